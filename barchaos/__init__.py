@@ -6,6 +6,6 @@ except NameError:
     __BARCHAOS_SETUP__ = False
 
 if not __BARCHAOS_SETUP__:
-    __all__ = ['experiments', 'potential']
+    __all__ = ['analysis', 'experiments', 'potential']
 
-    from . import experiments, potential
+    from . import analysis, experiments, potential
@@ -0,0 +1 @@
+from .diffusion import *
@@ -0,0 +1,212 @@
+# coding: utf-8
+
+"""
+Out-of-core post-processing of frequency map results.
+
+The frequency analysis results for a map can have many more rows than fit in
+memory, so everything here walks the experiment dataset in fixed-size chunks
+of rows. Each chunk is processed (vectorized) by a worker, and the master
+process writes the derived quantities into a new dataset in the cache file that
+is aligned row-by-row with the initial conditions ``w0``.
+"""
+
+# Standard library
+from os import path
+
+# Third-party
+import h5py
+import numpy as np
+
+# Project
+from ..log import logger
+
+__all__ = ['diffusion_rates', 'FrequencyDiffusion']
+
+def diffusion_rates(freqs, amps=None):
+    """Compute frequency diffusion rates for a block of orbits.
+
+    The diffusion rate is measured as the (log10) fractional change of each
+    fundamental frequency between the first and last window of the frequency
+    analysis.
+
+    Parameters
+    ----------
+    freqs : array_like
+        Fundamental frequencies with shape ``(norbits, nwindows, 3)``.
+    amps : array_like, optional
+        Amplitudes of the fundamental frequencies, same shape as ``freqs``. If
+        given, also return the diffusion rate of the leading (largest
+        amplitude) frequency in the first window.
+
+    Returns
+    -------
+    log_dfreq : numpy.ndarray
+        Log10 fractional frequency change per component, shape ``(norbits,
+        3)``.
+    log_dfreq_max : numpy.ndarray
+        Largest of the above over the three components, shape ``(norbits,)``.
+    log_dfreq_lead : numpy.ndarray
+        Only returned if ``amps`` is specified. Log10 fractional change of the
+        leading frequency, shape ``(norbits,)``.
+    """
+    freqs = np.asarray(freqs)
+
+    f1 = freqs[:, 0]
+    f2 = freqs[:, -1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_dfreq = np.log10(np.abs((f2 - f1) / f1))
+
+    # orbits with all NaN (e.g., failed orbits) should stay NaN
+    all_nan = np.all(np.isnan(log_dfreq), axis=1)
+    log_dfreq_max = np.full(len(log_dfreq), np.nan)
+    log_dfreq_max[~all_nan] = np.nanmax(log_dfreq[~all_nan], axis=1)
+
+    if amps is None:
+        return log_dfreq, log_dfreq_max
+
+    amps = np.nan_to_num(np.asarray(amps)[:, 0])
+    lead = np.argmax(amps, axis=1)
+    log_dfreq_lead = log_dfreq[np.arange(len(lead)), lead]
+
+    return log_dfreq, log_dfreq_max, log_dfreq_lead
+
+
+class FrequencyDiffusion(object):
+    """Compute frequency diffusion rates from the results of a `FreqMap` run.
+
+    Instances are callable on a ``(start, stop)`` row range and return the
+    derived quantities for those rows, so they can be passed to
+    ``pool.map()`` along with the ``callback`` method, exactly like the
+    `~barchaos.experiments.Experiment` classes::
+
+        with FrequencyDiffusion(cache_file) as analysis:
+            pool.map(analysis, analysis.chunks(), callback=analysis.callback)
+        analysis.status()
+
+    Rows that were not successfully processed (``error_code != 1``) are masked
+    and have NaN diffusion rates, so this can be run on partially complete
+    frequency maps.
+
+    Parameters
+    ----------
+    cache_file : str
+        Path to the cache file containing the source experiment dataset.
+    source : str, optional
+        Name of the source experiment dataset.
+    chunk_size : int, optional
+        Number of rows read, processed, and written at once. This sets the
+        (bounded) memory usage of each worker.
+    """
+
+    # dtype of things output by this analysis
+    cache_dtype = [
+        ('log_dfreq', 'f8', (3,)), # log10 fractional frequency change per component
+        ('log_dfreq_max', 'f8'), # maximum of the above over components
+        ('log_dfreq_lead', 'f8'), # log10 fractional change of the leading frequency
+        ('is_tube', 'b1'), # the orbit is a tube orbit
+        ('mask', 'b1') # source row was not successfully processed
+    ]
+
+    def __init__(self, cache_file, source='freqmap', chunk_size=2**20):
+        self.cache_file = path.abspath(cache_file)
+        self.source = source
+        self.name = '{0}_diffusion'.format(source)
+        self.chunk_size = int(chunk_size)
+
+        with h5py.File(self.cache_file, 'r') as f:
+            if self.source not in f:
+                raise IOError("Cache file at '{0}' has no '{1}' dataset to "
+                              "analyze.".format(self.cache_file, self.source))
+            self.n_orbits = f[self.source].shape[0]
+
+        logger.info("Number of orbits: {0}".format(self.n_orbits))
+
+        self._init_cache()
+
+    def _init_cache(self):
+        with h5py.File(self.cache_file, 'a') as f:
+            if self.name in f and f[self.name].shape[0] != self.n_orbits:
+                del f[self.name]
+
+            if self.name not in f:
+                f.create_dataset(name=self.name,
+                                 dtype=self.cache_dtype,
+                                 shape=(self.n_orbits,),
+                                 chunks=(max(1, min(self.chunk_size,
+                                                    self.n_orbits)),))
+
+    def __enter__(self):
+        self._counts = dict(n_valid=0, n_tube=0)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            return
+
+        with h5py.File(self.cache_file, 'a') as f:
+            d = f[self.name]
+            for k, v in self._counts.items():
+                d.attrs[k] = v
+
+            n_valid = self._counts['n_valid']
+            if n_valid > 0:
+                d.attrs['tube_fraction'] = self._counts['n_tube'] / n_valid
+                d.attrs['box_fraction'] = 1 - d.attrs['tube_fraction']
+
+    def chunks(self):
+        """Return a list of ``(start, stop)`` row ranges to process."""
+        starts = range(0, self.n_orbits, self.chunk_size)
+        return [(i, min(i+self.chunk_size, self.n_orbits)) for i in starts]
+
+    def __call__(self, chunk):
+        start, stop = chunk
+        logger.debug("Rows {0}-{1}".format(start, stop))
+
+        # Only read the fields we need for this chunk of rows
+        with h5py.File(self.cache_file, 'r') as f:
+            d = f[self.source]
+            freqs = d[start:stop, 'freqs']
+            amps = d[start:stop, 'amps']
+            is_tube = d[start:stop, 'is_tube']
+            error_code = d[start:stop, 'error_code']
+
+        mask = error_code != 1
+        freqs[mask] = np.nan
+        amps[mask] = np.nan
+
+        result = np.zeros(stop-start, dtype=self.cache_dtype)
+        (result['log_dfreq'], result['log_dfreq_max'],
+         result['log_dfreq_lead']) = diffusion_rates(freqs, amps)
+        result['is_tube'] = is_tube & ~mask
+        result['mask'] = mask
+
+        return start, stop, result
+
+    def callback(self, res):
+        """Write the results for a chunk of rows to the cache file. This should
+        run on the master process.
+        """
+        start, stop, result = res
+
+        logger.debug("Writing rows {0}-{1} to cache file...".format(start, stop))
+        with h5py.File(self.cache_file, 'a') as f:
+            f[self.name][start:stop] = result
+
+        self._counts['n_valid'] += int((~result['mask']).sum())
+        self._counts['n_tube'] += int(result['is_tube'].sum())
+
+    def status(self):
+        """
+        Prints out (to the logger) summary statistics of the derived dataset.
+        """
+
+        with h5py.File(self.cache_file, 'r') as f:
+            attrs = dict(f[self.name].attrs)
+
+        logger.info("------------- {0} Status -------------".format(self.name))
+        logger.info("Total number of orbits: {0}".format(self.n_orbits))
+        logger.info("Usable orbits: {0}".format(attrs.get('n_valid', 0)))
+        if 'tube_fraction' in attrs:
+            logger.info("Tube fraction: {0:.3f}".format(attrs['tube_fraction']))
+            logger.info("Box fraction: {0:.3f}".format(attrs['box_fraction']))
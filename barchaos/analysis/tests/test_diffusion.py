@@ -0,0 +1,84 @@
+# Third-party
+import h5py
+import numpy as np
+import pytest
+import schwimmbad
+
+# Package
+from ..diffusion import diffusion_rates, FrequencyDiffusion
+
+@pytest.fixture
+def cache_file(tmpdir):
+    fn = str(tmpdir.join('cache.hdf5'))
+
+    n = 1000
+    rnd = np.random.RandomState(42)
+    # the FreqMap dtype with the default two windows
+    dtype = [('freqs', 'f8', (2,3)), ('amps', 'f8', (2,3)), ('dE_max', 'f8'),
+             ('success', 'b1'), ('is_tube', 'b1'), ('dt', 'f8'),
+             ('nsteps', 'i8'), ('error_code', 'i8')]
+    data = np.zeros(n, dtype=dtype)
+    data['freqs'][:, 0] = rnd.uniform(0.1, 1., size=(n, 3))
+    data['freqs'][:, 1] = data['freqs'][:, 0] * (1 + 1E-4)
+    data['amps'] = rnd.uniform(size=(n, 2, 3))
+    data['is_tube'] = rnd.uniform(size=n) > 0.5
+    data['error_code'] = 1
+    data['error_code'][::10] = 4 # some failed orbits
+    data['error_code'][-100:] = 0 # some not processed yet
+
+    with h5py.File(fn, 'w') as f:
+        f.create_dataset('freqmap', data=data)
+
+    return fn
+
+def test_diffusion_rates():
+    freqs = np.ones((4, 2, 3))
+    freqs[:, 1] *= 1.01
+    freqs[1, 1, 2] = 1.1
+    freqs[2] = np.nan
+
+    log_df, log_df_max = diffusion_rates(freqs)
+    assert log_df.shape == (4, 3)
+    assert np.allclose(log_df[0], -2)
+    assert np.allclose(log_df_max[1], -1)
+    assert np.isnan(log_df_max[2])
+
+    amps = np.zeros_like(freqs)
+    amps[:, 0, 2] = 1.
+    *_, log_df_lead = diffusion_rates(freqs, amps)
+    assert np.allclose(log_df_lead[1], -1)
+
+@pytest.mark.parametrize('chunk_size', [64, 1000, 4096])
+def test_frequency_diffusion(cache_file, chunk_size):
+    with FrequencyDiffusion(cache_file, chunk_size=chunk_size) as analysis:
+        with schwimmbad.SerialPool() as pool:
+            for _ in pool.map(analysis, analysis.chunks(),
+                              callback=analysis.callback):
+                pass
+    analysis.status()
+
+    with h5py.File(cache_file, 'r') as f:
+        src = f['freqmap'][:]
+        d = f['freqmap_diffusion']
+        res = d[:]
+        attrs = dict(d.attrs)
+
+    assert res.shape == src.shape
+    assert np.all(res['mask'] == (src['error_code'] != 1))
+    assert np.all(np.isnan(res['log_dfreq_max'][res['mask']]))
+    assert np.allclose(res['log_dfreq_max'][~res['mask']], -4)
+
+    good = src['error_code'] == 1
+    assert attrs['n_valid'] == good.sum()
+    assert attrs['n_tube'] == (src['is_tube'] & good).sum()
+
+def test_frequency_diffusion_multi(cache_file):
+    with FrequencyDiffusion(cache_file, chunk_size=128) as analysis:
+        with schwimmbad.MultiPool(processes=2) as pool:
+            pool.map(analysis, analysis.chunks(), callback=analysis.callback)
+
+    with h5py.File(cache_file, 'r') as f:
+        src = f['freqmap'][:]
+        res = f['freqmap_diffusion'][:]
+    assert np.all(res['mask'] == (src['error_code'] != 1))
+    assert np.allclose(res['log_dfreq_max'][~res['mask']], -4)
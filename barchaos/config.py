@@ -1,15 +1,18 @@
 # coding: utf-8
 
 # Standard library
+import copy
 import os
 from os import path
 from abc import abstractproperty
+import hashlib
+import json
 
 # Third-party
 # import yaml
 import ruamel.yaml as yaml # supports comments
 
-__all__ = ['ConfigNamespace']
+__all__ = ['ConfigNamespace', 'ConfigSnapshot']
 
 class ConfigItem(object):
 
@@ -56,6 +59,16 @@ class ConfigItem(object):
     def set(self, value):
         if type(value) in self.allowed_types:
             self._value = value
+
+        # values loaded from YAML can be subclasses of the builtin types (e.g.,
+        # ruamel's ScalarFloat), but don't let bools pass as ints
+        elif (not isinstance(value, bool) and
+              isinstance(value, tuple(self.allowed_types))):
+            for type_ in self.allowed_types:
+                if isinstance(value, type_):
+                    self._value = type_(value)
+                    break
+
         else:
             raise TypeError("{0} must have type {1}, not {2}".format(self.name,
                                                                      self.allowed_types,
@@ -129,6 +142,11 @@ class ConfigNamespace(object, metaclass=_ConfigNamespaceMeta):
         items = dict([(n, getattr(self, n)) for n in self._items])
         return items
 
+    def defaults(self):
+        """The default values of the settings, ignoring the current values."""
+        return dict([(n, getattr(self, '_'+n).default_value)
+                     for n in self._items])
+
     def save(self, filename):
         """Save the configuration state to the specified YAML file.
 
@@ -181,3 +199,209 @@ class ConfigNamespace(object, metaclass=_ConfigNamespaceMeta):
             setattr(self, k, dict_[k])
 
 
+
+
+def _freeze(value):
+    """Convert a configuration value to an immutable, plain Python type."""
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+
+    for type_ in (bool, int, float, str):
+        if isinstance(value, type_):
+            return type_(value)
+
+    if value is None:
+        return value
+
+    raise TypeError("Unsupported configuration value type {0}"
+                    .format(type(value)))
+
+
+def _digest(obj):
+    """A stable content digest of a JSON-serializable object."""
+    s = json.dumps(obj, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+class FrozenNamespace(object):
+    """An immutable view of the settings in a single configuration namespace.
+
+    Settings are accessed as attributes, like with `ConfigNamespace` instances,
+    but can't be changed.
+
+    Parameters
+    ----------
+    name : str
+        The name of the configuration namespace.
+    items : dict
+        The setting names and values.
+    """
+
+    def __init__(self, name, items):
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, '_items',
+                           dict((k, _freeze(v)) for k, v in items.items()))
+
+    def __getattr__(self, key):
+        try:
+            return self.__dict__['_items'][key]
+        except KeyError:
+            raise AttributeError("Configuration namespace '{0}' has no setting "
+                                 "'{1}'".format(self.name, key))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Configuration snapshots are immutable.")
+
+    def __reduce__(self):
+        return (self.__class__, (self.name, self._items))
+
+    def __repr__(self):
+        items = ["{0}={1!r}".format(k, v) for k,v in sorted(self._items.items())]
+        return '<{0} {1}: {2}>'.format(self.__class__.__name__, self.name,
+                                       ' '.join(items))
+
+    def __eq__(self, other):
+        return (isinstance(other, FrozenNamespace) and
+                self.name == other.name and self._items == other._items)
+
+    def __hash__(self):
+        return hash(self.digest())
+
+    def to_dict(self):
+        return dict(self._items)
+
+    def replace(self, **kwargs):
+        """Return a copy of this namespace with some settings changed."""
+        items = self.to_dict()
+        for k in kwargs:
+            if k not in items:
+                raise AttributeError("Configuration namespace '{0}' has no "
+                                     "setting '{1}'".format(self.name, k))
+        items.update(kwargs)
+        return self.__class__(self.name, items)
+
+    def digest(self, keys=None):
+        """A stable content digest of the settings in this namespace.
+
+        Parameters
+        ----------
+        keys : iterable, optional
+            Only include these settings in the digest. This is useful for
+            keying caches that only depend on a subset of the settings.
+        """
+        if keys is None:
+            keys = self._items.keys()
+        return _digest([self.name, dict((k, self._items[k]) for k in keys)])
+
+
+class ConfigSnapshot(object):
+    """An immutable, picklable snapshot of the settings in a set of
+    configuration namespaces.
+
+    `ConfigNamespace` subclasses act like mutable singletons that are loaded
+    from a file, so separate processes can end up with different settings. A
+    snapshot instead resolves the settings once (e.g., on the master process)
+    and can be sent to worker processes, which then never have to touch the
+    filesystem to get their settings. The `digest()` identifies the settings by
+    content, so it can be used as a cache key and stored as provenance.
+
+    Use `ConfigSnapshot.load` to create a snapshot, and access the settings of
+    each namespace by name::
+
+        snapshot = ConfigSnapshot.load('config.yml', [FreqMapConfig()])
+        snapshot['freqmap'].n_periods
+
+    Parameters
+    ----------
+    namespaces : iterable
+        `FrozenNamespace` instances.
+    """
+
+    def __init__(self, namespaces):
+        object.__setattr__(self, '_namespaces',
+                           dict((ns.name, ns) for ns in namespaces))
+
+    @classmethod
+    def load(cls, filename, namespaces):
+        """Resolve the settings of a set of configuration namespaces (defaults
+        updated with any values in the given YAML file) into a snapshot.
+
+        The namespaces themselves are not changed, so a snapshot only depends
+        on the defaults and the given file - not on files loaded before, or on
+        settings changed on the (singleton) namespaces.
+
+        Parameters
+        ----------
+        filename : str, None
+            Path to a YAML configuration file, or None to use the defaults.
+        namespaces : iterable
+            `ConfigNamespace` instances to include in the snapshot.
+        """
+        dict_ = dict()
+        if filename is not None:
+            with open(filename, 'r') as f:
+                dict_ = yaml.load(f, yaml.RoundTripLoader) or dict()
+
+        frozen = []
+        for ns in namespaces:
+            items = ns.defaults()
+            for k, v in dict_.get(ns.name, dict()).items():
+                if k not in items: # unknown settings are ignored, as in load()
+                    continue
+
+                # validate the value with a copy of the item
+                item = copy.copy(getattr(ns, '_'+k))
+                item.set(v)
+                items[k] = item()
+
+            frozen.append(FrozenNamespace(ns.name, items))
+        return cls(frozen)
+
+    def __getitem__(self, name):
+        return self._namespaces[name]
+
+    def __contains__(self, name):
+        return name in self._namespaces
+
+    def __iter__(self):
+        return iter(sorted(self._namespaces.keys()))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Configuration snapshots are immutable.")
+
+    def __reduce__(self):
+        return (self.__class__, (list(self._namespaces.values()),))
+
+    def __repr__(self):
+        return '<{0} {1}: {2}>'.format(self.__class__.__name__,
+                                       self.digest()[:8], ', '.join(self))
+
+    def __eq__(self, other):
+        return (isinstance(other, ConfigSnapshot) and
+                self.digest() == other.digest())
+
+    def __hash__(self):
+        return hash(self.digest())
+
+    def to_dict(self):
+        return dict((name, self[name].to_dict()) for name in self)
+
+    def digest(self):
+        """A stable content digest of all settings in the snapshot."""
+        return _digest(self.to_dict())
+
+    def replace(self, name, **kwargs):
+        """Return a copy of this snapshot with some settings in namespace
+        ``name`` changed.
+        """
+        namespaces = dict(self._namespaces)
+        namespaces[name] = namespaces[name].replace(**kwargs)
+        return self.__class__(namespaces.values())
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    @classmethod
+    def from_json(cls, s):
+        """Load a snapshot stored with `ConfigSnapshot.to_json`."""
+        return cls([FrozenNamespace(k, v) for k, v in json.loads(s).items()])
@@ -1 +1,8 @@
-from .freqmap import FreqMap
+from .freqmap import FreqMap, OrbitIntegration
+from .lyapunov import LyapunovScreen
+from .refine import AdaptiveGrid, xz_initial_conditions
+from .sweep import Sweep
+from .sos import SurfaceOfSection, section_initial_conditions
+from .lease import LeaseLedger, process_leases
+from .orbitstats import OrbitStats
+from .pipeline import Pipeline
@@ -4,8 +4,13 @@
 from abc import ABCMeta, abstractproperty
 from abc import abstractclassmethod
 from os import path
+import cProfile
+import glob
+import io
 import os
 import pickle
+import pstats
+import socket
 
 # Third-party
 import h5py
@@ -13,12 +18,31 @@ import numpy as np
 import gala.dynamics as gd
 
 # Project
+from ..config import ConfigSnapshot
 from ..log import logger
-from ..potential import get_hamiltonian
-from .error import error_codes
+from ..potential import get_hamiltonian, Config as PotentialConfig
+from .error import error_codes, OrbitTimeout
+from .lease import FileLock
+from .util import call_with_time_limit
 
 __all__ = ['Experiment']
 
+# Hamiltonians already constructed in this process, keyed by the digest of the
+# potential settings - so workers only build each Hamiltonian once, even when
+# processing orbits for several configurations (see `Sweep`)
+_hamiltonians = dict()
+
+def _get_hamiltonian(snapshot):
+    key = snapshot[PotentialConfig.name].digest()
+    if key not in _hamiltonians:
+        _hamiltonians[key] = get_hamiltonian(snapshot)
+    return _hamiltonians[key]
+
+# Profilers in this process, keyed by the profile directory of the experiment,
+# which accumulate the profiles of all sampled orbits processed by this worker
+# (see the ``profile`` argument of `Experiment`)
+_profilers = dict()
+
 class Experiment(object):
 
     __metaclass__ = ABCMeta
@@ -31,7 +55,8 @@ class Experiment(object):
     def config(self):
         """ A ConfigNamespace subclass instance containing config defaults """
 
-    def __init__(self, cache_file, config_file=None, overwrite=False):
+    def __init__(self, cache_file, config_file=None, overwrite=False,
+                 keyed=False, time_budget=None, profile=None, shared=False):
 
         # Name of this experiment
         self.name = self.__class__.__name__.lower()
@@ -44,12 +69,35 @@ class Experiment(object):
                           "initial conditions.".format(self.cache_file))
         self._cache_path = path.dirname(self.cache_file)
 
-        # Load the configuraton settings for this experiment
+        # If shared, several independent jobs can process this cache file at
+        # the same time (see `process_leases`): all access to the cache file
+        # is serialized with a lock file, and each job has its own temporary
+        # directory
+        self.shared = shared
+        self.job_id = None
+        lock_file = None
+        if self.shared:
+            self.job_id = "{0}-{1}".format(socket.gethostname(), os.getpid())
+            lock_file = "{0}.lock".format(path.splitext(self.cache_file)[0])
+        self._lock = FileLock(lock_file)
+
+        # Resolve the configuraton settings for this experiment (and the
+        # potential) once, here, into an immutable snapshot that is sent to
+        # the worker processes along with this object
         self.config_file = config_file
-        self.config.load(self.config_file)
+        self.snapshot = ConfigSnapshot.load(self.config_file,
+                                            [PotentialConfig(), self.config])
+
+        # If keyed, the results are stored in a dataset named by the digest
+        # of the configuration, so results for several configurations can be
+        # stored in the same cache file
+        self.key = None
+        if keyed:
+            self.key = self.snapshot.digest()
+            self.name = "{0}_{1}".format(self.name, self.key)
 
         # Load initial conditions
-        with h5py.File(self.cache_file) as f:
+        with self._lock, h5py.File(self.cache_file) as f:
             self.w0 = gd.PhaseSpacePosition.from_hdf5(f['w0'])
 
         self.n_orbits = self.w0.shape[0]
@@ -57,6 +105,23 @@ class Experiment(object):
 
         self.overwrite = overwrite
 
+        # Wall-clock time budget for processing each orbit, in seconds. With a
+        # budget, each orbit is processed in a forked child process (see
+        # `call_with_time_limit`), so this can't be used in MPI processes,
+        # which can't safely be forked
+        self.time_budget = time_budget
+
+        # If set, profile every this many orbits - the worker profiles are
+        # written to a directory next to the cache file and merged in
+        # ``status()``
+        self.profile = profile
+        profile_dir = "_profile_{0}".format(self.__class__.__name__)
+        if self.key is not None:
+            profile_dir = "{0}_{1}".format(profile_dir, self.key)
+        if self.job_id is not None:
+            profile_dir = "{0}_{1}".format(profile_dir, self.job_id)
+        self._profile_dir = path.join(self._cache_path, profile_dir)
+
         # Now we initialize the cache file so it has an empty dataset to be
         # filled by this experiment
         self._init_cache()
@@ -66,13 +131,53 @@ class Experiment(object):
         # all experiments must also return an error code - see error.py
         return self.cache_dtype + [('error_code', 'i8')]
 
+    @property
+    def settings(self):
+        """ The (frozen) configuration settings for this experiment """
+        return self.snapshot[self.config.name]
+
     def _init_cache(self):
-        with h5py.File(self.cache_file) as f:
+        digest = self.snapshot.digest()
+
+        with self._lock, h5py.File(self.cache_file) as f:
+            # the dtype of some experiments depends on the configuration
+            if self.name in f and f[self.name].dtype != np.dtype(self._dtype):
+                if not self.overwrite:
+                    raise IOError("Existing results in '{0}' have a different "
+                                  "dtype (from different settings) - use "
+                                  "overwrite, or keyed results."
+                                  .format(self.name))
+                del f[self.name]
+
+            # results computed with different settings can't be mixed
+            if (self.name in f and
+                    f[self.name].attrs.get('config_digest', digest) != digest):
+                if not self.overwrite:
+                    raise IOError("Existing results in '{0}' were computed "
+                                  "with different configuration settings - "
+                                  "use overwrite, or keyed results."
+                                  .format(self.name))
+                del f[self.name]
+
             if self.name not in f:
-                # create the empty dataset
-                f.create_dataset(name=self.name,
-                                 dtype=self._dtype,
-                                 shape=(self.n_orbits,))
+                # create the empty dataset - this is resizable so that initial
+                # conditions can be appended to the cache file later (see
+                # AdaptiveGrid)
+                d = f.create_dataset(name=self.name,
+                                     dtype=self._dtype,
+                                     shape=(self.n_orbits,),
+                                     maxshape=(None,))
+
+                # store the configuration as provenance for the results
+                d.attrs['config_digest'] = digest
+                d.attrs['config'] = self.snapshot.to_json()
+
+            elif f[self.name].shape[0] < self.n_orbits:
+                if f[self.name].maxshape[0] is not None:
+                    raise IOError("Cache file has more initial conditions "
+                                  "than results in '{0}', but the dataset "
+                                  "can't be resized.".format(self.name))
+                f[self.name].resize(self.n_orbits, axis=0)
 
     @property
     def _empty_result(self):
@@ -113,14 +218,27 @@ class Experiment(object):
     # in this mode, the class creates a temporary directory to write all of the
     # intermediate results to, and cleans them up at the end.
     def __enter__(self):
-        self._tmpdir = path.join(self._cache_path,
-                                 "_tmp_{0}".format(self.__class__.__name__))
+        tmpdir = "_tmp_{0}".format(self.__class__.__name__)
+        if self.key is not None:
+            tmpdir = "{0}_{1}".format(tmpdir, self.key)
+        if self.job_id is not None:
+            tmpdir = "{0}_{1}".format(tmpdir, self.job_id)
+        self._tmpdir = path.join(self._cache_path, tmpdir)
 
         logger.debug("Creating temp. directory {0}".format(self._tmpdir))
         if path.exists(self._tmpdir):
             import shutil
             shutil.rmtree(self._tmpdir)
         os.mkdir(self._tmpdir)
+
+        if self.profile:
+            # remove profiles from any previous run
+            _profilers.pop(self._profile_dir, None)
+            if path.exists(self._profile_dir):
+                import shutil
+                shutil.rmtree(self._profile_dir)
+            os.mkdir(self._profile_dir)
+
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -136,6 +254,22 @@ class Experiment(object):
     def run(cls, w0, potential, **kwargs):
         """ (classmethod) Run the experiment on a single orbit """
 
+    def indices(self):
+        """The orbit indices to process with this experiment. Subclasses can
+        override this to only run on a subset of the initial conditions.
+        """
+        return list(range(self.n_orbits))
+
+    def timed_out(self):
+        """The indices of orbits that exceeded their time budget."""
+        with self._lock, h5py.File(self.cache_file, 'r') as f:
+            error_code = f[self.name]['error_code']
+        return np.where(error_code == 6)[0].tolist()
+
+    def _run_kwargs(self, index):
+        """Any extra, per-orbit keyword arguments to pass to ``run()``."""
+        return dict()
+
     def callback(self, tmpfile):
         """A function that operates on the name of the temporary cache file that
         each worker writes. This function should run on the master process, and
@@ -156,33 +290,60 @@ class Experiment(object):
                      .format(index))
 
         # row index
-        with h5py.File(self.cache_file, 'a') as f:
+        with self._lock, h5py.File(self.cache_file, 'a') as f:
             g = f[self.name]
             g[index] = result
 
         del result
 
     def __call__(self, index):
-        logger.info("Orbit {0}".format(index))
-
-        # Read the results for just this orbit
-        with h5py.File(self.cache_file, 'r') as f:
-            g = f[self.name]
-            error_code = g[index]['error_code']
-
-        # Short-circuit if this orbit is already done
-        if not self.overwrite and error_code > 0:
-            logger.debug("Orbit {0} already completed.".format(index))
-            return None
-
-        # Load the Hamiltonian object to use to integrate orbits
-        H = get_hamiltonian(self.config_file)
+        return self._process(index)
 
-        # Only pass in things specified in _run_kwargs (w0 and potential required)
-        # kwargs = dict([(k,self.config[k])
-        #                for k in self.config.keys() if k in self._run_kwargs])
-        res = self.run(w0=self.w0[index], H=H)
+    def _run(self, index, H):
+        """Run the experiment on an orbit."""
+        return self._profiled(index, self.run, w0=self.w0[index], H=H,
+                              **self._run_kwargs(index))
 
+    def _profiled(self, index, func, *args, **kwargs):
+        """Call a function that processes an orbit, profiling every
+        ``profile``-th orbit.
+        """
+        if not self.profile or index % self.profile != 0:
+            return func(*args, **kwargs)
+
+        if self._profile_dir not in _profilers:
+            _profilers[self._profile_dir] = cProfile.Profile()
+        profiler = _profilers[self._profile_dir]
+
+        profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+
+            # one file per process, with the cumulative profile of all orbits
+            # this process has profiled so far
+            profiler.dump_stats(path.join(self._profile_dir,
+                                           "{0}.prof".format(os.getpid())))
+
+    def _needs_run(self, index, error_code=None):
+        """Whether an orbit still needs to be processed, given its error code
+        (read from the cache file if not given).
+        """
+        if error_code is None:
+            # Read the results for just this orbit
+            with self._lock, h5py.File(self.cache_file, 'r') as f:
+                g = f[self.name]
+                error_code = g[index]['error_code']
+
+        # orbits that ran out of time are always retried, as are orbits that
+        # were skipped by the pre-screen (if they are processed now)
+        return self.overwrite or error_code in (0, 6, 7)
+
+    def _save_result(self, index, res):
+        """Write the result for an orbit to a temporary file (see
+        ``callback``), and return the name of the file.
+        """
         if res['error_code'] > 1:
             logger.warning(error_codes[res['error_code'][0]])
 
@@ -192,17 +353,43 @@ class Experiment(object):
             pickle.dump((index, res), f)
         return tmpfile
 
+    def _process(self, index):
+        logger.info("Orbit {0}".format(index))
+
+        # Short-circuit if this orbit is already done
+        if not self._needs_run(index):
+            logger.debug("Orbit {0} already completed.".format(index))
+            return None
+
+        # Load the Hamiltonian object to use to integrate orbits
+        H = _get_hamiltonian(self.snapshot)
+
+        if not self.time_budget:
+            res = self._run(index, H)
+
+        else:
+            # run in a child process that is killed if it runs out of time
+            try:
+                res = call_with_time_limit(self.time_budget, self._run,
+                                           index, H)
+            except OrbitTimeout:
+                res = self._empty_result
+                res['error_code'] = 6
+
+        return self._save_result(index, res)
+
     def status(self):
         """
         Prints out (to the logger) the status of the current run of the experiment.
         """
 
-        with h5py.File(self.cache_file) as f:
+        with self._lock, h5py.File(self.cache_file) as f:
             d = f[self.name]
 
             # numbers
             nsuccess = d['success'].sum()
-            nfail = ((d['success'] == False) & (d['error_code'] > 0)).sum()
+            nfail = ((d['success'] == False) & (d['error_code'] > 0) &
+                     (d['error_code'] != 7)).sum()
 
             logger.info("------------- {0} Status -------------"
                         .format(self.name))
@@ -214,3 +401,37 @@ class Experiment(object):
                 n = (d['error_code'] == ecode).sum()
                 logger.info("\t({0}) {1}: {2}".format(ecode,
                                                       error_codes[ecode], n))
+
+        if self.profile:
+            self.profile_report()
+
+    def profile_report(self, n_lines=25):
+        """Merge the profiles written by each worker into a single profile
+        (``merged.prof`` in the profile directory), and print (to the logger)
+        the functions with the largest cumulative time.
+
+        Returns
+        -------
+        stats : `pstats.Stats`
+            The merged profile, or None if no orbits were profiled.
+        """
+        filenames = sorted(glob.glob(path.join(self._profile_dir,
+                                               "[0-9]*.prof")))
+        if len(filenames) == 0:
+            logger.info("No profiles in {0}".format(self._profile_dir))
+            return None
+
+        stats = pstats.Stats(filenames[0], stream=io.StringIO())
+        for filename in filenames[1:]:
+            stats.add(filename)
+        stats.dump_stats(path.join(self._profile_dir, "merged.prof"))
+
+        logger.info("------------- {0} Profile -------------".format(self.name))
+        logger.info("Merged {0} worker profiles into {1}"
+                    .format(len(filenames), self._profile_dir))
+        stats.sort_stats('cumulative').print_stats(n_lines)
+        for line in stats.stream.getvalue().splitlines():
+            if line.strip():
+                logger.info(line)
+
+        return stats
@@ -7,5 +7,12 @@ error_codes = {
     3: "Failed to integrate orbit",
     4: "Energy conservation criteria not met",
     5: "SuperFreq failed on find_fundamental_frequencies()",
+    6: "Exceeded the wall-clock time budget for the orbit",
+    7: "Skipped by the chaos pre-screen",
+    8: "Potential has no C implementation, required by the integrator",
     9: "Unexpected failure"
 }
+
+class OrbitTimeout(Exception):
+    """Raised when processing an orbit exceeds its wall-clock time budget."""
+    pass
@@ -1,7 +1,14 @@
 # coding: utf-8
 
+# Standard library
+from os import path
+import os
+import pickle
+
 # Third-party
+import h5py
 import numpy as np
+import gala.dynamics as gd
 import gala.integrate as gi
 from gala.dynamics.util import estimate_dt_n_steps
 from superfreq import SuperFreq
@@ -10,9 +17,11 @@ from superfreq import SuperFreq
 from ..config import ConfigNamespace, ConfigItem
 from ..log import logger
 from .base import Experiment
-from .util import orbit_to_poincare_polar
+from .lyapunov import LyapunovScreen
+from .store import OrbitStore
+from .util import circulation, frequency_coordinates, integrate_orbit
 
-__all__ = ['FreqMap']
+__all__ = ['FreqMap', 'OrbitIntegration', 'window_slices']
 
 class Config(ConfigNamespace):
     name = "freqmap"
@@ -26,6 +35,15 @@ class Config(ConfigNamespace):
     n_steps_per_period = ConfigItem(
         512, "Number of steps per integration period (determines step size)")
 
+    atol = ConfigItem(
+        1E-11, "Absolute tolerance for the integrator")
+
+    atol_ladder = ConfigItem(
+        [], "Tolerances to try in turn, e.g., [1E-8, 1E-10, 1E-12]: orbits are "
+            "re-integrated with the next tolerance until the energy is "
+            "conserved to within energy_tolerance. If empty, only atol is "
+            "used")
+
     hamming_p = ConfigItem(
         4, "Exponent to use for Hamming filter in SuperFreq")
 
@@ -35,24 +53,196 @@ class Config(ConfigNamespace):
     force_cartesian = ConfigItem(
         False, "Do frequency analysis on orbit in cartesian coordinates")
 
+    n_windows = ConfigItem(
+        2, "Number of time windows to compute the frequencies in")
+
+    window_overlap = ConfigItem(
+        0., "Fraction of each window that overlaps the next window (0 for "
+            "contiguous windows, e.g., 0.5 for half-overlapping sliding "
+            "windows)")
+
+    store_downsample = ConfigItem(
+        1, "When storing orbits with OrbitIntegration, only keep every "
+           "n-th timestep")
+
+    store_compression = ConfigItem(
+        "", "HDF5 compression filter for stored orbits (e.g., 'gzip'), or "
+            "empty to store orbits uncompressed")
+
+    prescreen_n_periods = ConfigItem(
+        0, "When using the chaos pre-screen, number of orbital periods to "
+           "integrate orbits classified as clearly regular or chaotic for. "
+           "If 0, these orbits are skipped")
+
+# The freqmap settings that the integrated (and stored) orbits depend on - the
+# frequency analysis of stored orbits can be re-run with any other settings
+_integration_keys = ['energy_tolerance', 'n_periods', 'n_steps_per_period',
+                     'atol', 'atol_ladder', 'prescreen_n_periods',
+                     'store_downsample']
+
+def window_slices(nsteps, n_windows, overlap=0.):
+    """Split an orbit with ``nsteps`` steps (``nsteps+1`` times) into windows
+    of equal length, spanning the orbit.
+
+    Parameters
+    ----------
+    nsteps : int
+        Number of steps in the orbit.
+    n_windows : int
+        Number of windows.
+    overlap : float, optional
+        Fraction of each window that overlaps the next window.
+
+    Returns
+    -------
+    slices : list
+        A slice of the orbit for each window. Consecutive windows share at
+        least their end and start points.
+    """
+    if n_windows < 1:
+        raise ValueError("Number of windows must be at least 1.")
+
+    if not 0 <= overlap < 1:
+        raise ValueError("Window overlap must be in the range [0, 1).")
+
+    # number of steps in each window
+    n = int(nsteps / (1 + (n_windows-1) * (1-overlap)))
+    starts = np.round(np.linspace(0, nsteps-n, n_windows)).astype(int)
+    return [slice(start, start+n+1) for start in starts]
+
 
 class FreqMap(Experiment):
-    # dtype of things output by this experiment
-    cache_dtype = [
-        ('freqs', 'f8', (2,3)), # three fundamental frequencies computed in 2 windows
-        ('amps', 'f8', (2,3)), # amplitudes of frequencies in time series
-        ('dE_max', 'f8'), # maximum energy difference (compared to initial) during orbit integration
-        ('success', 'b1'), # did we succeed in computing the frequencies
-        ('is_tube', 'b1'), # the orbit is a tube orbit
-        ('dt', 'f8'), # timestep used for integration
-        ('nsteps', 'i8') # number of steps integrated
-    ]
 
     config = Config()
 
-    # TODO: eek, this might be borked because I changed it from a classmethod...
-    def run(self, w0, H):
-        c = self.config
+    @property
+    def cache_dtype(self):
+        # the number of windows is set by the configuration
+        n = self.settings.n_windows
+        return [
+            ('freqs', 'f8', (n,3)), # three fundamental frequencies computed in each window
+            ('amps', 'f8', (n,3)), # amplitudes of frequencies in time series
+            ('dE_max', 'f8'), # maximum energy difference (compared to initial) during orbit integration
+            ('success', 'b1'), # did we succeed in computing the frequencies
+            ('is_tube', 'b1'), # the orbit is a tube orbit
+            ('dt', 'f8'), # timestep used for integration
+            ('nsteps', 'i8') # number of steps integrated
+        ] + self._ladder_dtype
+
+    @property
+    def _ladder_dtype(self):
+        # only record the rung if there is a ladder, so that cache files
+        # written without one keep the same dtype
+        if not self.settings.atol_ladder:
+            return []
+        return [('rung', 'i8')] # the rung of the tolerance ladder that was used
+
+    def __init__(self, cache_file, config_file=None, overwrite=False,
+                 prescreen=False, orbit_store=None, **kwargs):
+        super(FreqMap, self).__init__(cache_file, config_file=config_file,
+                                      overwrite=overwrite, **kwargs)
+
+        # Load the orbit classifications from the chaos pre-screen
+        self._classification = None
+        if prescreen:
+            screen_name = LyapunovScreen.__name__.lower()
+            with self._lock, h5py.File(self.cache_file, 'r') as f:
+                if screen_name not in f:
+                    raise IOError("Cache file has no '{0}' results - you must "
+                                  "run the {1} experiment first."
+                                  .format(screen_name,
+                                          LyapunovScreen.__name__))
+                self._classification = f[screen_name]['classification']
+
+            # e.g., initial conditions were added after the pre-screen ran
+            if len(self._classification) != self.n_orbits:
+                raise IOError("The '{0}' results are for {1} orbits, but "
+                              "there are {2} initial conditions - you must "
+                              "re-run the {3} experiment first."
+                              .format(screen_name, len(self._classification),
+                                      self.n_orbits, LyapunovScreen.__name__))
+
+            # mark the orbits that will be skipped, so they aren't reported
+            # as not processed yet
+            if self.settings.prescreen_n_periods == 0:
+                self._mark_skipped()
+
+        # If an orbit store is specified, the orbits are read from the store
+        # (written by the OrbitIntegration experiment) instead of integrated
+        self.store = None
+        if orbit_store is not None:
+            if not path.exists(orbit_store):
+                raise IOError("Orbit store at '{0}' doesn't exist - you must "
+                              "run the OrbitIntegration experiment first."
+                              .format(orbit_store))
+            self.store = OrbitStore(orbit_store)
+
+            # stores written before the settings were recorded are assumed to
+            # match
+            digest = self.store.config_digest or self._store_digest
+            if digest != self._store_digest:
+                raise IOError("The orbits in the orbit store at '{0}' were "
+                              "integrated with different potential or "
+                              "freqmap integration settings."
+                              .format(orbit_store))
+
+    @property
+    def _store_digest(self):
+        # the potential and integration settings the orbits depend on
+        return "{0}_{1}".format(self.snapshot['potential'].digest(),
+                                self.settings.digest(_integration_keys))
+
+    def _mark_skipped(self):
+        skip = np.isin(self._classification, (1, 3))
+        with self._lock, h5py.File(self.cache_file, 'a') as f:
+            d = f[self.name]
+            error_code = d['error_code']
+            skip &= (error_code == 0)
+            if np.any(skip):
+                error_code[skip] = 7
+                d['error_code'] = error_code
+
+    def _is_clear_case(self, index):
+        # classified as regular or chaotic by the pre-screen
+        return self._classification[index] in (1, 3)
+
+    def indices(self):
+        idx = super(FreqMap, self).indices()
+
+        if (self._classification is not None and
+                self.settings.prescreen_n_periods == 0):
+            idx = [i for i in idx if not self._is_clear_case(i)]
+            logger.info("Pre-screen: skipping {0} clearly regular or chaotic "
+                        "orbits".format(self.n_orbits - len(idx)))
+
+        return idx
+
+    def _run_kwargs(self, index):
+        kw = dict()
+        if self._classification is not None and self._is_clear_case(index):
+            kw['n_periods'] = self.settings.prescreen_n_periods
+
+        # read the orbit from the store instead of integrating
+        if self.store is not None:
+            kw['index'] = index
+
+        return kw
+
+    def integrate(self, w0, H, n_periods=None):
+        """Integrate the orbit and check energy conservation.
+
+        Returns
+        -------
+        orbit : `~gala.dynamics.Orbit`
+            The orbit, or None if the integration failed.
+        result : numpy.ndarray
+            The result array, with ``dt``, ``nsteps``, and ``dE_max`` set, and
+            with a nonzero ``error_code`` if the integration failed.
+        """
+        c = self.settings
+
+        if n_periods is None:
+            n_periods = c.n_periods
 
         # return dict
         result = self._empty_result
@@ -60,77 +250,248 @@ class FreqMap(Experiment):
         # get timestep and nsteps for integration
         try:
             dt, nsteps = estimate_dt_n_steps(
-                w0, H, n_periods=c.n_periods,
+                w0, H, n_periods=n_periods,
                 n_steps_per_period=c.n_steps_per_period,
                 func=np.nanmin, Integrator=gi.DOPRI853Integrator)
         except RuntimeError:
             result['error_code'] = 2
-            return result
+            return None, result
         except:
             result['error_code'] = 9
-            return result
+            return None, result
 
         # integrate orbit
-        logger.debug("Integrating orbit with dt={0}, nsteps={1}".format(dt, nsteps))
-        try:
-            orbit = H.integrate_orbit(w0, dt=dt, n_steps=nsteps,
-                                      Integrator=gi.DOPRI853Integrator,
-                                      Integrator_kwargs=dict(atol=1E-11))
-        except RuntimeError: # ODE integration failed
-            logger.warning("Orbit integration failed.")
-            dEmax = 1E10
-        else:
-            logger.debug('Orbit integrated successfully, checking energy conservation...')
-
-            # check energy conservation for the orbit
-            E = orbit.energy()
-            dEmax = np.max(np.abs((E[1:] - E[0])/E[0]))
-            logger.debug('max(∆E) = {0:.2e}'.format(dEmax))
+        orbit, dEmax, rung = self._integrate_ladder(w0, H, dt, nsteps)
+
+        result['dE_max'] = dEmax
+        result['dt'] = float(dt)
+        result['nsteps'] = nsteps
+        if 'rung' in result.dtype.names:
+            result['rung'] = rung
 
         if dEmax > c.energy_tolerance:
             result['error_code'] = 4
-            result['dE_max'] = dEmax
+
+        return orbit, result
+
+    def _integrate_ladder(self, w0, H, dt, nsteps):
+        """Integrate the orbit at each rung of the tolerance ladder in turn,
+        until the energy is conserved to within the energy tolerance.
+
+        Returns
+        -------
+        orbit : `~gala.dynamics.Orbit`
+            The orbit, sampled with timestep ``dt``, or None if the integration
+            failed.
+        dE_max : float
+            The maximum fractional energy difference.
+        rung : int
+            The index of the last tolerance tried.
+        """
+        c = self.settings
+
+        ladder = c.atol_ladder or (c.atol,)
+        for rung, atol in enumerate(ladder):
+            if rung > 0:
+                logger.debug("Energy not conserved (dE_max={0:.1e}), "
+                             "retrying at rung {1}".format(dEmax, rung))
+
+            orbit, dEmax = integrate_orbit(w0, H, dt=dt, n_steps=nsteps,
+                                           atol=atol)
+
+            if dEmax <= c.energy_tolerance:
+                break
+
+        return orbit, dEmax, rung
+
+    def _read_orbit(self, index, H):
+        """Read an orbit from the orbit store."""
+        result = self._empty_result
+
+        with self._lock:
+            in_store = index in self.store
+
+        if not in_store:
+            # propagate the reason the integration failed, if it did
+            with self._lock, h5py.File(self.cache_file, 'r') as f:
+                name = OrbitIntegration.__name__.lower()
+                if name in f and f[name][index]['error_code'] > 1:
+                    result['error_code'] = f[name][index]['error_code']
+                else:
+                    logger.warning("Orbit {0} not in the orbit store."
+                                   .format(index))
+                    result['error_code'] = 9
+            return None, result
+
+        with self._lock:
+            t, w, attrs = self.store.read(index)
+        orbit = gd.Orbit(pos=w[:3]*H.units['length'],
+                         vel=w[3:]*H.units['length']/H.units['time'],
+                         t=t*H.units['time'], hamiltonian=H)
+
+        for k in ['dE_max', 'dt', 'nsteps']:
+            result[k] = attrs[k]
+        if 'rung' in result.dtype.names:
+            result['rung'] = attrs.get('rung', 0)
+
+        return orbit, result
+
+    def get_orbit(self, w0, H, n_periods=None, index=None):
+        """Get the orbit to analyze: integrate it, or read it from the orbit
+        store if an ``index`` is given. See `FreqMap.integrate` for the return
+        values.
+        """
+        if index is not None:
+            return self._read_orbit(index, H)
+        return self.integrate(w0, H, n_periods=n_periods)
+
+    # TODO: eek, this might be borked because I changed it from a classmethod...
+    def run(self, w0, H, n_periods=None, index=None):
+        orbit, result = self.get_orbit(w0, H, n_periods=n_periods, index=index)
+
+        if result['error_code'] > 0:
             return result
 
-        # start finding the frequencies -- do first half then second half
-        sf1 = SuperFreq(orbit.t[:nsteps//2+1].value, p=c.hamming_p)
-        sf2 = SuperFreq(orbit.t[nsteps//2:].value, p=c.hamming_p)
+        return self.analyze(orbit, result)
+
+    def analyze(self, orbit, result):
+        """Run the frequency analysis on an integrated orbit, and fill the
+        frequency results into the ``result`` array.
+        """
+        c = self.settings
+
+        # number of steps in the orbit (might be downsampled if read from an
+        # orbit store)
+        nsteps = len(orbit.t) - 1
+
+        windows = window_slices(nsteps, c.n_windows, c.window_overlap)
+
+        # all windows have the same number of (evenly spaced) times, so they
+        # can share the SuperFreq setup - the frequencies don't depend on the
+        # time of the start of the window
+        sf = SuperFreq(orbit.t[windows[0]].value, p=c.hamming_p)
 
         # classify orbit full orbit
-        circ = orbit.circulation()
+        ws = orbit.w()
+        circ = circulation(ws)
         is_tube = np.any(circ)
 
-        # define slices for first and second parts
-        sl1 = slice(None,nsteps//2+1)
-        sl2 = slice(nsteps//2,None)
+        # transform the full orbit once (with the circulation of tube orbits
+        # aligned with the z axis), and slice out the windows
+        fs = frequency_coordinates(ws, circ, force_cartesian=c.force_cartesian)
 
-        if is_tube and not c.force_cartesian:
-            # first need to flip coordinates so that circulation is around z axis
-            new_orbit = orbit.align_circulation_with_z(circ)
-            fs1 = orbit_to_poincare_polar(new_orbit[sl1])
-            fs2 = orbit_to_poincare_polar(new_orbit[sl2])
+        logger.debug("Running SuperFreq on the orbit in {0} windows"
+                     .format(len(windows)))
+        freqs = result['freqs'][0]
+        amps = result['amps'][0]
+        for k, sl in enumerate(windows):
+            try:
+                freqs[k],d,ixs = sf.find_fundamental_frequencies(
+                    [f[sl] for f in fs], nintvec=c.n_intvec)
+            except:
+                result['error_code'] = 5
+                return result
 
-        else:  # box
-            ws = orbit.w()
-            fs1 = [(ws[j,sl1] + 1j*ws[j+3,sl1]) for j in range(3)]
-            fs2 = [(ws[j,sl2] + 1j*ws[j+3,sl2]) for j in range(3)]
+            amps[k] = d['|A|'][ixs]
 
-        logger.debug("Running SuperFreq on the orbits")
-        try:
-            freqs1,d1,ixs1 = sf1.find_fundamental_frequencies(
-                fs1, nintvec=c.n_intvec)
-            freqs2,d2,ixs2 = sf2.find_fundamental_frequencies(
-                fs2, nintvec=c.n_intvec)
-        except:
-            result['error_code'] = 5
+        result['freqs'] = freqs
+        result['is_tube'] = float(is_tube)
+        result['amps'] = amps
+        result['success'] = True
+        result['error_code'] = 1
+        return result
+
+
+class OrbitIntegration(FreqMap):
+    """The integration stage of `FreqMap` on its own: integrates orbits with
+    the ``freqmap`` settings and writes them to an `OrbitStore`, so that the
+    frequency analysis can be re-run on the stored orbits (by passing the
+    ``orbit_store`` to `FreqMap`) without re-integrating.
+
+    The orbits can be downsampled and compressed before storing - see the
+    ``store_downsample`` and ``store_compression`` settings.
+    """
+
+    # dtype of things output by this experiment
+    @property
+    def cache_dtype(self):
+        return [
+            ('dE_max', 'f8'), # maximum energy difference (compared to initial) during orbit integration
+            ('success', 'b1'), # did we succeed in integrating the orbit
+            ('dt', 'f8'), # timestep used for integration
+            ('nsteps', 'i8') # number of steps integrated
+        ] + self._ladder_dtype
+
+    def __init__(self, cache_file, config_file=None, overwrite=False,
+                 prescreen=False, orbit_store=None, **kwargs):
+        # don't pass the store to FreqMap - we write to it, not read from it
+        super(OrbitIntegration, self).__init__(cache_file,
+                                               config_file=config_file,
+                                               overwrite=overwrite,
+                                               prescreen=prescreen, **kwargs)
+
+        if orbit_store is None:
+            orbit_store = OrbitStore.default_filename(self.cache_file,
+                                                      key=self.key)
+
+        with self._lock:
+            self.store = OrbitStore(orbit_store,
+                                    compression=self.settings.store_compression)
+
+            digest = self.store.config_digest
+            if digest is not None and digest != self._store_digest:
+                if not overwrite:
+                    raise IOError("The orbits in the orbit store at '{0}' "
+                                  "were integrated with different potential "
+                                  "or freqmap integration settings. Use "
+                                  "overwrite=True to replace them."
+                                  .format(orbit_store))
+                self.store.clear()
+            self.store.config_digest = self._store_digest
+
+    def _run_kwargs(self, index):
+        kw = super(OrbitIntegration, self)._run_kwargs(index)
+        kw.pop('index', None)
+        kw['tmpfile'] = self._orbit_tmpfile(index)
+        return kw
+
+    def _orbit_tmpfile(self, index):
+        return path.join(self._tmpdir, "{0}-{1}-orbit.npy"
+                                       .format(self.__class__.__name__, index))
+
+    def run(self, w0, H, n_periods=None, tmpfile=None):
+        orbit, result = self.integrate(w0, H, n_periods=n_periods)
+
+        if result['error_code'] > 0:
             return result
 
-        result['freqs'] = np.vstack((freqs1, freqs2))
-        result['dE_max'] = dEmax
-        result['is_tube'] = float(is_tube)
-        result['dt'] = float(dt)
-        result['nsteps'] = nsteps
-        result['amps'] = np.vstack((d1['|A|'][ixs1], d2['|A|'][ixs2]))
+        # the orbit is written to the store on the master process (in the
+        # callback), so write it to a temporary file for now
+        k = self.settings.store_downsample
+        t = orbit.t.decompose(H.units).value[::k]
+        w = orbit.w(H.units)[:, ::k]
+        np.save(tmpfile, np.vstack((t[None], w)))
+
         result['success'] = True
         result['error_code'] = 1
         return result
+
+    def callback(self, tmpfile):
+        if tmpfile is None: # orbit already done
+            return
+
+        with open(tmpfile, 'rb') as f:
+            index, result = pickle.load(f)
+
+        orbit_tmpfile = self._orbit_tmpfile(index)
+        if path.exists(orbit_tmpfile):
+            tw = np.load(orbit_tmpfile)
+            attrs = dict((k, result[k][0]) for k in ['dE_max', 'dt', 'nsteps'])
+            if 'rung' in result.dtype.names:
+                attrs['rung'] = result['rung'][0]
+
+            with self._lock:
+                self.store.write(index, tw[0], tw[1:], **attrs)
+            os.remove(orbit_tmpfile)
+
+        super(OrbitIntegration, self).callback(tmpfile)
@@ -0,0 +1,283 @@
+# coding: utf-8
+
+"""
+Cooperative processing of one cache file by several independent jobs.
+
+Jobs claim chunks of orbit indices by taking out leases in a ledger next to the
+cache file. A lease expires if it isn't renewed (e.g., because the job holding
+it was killed), after which another job can claim the chunk - orbits that were
+already completed are skipped as usual. The ledger and the cache file are only
+read and written while holding an exclusive lock on a lock file, so results
+from all jobs can be written to the same cache file.
+
+To process a cache file with several jobs, run each job with a ``shared``
+experiment and `process_leases`::
+
+    with FreqMap(cache_file, shared=True) as exp:
+        process_leases(exp, pool)
+        exp.status()
+
+"""
+
+# Standard library
+import fcntl
+import json
+from os import path
+import os
+import time
+
+# Project
+from ..log import logger
+
+__all__ = ['FileLock', 'LeaseLedger', 'process_leases']
+
+class FileLock(object):
+    """An exclusive, inter-process lock on a file (with ``flock``), used as a
+    context manager. The lock is reentrant within a process, so methods that
+    take the lock can call each other.
+
+    Parameters
+    ----------
+    filename : str, None
+        Path to the lock file. It is created if it doesn't exist. If None, the
+        lock does nothing.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = None
+        self._depth = 0
+
+    def __getstate__(self):
+        # the lock isn't held in other processes
+        state = self.__dict__.copy()
+        state['_fd'] = None
+        state['_depth'] = 0
+        return state
+
+    def __enter__(self):
+        if self.filename is None:
+            return self
+
+        if self._depth == 0:
+            self._fd = os.open(self.filename, os.O_RDWR | os.O_CREAT)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.filename is None:
+            return
+
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+class LeaseLedger(object):
+    """A ledger of leases on chunks of the orbit indices of an experiment.
+
+    The ledger is a JSON file next to the cache file, with the state of each
+    chunk that has been claimed: the job holding the lease and when the lease
+    expires, or that the chunk is done.
+
+    Parameters
+    ----------
+    experiment : `Experiment`
+        A ``shared`` experiment.
+    chunk_size : int, optional
+        Number of orbit indices in each chunk.
+    lease_time : float, optional
+        Time until a lease expires, unless renewed [s].
+    """
+
+    def __init__(self, experiment, chunk_size=64, lease_time=600.):
+        if not experiment.shared:
+            raise ValueError("Leases can only be used with shared experiments "
+                             "(see the 'shared' argument of Experiment).")
+
+        self.experiment = experiment
+        self.chunk_size = int(chunk_size)
+        self.lease_time = float(lease_time)
+        self.job_id = experiment.job_id
+
+        base = path.splitext(experiment.cache_file)[0]
+        self.filename = "{0}_{1}_leases.json".format(base, experiment.name)
+
+        indices = experiment.indices()
+        self._chunks = [indices[i:i+self.chunk_size]
+                        for i in range(0, len(indices), self.chunk_size)]
+
+    @property
+    def _lock(self):
+        return self.experiment._lock
+
+    def _read(self):
+        if not path.exists(self.filename):
+            return dict()
+
+        with open(self.filename, 'r') as f:
+            ledger = json.load(f)
+
+        if ledger['chunk_size'] != self.chunk_size:
+            raise ValueError("Ledger '{0}' uses a chunk size of {1}, not {2}."
+                             .format(self.filename, ledger['chunk_size'],
+                                     self.chunk_size))
+
+        return dict((int(k), v) for k, v in ledger['chunks'].items())
+
+    def _write(self, chunks):
+        # write to a temporary file and rename, so the ledger is never left
+        # half-written
+        tmp = "{0}.{1}".format(self.filename, self.job_id)
+        with open(tmp, 'w') as f:
+            json.dump(dict(chunk_size=self.chunk_size, chunks=chunks), f)
+        os.rename(tmp, self.filename)
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def indices(self, chunk):
+        """The orbit indices in a chunk."""
+        return self._chunks[chunk]
+
+    def claim(self):
+        """Claim the next chunk that is not done and not leased by another
+        job (or whose lease expired).
+
+        Returns
+        -------
+        chunk : int
+            The chunk number, or None if there are no chunks left to claim.
+        """
+        with self._lock:
+            chunks = self._read()
+            now = time.time()
+
+            for chunk in range(len(self._chunks)):
+                state = chunks.get(chunk)
+                if state is not None:
+                    if state['done'] or state['expires'] > now:
+                        continue
+
+                    logger.info("Lease on chunk {0} held by {1} expired"
+                                .format(chunk, state['owner']))
+
+                chunks[chunk] = dict(owner=self.job_id, done=False,
+                                     expires=now + self.lease_time)
+                self._write(chunks)
+                logger.debug("Claimed chunk {0}".format(chunk))
+                return chunk
+
+        return None
+
+    def _update(self, chunk, **kwargs):
+        with self._lock:
+            chunks = self._read()
+            state = chunks.get(chunk)
+            if state is None or state['owner'] != self.job_id:
+                logger.warning("Lease on chunk {0} was taken over by another "
+                               "job".format(chunk))
+                return False
+
+            state.update(kwargs)
+            self._write(chunks)
+            return True
+
+    def renew(self, chunk):
+        """Extend the lease on a chunk. Returns False if the lease has been
+        taken over by another job.
+        """
+        return self._update(chunk, expires=time.time() + self.lease_time)
+
+    def complete(self, chunk):
+        """Mark a chunk as done."""
+        return self._update(chunk, done=True)
+
+    def release(self, chunk):
+        """Give up the lease on a chunk, so other jobs can claim it."""
+        return self._update(chunk, expires=0.)
+
+    def status(self):
+        """The number of chunks that are done, leased, and not claimed."""
+        with self._lock:
+            chunks = self._read()
+
+        now = time.time()
+        n_done = sum(1 for s in chunks.values() if s['done'])
+        n_leased = sum(1 for s in chunks.values()
+                       if not s['done'] and s['expires'] > now)
+        return n_done, n_leased, len(self._chunks) - n_done - n_leased
+
+
+def process_leases(experiment, pool, chunk_size=64, lease_time=600.,
+                   batch_size=16):
+    """Process orbits of a ``shared`` experiment by claiming chunks of orbits
+    until there are none left, renewing the lease on each chunk as its orbits
+    complete. The orbits in a chunk are submitted to the pool in batches, and
+    if the lease on the chunk is taken over by another job, the rest of the
+    chunk is left to that job.
+
+    Parameters
+    ----------
+    experiment : `Experiment`
+    pool
+        A schwimmbad pool.
+    chunk_size : int, optional
+        Number of orbit indices in each chunk.
+    lease_time : float, optional
+        Time until a lease expires, unless renewed [s]. This should be much
+        longer than it takes to process a single orbit.
+    batch_size : int, optional
+        Number of orbits to submit to the pool at a time. The lease is checked
+        between batches, so this should be at least the number of workers.
+
+    Returns
+    -------
+    n_chunks : int
+        The number of chunks this job processed.
+    """
+    ledger = LeaseLedger(experiment, chunk_size=chunk_size,
+                         lease_time=lease_time)
+
+    n_chunks = 0
+    while True:
+        chunk = ledger.claim()
+        if chunk is None:
+            break
+
+        lease = dict(held=True)
+        def callback(tmpfile):
+            experiment.callback(tmpfile)
+            if not ledger.renew(chunk):
+                lease['held'] = False
+
+        indices = ledger.indices(chunk)
+        try:
+            for i in range(0, len(indices), batch_size):
+                for _ in pool.map(experiment, indices[i:i+batch_size],
+                                  callback=callback):
+                    pass
+
+                if not lease['held']:
+                    break
+
+        except:
+            ledger.release(chunk)
+            raise
+
+        if not lease['held']:
+            logger.info("Leaving the rest of chunk {0} to the job that took it "
+                        "over".format(chunk))
+            continue
+
+        ledger.complete(chunk)
+        n_chunks += 1
+
+    n_done, n_leased, _ = ledger.status()
+    logger.info("Job {0} processed {1} chunks - {2} of {3} done, {4} leased by "
+                "other jobs".format(ledger.job_id, n_chunks, n_done,
+                                    len(ledger), n_leased))
+    return n_chunks
@@ -0,0 +1,142 @@
+# coding: utf-8
+
+# Third-party
+import numpy as np
+import gala.dynamics as gd
+import gala.integrate as gi
+from gala.dynamics.util import estimate_dt_n_steps
+
+# Project
+from ..config import ConfigNamespace, ConfigItem
+from ..log import logger
+from .base import Experiment
+
+__all__ = ['LyapunovScreen', 'classifications']
+
+# orbit classifications from the chaos pre-screen
+classifications = {
+    0: "Not classified",
+    1: "Regular",
+    2: "Ambiguous",
+    3: "Chaotic"
+}
+
+class Config(ConfigNamespace):
+    name = "lyapunov"
+
+    n_periods = ConfigItem(
+        32, "Total number of orbital periods to integrate for")
+
+    n_steps_per_period = ConfigItem(
+        128, "Number of steps per integration period (determines step size)")
+
+    d0 = ConfigItem(
+        1E-5, "Initial separation of the offset orbits")
+
+    n_steps_per_pullback = ConfigItem(
+        10, "Number of steps between renormalizing the offset orbits")
+
+    noffset_orbits = ConfigItem(
+        2, "Number of offset orbits to integrate")
+
+    regular_slope = ConfigItem(
+        -0.8, "Orbits with a log-log slope of the finite-time Lyapunov "
+              "exponent below this are classified as regular")
+
+    chaotic_slope = ConfigItem(
+        -0.2, "Orbits with a log-log slope of the finite-time Lyapunov "
+              "exponent above this are classified as chaotic")
+
+
+class LyapunovScreen(Experiment):
+    """A cheap pre-screen for chaos that can be used to triage orbits before
+    running the (much more expensive) `FreqMap` experiment.
+
+    This integrates each orbit for a small number of orbital periods along with
+    a set of nearby offset orbits to estimate the finite-time Lyapunov exponent
+    (FTLE). For regular orbits, the FTLE decays as :math:`t^{-1}`, whereas for
+    chaotic orbits it converges to a constant, so each orbit is classified by
+    the slope of :math:`\\log\\lambda` vs. :math:`\\log t` over the second half
+    of the integration (see ``classifications`` for the possible values).
+    """
+
+    # dtype of things output by this experiment
+    cache_dtype = [
+        ('lyap_max', 'f8'), # finite-time Lyapunov exponent at the final time [1/Myr]
+        ('lyap_slope', 'f8'), # slope of log(FTLE) vs. log(t)
+        ('classification', 'i8'), # see `classifications`
+        ('success', 'b1'), # did we succeed in computing the FTLE
+        ('dt', 'f8'), # timestep used for integration
+        ('nsteps', 'i8') # number of steps integrated
+    ]
+
+    config = Config()
+
+    def run(self, w0, H):
+        c = self.settings
+
+        # return dict
+        result = self._empty_result
+
+        # fast_lyapunov_max only works with the C integrator
+        if not H.c_enabled:
+            result['error_code'] = 8
+            return result
+
+        # get timestep and nsteps for integration
+        try:
+            dt, nsteps = estimate_dt_n_steps(
+                w0, H, n_periods=c.n_periods,
+                n_steps_per_period=c.n_steps_per_period,
+                func=np.nanmin, Integrator=gi.DOPRI853Integrator)
+        except RuntimeError:
+            result['error_code'] = 2
+            return result
+        except:
+            result['error_code'] = 9
+            return result
+
+        logger.debug("Integrating orbit with dt={0}, nsteps={1}".format(dt, nsteps))
+        try:
+            lyap = gd.fast_lyapunov_max(
+                w0, H, dt=dt, n_steps=nsteps, d0=c.d0,
+                n_steps_per_pullback=c.n_steps_per_pullback,
+                noffset_orbits=c.noffset_orbits, return_orbit=False)
+        except RuntimeError: # ODE integration failed
+            logger.warning("Orbit integration failed.")
+            result['error_code'] = 3
+            return result
+
+        # FTLE as a function of time: take the max over the offset orbits
+        lyap = np.max(lyap.value, axis=1)
+        t = (np.arange(len(lyap)) + 1.) * c.n_steps_per_pullback * dt
+
+        # fit the slope of log(FTLE) vs. log(t) over the second half
+        sl = slice(len(lyap)//2, None)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope, _ = np.polyfit(np.log(t[sl]), np.log(lyap[sl]), deg=1)
+
+        if not np.isfinite(slope):
+            result['error_code'] = 9
+            return result
+
+        if slope < c.regular_slope:
+            classification = 1
+
+        elif slope > c.chaotic_slope:
+            classification = 3
+
+        else:
+            classification = 2
+
+        logger.debug("FTLE slope = {0:.2f}: {1}"
+                     .format(slope, classifications[classification]))
+
+        result['lyap_max'] = lyap[-1]
+        result['lyap_slope'] = slope
+        result['classification'] = classification
+        result['dt'] = float(dt)
+        result['nsteps'] = nsteps
+        result['success'] = True
+        result['error_code'] = 1
+        return result
@@ -0,0 +1,60 @@
+# coding: utf-8
+
+# Third-party
+import numpy as np
+
+# Project
+from .freqmap import FreqMap
+from .util import circulation
+
+__all__ = ['OrbitStats']
+
+class OrbitStats(FreqMap):
+    """Simple per-orbit diagnostics: energy conservation, circulation, and
+    the extent of the orbit.
+
+    Orbits are integrated (or read from an orbit store) with the ``freqmap``
+    settings, so this can run as a stage of a `Pipeline` along with `FreqMap`
+    on the same integrated orbits.
+    """
+
+    # dtype of things output by this experiment
+    @property
+    def cache_dtype(self):
+        return [
+            ('EJ', 'f8'), # initial Jacobi energy
+            ('dE_max', 'f8'), # maximum energy difference (compared to initial) during orbit integration
+            ('dE_std', 'f8'), # standard deviation of the fractional energy difference
+            ('circulation', 'b1', (3,)), # circulation about the x, y, and z axes
+            ('is_tube', 'b1'), # the orbit is a tube orbit
+            ('r_peri', 'f8'), # smallest sampled spherical radius
+            ('r_apo', 'f8'), # largest sampled spherical radius
+            ('xyz_max', 'f8', (3,)), # largest sampled |x|, |y|, |z|
+            ('success', 'b1'), # did we succeed in computing the diagnostics
+            ('dt', 'f8'), # timestep used for integration
+            ('nsteps', 'i8') # number of steps integrated
+        ] + self._ladder_dtype
+
+    def analyze(self, orbit, result):
+        """Compute the diagnostics for an integrated orbit, and fill them into
+        the ``result`` array.
+        """
+        E = orbit.energy().value
+        dE = (E - E[0]) / E[0]
+
+        w = orbit.w()
+        xyz = w[:3]
+        r = np.sqrt(np.sum(xyz**2, axis=0))
+
+        circ = circulation(w)
+
+        result['EJ'] = E[0]
+        result['dE_std'] = np.std(dE)
+        result['circulation'] = circ.astype(bool)
+        result['is_tube'] = np.any(circ)
+        result['r_peri'] = r.min()
+        result['r_apo'] = r.max()
+        result['xyz_max'] = np.max(np.abs(xyz), axis=1)
+        result['success'] = True
+        result['error_code'] = 1
+        return result
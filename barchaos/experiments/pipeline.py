@@ -0,0 +1,189 @@
+# coding: utf-8
+
+# Third-party
+import h5py
+
+# Project
+from ..log import logger
+from .base import _get_hamiltonian
+from .error import OrbitTimeout
+from .freqmap import FreqMap, OrbitIntegration
+from .util import call_with_time_limit
+
+__all__ = ['Pipeline']
+
+class Pipeline(object):
+    """Run several experiments as stages on a single integration of each
+    orbit.
+
+    The first stage integrates the orbit (or reads it from an orbit store),
+    and every stage then analyzes the same orbit. Each stage still writes to
+    its own dataset in the cache file, with its own error code, and an orbit
+    is only integrated if at least one of the stages still needs it. The
+    stages must be `FreqMap`-based experiments (i.e., they analyze orbits
+    integrated with the ``freqmap`` settings - see, e.g., `OrbitStats`).
+    Instances can be passed to ``pool.map()`` along with the ``callback``
+    method exactly like a single experiment::
+
+        with Pipeline(cache_file, [FreqMap, OrbitStats]) as pipeline:
+            pool.map(pipeline, pipeline.indices(), callback=pipeline.callback)
+            pipeline.status()
+
+    Parameters
+    ----------
+    cache_file : str
+        Path to the cache file.
+    stages : iterable
+        The `Experiment` subclasses to run.
+    config_file : str, optional
+        Path to a configuration file.
+    overwrite : bool, optional
+    **kwargs
+        Any other keyword arguments are passed to the experiments. If
+        ``profile`` is given, the work on each sampled orbit (for all stages)
+        is profiled in the profile directory of the first stage.
+    """
+
+    def __init__(self, cache_file, stages, config_file=None, overwrite=False,
+                 **kwargs):
+        stages = list(stages)
+        for cls in stages:
+            if not issubclass(cls, FreqMap) or issubclass(cls, OrbitIntegration):
+                raise ValueError("Pipeline stages must analyze FreqMap "
+                                 "orbits, so {0} can't be a stage."
+                                 .format(cls.__name__))
+
+        if len(set(stages)) != len(stages):
+            raise ValueError("Pipeline stages must be unique.")
+
+        # only the first stage profiles, since it runs the whole pipeline
+        profile = kwargs.pop('profile', None)
+        self.stages = [cls(cache_file, config_file=config_file,
+                           overwrite=overwrite,
+                           profile=profile if k == 0 else None, **kwargs)
+                       for k, cls in enumerate(stages)]
+
+        # the orbit indices to process with each stage
+        self._indices = [set(exp.indices()) for exp in self.stages]
+
+    def __enter__(self):
+        for exp in self.stages:
+            exp.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for exp in self.stages:
+            exp.__exit__(exc_type, exc_value, traceback)
+
+    def indices(self):
+        """The orbit indices to process with any of the stages."""
+        return sorted(set().union(*self._indices))
+
+    def timed_out(self):
+        """The indices of orbits that exceeded their time budget in any of the
+        stages.
+        """
+        idx = set()
+        for exp in self.stages:
+            idx.update(exp.timed_out())
+        return sorted(idx)
+
+    @property
+    def time_budget(self):
+        """ The wall-clock time budget per orbit, for all stages [s] """
+        return self.stages[0].time_budget
+
+    @time_budget.setter
+    def time_budget(self, value):
+        for exp in self.stages:
+            exp.time_budget = value
+
+    def __call__(self, index):
+        logger.info("Orbit {0}".format(index))
+
+        stages = self._stages_to_run(index)
+        if len(stages) == 0:
+            logger.debug("Orbit {0} already completed.".format(index))
+            return None
+
+        if not self.time_budget:
+            results = self._run(index, stages)
+
+        else:
+            # run in a child process that is killed if it runs out of time
+            try:
+                results = call_with_time_limit(self.time_budget, self._run,
+                                               index, stages)
+            except OrbitTimeout:
+                results = []
+                for k in stages:
+                    res = self.stages[k]._empty_result
+                    res['error_code'] = 6
+                    results.append((k, res))
+
+        return [(k, self.stages[k]._save_result(index, res))
+                for k, res in results]
+
+    def _stages_to_run(self, index):
+        """The stages that still need to process an orbit."""
+        stages = [k for k, idx in enumerate(self._indices) if index in idx]
+
+        # all stages write to the same cache file, so read their error codes
+        # for this orbit at once
+        first = self.stages[0]
+        with first._lock, h5py.File(first.cache_file, 'r') as f:
+            error_codes = [f[self.stages[k].name][index]['error_code']
+                           for k in stages]
+
+        return [k for k, error_code in zip(stages, error_codes)
+                if self.stages[k]._needs_run(index, error_code=error_code)]
+
+    def _run(self, index, stages):
+        """Run the stages on an orbit, profiling with the settings of the
+        first stage.
+        """
+        return self.stages[0]._profiled(index, self._run_stages, index,
+                                        stages)
+
+    def _run_stages(self, index, stages):
+        """Integrate an orbit once, and analyze it with the given stages."""
+        first = self.stages[0]
+        H = _get_hamiltonian(first.snapshot)
+
+        # integrate once, with the first stage
+        orbit, integration = first.get_orbit(w0=first.w0[index], H=H,
+                                             **first._run_kwargs(index))
+
+        results = []
+        for k in stages:
+            exp = self.stages[k]
+            res = exp._empty_result
+
+            # the integration results, e.g., dE_max
+            for name in integration.dtype.names:
+                if name in res.dtype.names and name != 'success':
+                    res[name] = integration[name]
+
+            if orbit is not None and res['error_code'] == 0:
+                res = exp.analyze(orbit, res)
+
+            results.append((k, res))
+
+        return results
+
+    def callback(self, tmpfiles):
+        """Write the results for an orbit from each stage to the cache file.
+        This should run on the master process.
+        """
+        if tmpfiles is None: # orbit already done
+            return
+
+        for k, tmpfile in tmpfiles:
+            self.stages[k].callback(tmpfile)
+
+    def status(self):
+        """
+        Prints out (to the logger) the status of each stage.
+        """
+        for exp in self.stages:
+            exp.status()
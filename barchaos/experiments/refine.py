@@ -0,0 +1,372 @@
+# coding: utf-8
+
+"""
+Adaptive refinement of grids of initial conditions.
+
+Most of a uniform grid of initial conditions lands in large regular regions of
+phase space, where the frequencies of neighbouring orbits are nearly identical.
+Instead, we start from a coarse grid and repeatedly subdivide only the cells
+where the frequency map has structure: where the frequencies change rapidly
+between neighbouring cells or the orbit family changes (resonance boundaries),
+or where the frequencies diffuse (chaotic layers).
+
+The grid is defined in some low-dimensional space of initial condition
+coordinates (e.g., :math:`(x, z)` at fixed Jacobi energy - see
+`xz_initial_conditions()`). Each orbit is the center of a rectangular cell, and
+refining a cell adds the :math:`2^{\\rm ndim}` cells of half the size that tile
+it. The grid metadata are stored in a ``grid`` group in the cache file, aligned
+row-by-row with the initial conditions ``w0``, and new initial conditions are
+appended to the end of ``w0``, so existing experiment results stay valid.
+"""
+
+# Third-party
+import astropy.units as u
+import gala.dynamics as gd
+import h5py
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Project
+from ..analysis import diffusion_rates
+from ..config import ConfigNamespace, ConfigItem, ConfigSnapshot
+from ..log import logger
+
+__all__ = ['AdaptiveGrid', 'xz_initial_conditions']
+
+class Config(ConfigNamespace):
+    name = "refine"
+
+    max_orbits = ConfigItem(
+        65536, "Total number of orbits (initial and refined) to stop at")
+
+    max_level = ConfigItem(
+        4, "Maximum number of times a grid cell can be subdivided")
+
+    log_dfreq_neighbour = ConfigItem(
+        -2., "Refine cells where the log10 fractional frequency difference "
+             "with a neighbouring cell is above this")
+
+    log_diffusion = ConfigItem(
+        -4., "Refine cells where the log10 frequency diffusion rate is above "
+             "this")
+
+def xz_initial_conditions(xz, EJ, H):
+    """Initial conditions on a grid in :math:`(x, z)` (with :math:`y=0`) with
+    a given Jacobi energy, launched with only a :math:`y` velocity (in the
+    rotating frame).
+
+    Parameters
+    ----------
+    xz : array_like
+        Grid coordinates with shape ``(norbits, 2)`` [kpc].
+    EJ : float
+        The Jacobi energy [kpc^2/Myr^2].
+    H : `~gala.potential.Hamiltonian`
+        The Hamiltonian, with a rotating frame about the z axis.
+
+    Returns
+    -------
+    w0 : `~gala.dynamics.PhaseSpacePosition`
+        The initial conditions. Grid points outside of the zero-velocity
+        surface have NaN velocities.
+    """
+    xz = np.atleast_2d(xz)
+
+    xyz = np.zeros((3, len(xz)))
+    xyz[0] = xz[:, 0]
+    xyz[2] = xz[:, 1]
+
+    # E_J = v^2/2 + Phi - Omega * (x v_y - y v_x)
+    Om = H.frame.parameters['Omega'][2].to(1/u.Myr).value
+    Phi = H.potential.energy(xyz).value
+    with np.errstate(invalid='ignore'):
+        vy = Om*xyz[0] + np.sqrt((Om*xyz[0])**2 - 2*(Phi - EJ))
+
+    vxyz = np.zeros_like(xyz)
+    vxyz[1] = vy
+
+    return gd.PhaseSpacePosition(pos=xyz*u.kpc, vel=vxyz*u.kpc/u.Myr)
+
+def _is_finite(w0):
+    return (np.all(np.isfinite(w0.xyz.value), axis=0) &
+            np.all(np.isfinite(w0.v_xyz.value), axis=0))
+
+def _neighbour_pairs(x, spacing, eps=1E-8):
+    """Find all pairs of touching cells.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Cell centers, shape ``(ncells, ndim)``.
+    spacing : numpy.ndarray
+        Cell sizes (the same along every dimension), shape ``(ncells,)``.
+
+    Returns
+    -------
+    i, j : numpy.ndarray
+        Indices of the cells in each pair, where cell ``j`` is the same size
+        as or smaller than cell ``i``.
+    """
+    tree = cKDTree(x)
+
+    ii = []
+    jj = []
+    for s in np.unique(spacing):
+        idx, = np.where(spacing == s)
+
+        # candidate neighbours of cells of this size that are the same size or
+        # smaller, then keep only the cells that touch
+        pairs = cKDTree(x[idx]).sparse_distance_matrix(
+            tree, max_distance=s*(1+eps), p=np.inf, output_type='ndarray')
+        i = idx[pairs['i']]
+        j = pairs['j']
+        keep = ((i != j) & (spacing[j] <= s) &
+                (pairs['v'] <= 0.5*(s + spacing[j])*(1+eps)))
+
+        # don't double count pairs of cells of the same size
+        keep &= (spacing[j] < s) | (i < j)
+
+        ii.append(i[keep])
+        jj.append(j[keep])
+
+    return np.concatenate(ii), np.concatenate(jj)
+
+class AdaptiveGrid(object):
+    """An adaptively refined grid of initial conditions in a cache file.
+
+    Use `AdaptiveGrid.create` to write the initial (coarse) grid to a new cache
+    file, run an experiment that measures frequencies (e.g., `FreqMap`), then
+    call `AdaptiveGrid.refine` to append refined initial conditions to the
+    cache file, and repeat until ``refine()`` returns 0.
+
+    Parameters
+    ----------
+    cache_file : str
+        Path to the cache file.
+    config_file : str, optional
+        Path to a configuration file.
+    source : str, optional
+        Name of the experiment dataset with the frequencies to refine on.
+    """
+
+    def __init__(self, cache_file, config_file=None, source='freqmap'):
+        self.cache_file = cache_file
+        self.source = source
+        self.snapshot = ConfigSnapshot.load(config_file, [Config()])
+
+        with h5py.File(self.cache_file, 'r') as f:
+            if 'grid' not in f:
+                raise IOError("Cache file at '{0}' has no 'grid' group - you "
+                              "must first create it with AdaptiveGrid.create()."
+                              .format(self.cache_file))
+            self.attrs = dict(f['grid'].attrs)
+        self.spacing0 = self.attrs['spacing0']
+
+    @property
+    def settings(self):
+        """ The (frozen) refinement settings """
+        return self.snapshot[Config.name]
+
+    @classmethod
+    def create(cls, cache_file, coords, spacing, w0, **attrs):
+        """Write an initial, uniform grid of initial conditions to a new cache
+        file.
+
+        Parameters
+        ----------
+        cache_file : str
+            Path to the cache file.
+        coords : array_like
+            Grid coordinates of the cell centers, shape ``(norbits, ndim)``.
+        spacing : array_like
+            The grid spacing along each dimension, shape ``(ndim,)``.
+        w0 : `~gala.dynamics.PhaseSpacePosition`
+            The initial conditions for each cell. Cells with non-finite
+            initial conditions are dropped.
+        **attrs
+            Any other metadata to store with the grid, e.g., the Jacobi energy.
+        """
+        coords = np.atleast_2d(coords)
+
+        ok = _is_finite(w0)
+        coords = coords[ok]
+        w0 = w0[ok]
+        n = len(coords)
+
+        with h5py.File(cache_file, 'w') as f:
+            # the initial conditions and grid metadata are resizable so we can
+            # append refined cells
+            g = f.create_group('w0')
+            for name, q in [('pos', w0.xyz), ('vel', w0.v_xyz)]:
+                d = g.create_dataset(name, data=q.value, maxshape=(3, None))
+                d.attrs['unit'] = str(q.unit)
+
+            g = f.create_group('grid')
+            g.create_dataset('coords', data=coords,
+                             maxshape=(None, coords.shape[1]))
+            g.create_dataset('level', data=np.zeros(n, dtype=int),
+                             maxshape=(None,))
+            g.create_dataset('parent', data=np.full(n, -1, dtype=int),
+                             maxshape=(None,))
+            g.create_dataset('refined', data=np.zeros(n, dtype=bool),
+                             maxshape=(None,))
+            g.attrs['spacing0'] = np.array(spacing, dtype=float)
+            for k, v in attrs.items():
+                g.attrs[k] = v
+
+        logger.info("Created grid with {0} initial conditions".format(n))
+
+        return cls(cache_file)
+
+    def indicators(self):
+        """Compute the refinement indicators for all unrefined cells that have
+        been successfully processed by the source experiment.
+
+        Returns
+        -------
+        log_dfreq_neighbour : numpy.ndarray
+            The log10 of the largest fractional frequency difference with any
+            neighbouring cell. This is infinite if a neighbour is in a
+            different orbit family, and NaN for cells that are excluded.
+        log_diffusion : numpy.ndarray
+            The log10 frequency diffusion rate, NaN for cells that are
+            excluded.
+        """
+        with h5py.File(self.cache_file, 'r') as f:
+            g = f['grid']
+            coords = g['coords'][:]
+            level = g['level'][:]
+            refined = g['refined'][:]
+
+            n = len(coords)
+            shape = (2, 3)
+            if self.source in f:
+                shape = f[self.source].dtype['freqs'].shape
+            freqs = np.full((n,) + shape, np.nan)
+            is_tube = np.zeros(n, dtype=bool)
+            error_code = np.zeros(n, dtype=int)
+
+            # the experiment might not have been run on the newest cells yet
+            if self.source in f:
+                d = f[self.source]
+                m = min(n, d.shape[0])
+                freqs[:m] = d[:m, 'freqs']
+                is_tube[:m] = d[:m, 'is_tube']
+                error_code[:m] = d[:m, 'error_code']
+
+        # neighbours are only defined between the leaves of the grid
+        use = (error_code == 1) & ~refined
+        idx, = np.where(use)
+
+        log_dfreq_neighbour = np.full(n, np.nan)
+        log_diffusion = np.full(n, np.nan)
+        if len(idx) == 0:
+            return log_dfreq_neighbour, log_diffusion
+
+        _, log_diffusion[idx] = diffusion_rates(freqs[idx])
+
+        x = coords[idx] / self.spacing0[None]
+        i, j = _neighbour_pairs(x, 2.**-level[idx])
+        i = idx[i]
+        j = idx[j]
+
+        f1 = np.abs(freqs[i, 0])
+        f2 = np.abs(freqs[j, 0])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dfreq = np.nanmax(np.abs(f2 - f1) / np.minimum(f1, f2), axis=1)
+            dfreq = np.log10(dfreq)
+        dfreq[is_tube[i] != is_tube[j]] = np.inf
+
+        log_dfreq_neighbour[idx] = -np.inf
+        np.maximum.at(log_dfreq_neighbour, i, dfreq)
+        np.maximum.at(log_dfreq_neighbour, j, dfreq)
+
+        return log_dfreq_neighbour, log_diffusion
+
+    def refine(self, ic_func):
+        """Subdivide the cells with the largest refinement indicators and
+        append the initial conditions for the new cells to the cache file.
+
+        Parameters
+        ----------
+        ic_func : callable
+            Takes an array of grid coordinates with shape ``(norbits, ndim)``
+            and returns a `~gala.dynamics.PhaseSpacePosition` with the initial
+            conditions. New cells with non-finite initial conditions (e.g.,
+            outside of the zero-velocity surface) are dropped.
+
+        Returns
+        -------
+        n_new : int
+            The number of initial conditions added - 0 if the grid is fully
+            refined or the orbit budget is used up.
+        """
+        c = self.settings
+
+        with h5py.File(self.cache_file, 'r') as f:
+            g = f['grid']
+            coords = g['coords'][:]
+            level = g['level'][:]
+
+        n, ndim = coords.shape
+        n_children = 2**ndim
+        n_cells = (c.max_orbits - n) // n_children
+        if n_cells <= 0:
+            logger.info("Orbit budget used up ({0} orbits)".format(n))
+            return 0
+
+        # how far above the thresholds each cell is
+        log_dfreq_neighbour, log_diffusion = self.indicators()
+        with np.errstate(invalid='ignore'):
+            priority = np.fmax(log_dfreq_neighbour - c.log_dfreq_neighbour,
+                               log_diffusion - c.log_diffusion)
+            priority[level >= c.max_level] = np.nan
+            idx, = np.where(priority > 0)
+
+        if len(idx) == 0:
+            logger.info("No cells left to refine")
+            return 0
+
+        # refine the highest priority cells that fit in the budget
+        idx = idx[np.argsort(priority[idx])[::-1][:n_cells]]
+        logger.info("Refining {0} cells".format(len(idx)))
+
+        # each child is offset by a quarter of the parent cell size along each
+        # dimension
+        offsets = np.stack(np.meshgrid(*[[-0.25, 0.25]]*ndim, indexing='ij'))
+        offsets = offsets.reshape(ndim, -1).T
+        spacing = self.spacing0[None] * 2.**-level[idx, None]
+        child_coords = (coords[idx, None] +
+                        offsets[None] * spacing[:, None]).reshape(-1, ndim)
+        child_parent = np.repeat(idx, n_children)
+
+        w0 = ic_func(child_coords)
+        ok = _is_finite(w0)
+        w0 = w0[ok]
+        child_coords = child_coords[ok]
+        child_parent = child_parent[ok]
+        n_new = len(child_coords)
+
+        with h5py.File(self.cache_file, 'a') as f:
+            g = f['w0']
+            for name, q in [('pos', w0.xyz), ('vel', w0.v_xyz)]:
+                d = g[name]
+                d.resize(n + n_new, axis=1)
+                d[:, n:] = q.to(u.Unit(d.attrs['unit'])).value
+
+            g = f['grid']
+            for name, data in [('coords', child_coords),
+                               ('level', level[child_parent] + 1),
+                               ('parent', child_parent),
+                               ('refined', np.zeros(n_new, dtype=bool))]:
+                g[name].resize(n + n_new, axis=0)
+                g[name][n:] = data
+
+            refined = g['refined'][:]
+            refined[idx] = True
+            g['refined'][:] = refined
+
+        logger.info("Added {0} initial conditions ({1} total)"
+                    .format(n_new, n + n_new))
+
+        return n_new
@@ -0,0 +1,297 @@
+# coding: utf-8
+
+"""
+Poincaré surfaces of section.
+
+Orbits are integrated in short segments, and crossings of the section plane
+are detected within each segment and refined to the exact crossing by cubic
+Hermite interpolation (using the time derivatives from Hamilton's equations
+at the bracketing steps). Only the crossings are kept, in a fixed-size buffer
+per orbit, so the memory used doesn't depend on the number of steps.
+"""
+
+# Third-party
+import astropy.units as u
+import numpy as np
+import gala.dynamics as gd
+import gala.integrate as gi
+from gala.dynamics.util import estimate_dt_n_steps
+
+# Project
+from ..config import ConfigNamespace, ConfigItem
+from ..log import logger
+from .base import Experiment
+
+__all__ = ['SurfaceOfSection', 'section_initial_conditions', 'find_crossings']
+
+_axes = {'x': 0, 'y': 1, 'z': 2}
+
+class Config(ConfigNamespace):
+    name = "sos"
+
+    n_periods = ConfigItem(
+        256, "Total number of orbital periods to integrate for")
+
+    n_steps_per_period = ConfigItem(
+        128, "Number of steps per integration period (determines step size)")
+
+    n_steps_per_segment = ConfigItem(
+        4096, "Number of steps to integrate at a time while looking for "
+              "crossings")
+
+    max_crossings = ConfigItem(
+        512, "Maximum number of crossings to record per orbit")
+
+    section_axis = ConfigItem(
+        "y", "The section is the plane where this coordinate is zero")
+
+    direction = ConfigItem(
+        1, "Only record crossings where the section coordinate is "
+           "increasing (1), decreasing (-1), or both (0)")
+
+    atol = ConfigItem(
+        1E-11, "Absolute tolerance for the integrator")
+
+    energy_tolerance = ConfigItem(
+        1E-8, "Maximum allowed fractional energy difference")
+
+
+def section_initial_conditions(x, vx, EJ, H):
+    """Initial conditions on the :math:`y=0` plane (with :math:`z=v_z=0`) at
+    a given Jacobi energy, for a batch of orbits on the same surface of
+    section. The :math:`y` velocity (in the rotating frame) is positive.
+
+    Parameters
+    ----------
+    x : array_like
+        Positions along the x axis [kpc].
+    vx : array_like
+        Velocities along the x axis [kpc/Myr].
+    EJ : float
+        The Jacobi energy [kpc^2/Myr^2].
+    H : `~gala.potential.Hamiltonian`
+        The Hamiltonian, with a rotating frame about the z axis.
+
+    Returns
+    -------
+    w0 : `~gala.dynamics.PhaseSpacePosition`
+        The initial conditions. Points outside of the zero-velocity curve
+        have NaN velocities.
+    """
+    x, vx = np.broadcast_arrays(np.atleast_1d(x), np.atleast_1d(vx))
+
+    xyz = np.zeros((3, len(x)))
+    xyz[0] = x
+
+    # E_J = v^2/2 + Phi - Omega * (x v_y - y v_x), and the velocity in the
+    # rotating frame is v_y - Omega x
+    Om = H.frame.parameters['Omega'][2].to(1/u.Myr).value
+    Phi = H.potential.energy(xyz).value
+    with np.errstate(invalid='ignore'):
+        vy = Om*x + np.sqrt((Om*x)**2 - 2*(Phi - EJ) - vx**2)
+
+    vxyz = np.zeros_like(xyz)
+    vxyz[0] = vx
+    vxyz[1] = vy
+
+    return gd.PhaseSpacePosition(pos=xyz*u.kpc, vel=vxyz*u.kpc/u.Myr)
+
+def _time_derivatives(w, H, Om):
+    """Time derivatives of the phase-space coordinates in the rotating frame,
+    for an array of points with shape ``(6, n)``.
+    """
+    x = w[:3]
+    p = w[3:]
+
+    Om_x = np.stack((-Om*x[1], Om*x[0], np.zeros_like(x[0])))
+    Om_p = np.stack((-Om*p[1], Om*p[0], np.zeros_like(p[0])))
+
+    grad = H.potential.gradient(x).decompose(H.units).value
+
+    return np.vstack((p - Om_x, -grad - Om_p))
+
+def _hermite(s, f0, f1, df0, df1, h):
+    s2 = s*s
+    s3 = s2*s
+    return ((2*s3 - 3*s2 + 1)*f0 + (s3 - 2*s2 + s)*h*df0 +
+            (-2*s3 + 3*s2)*f1 + (s3 - s2)*h*df1)
+
+def _dhermite(s, f0, f1, df0, df1, h):
+    s2 = s*s
+    return ((6*s2 - 6*s)*f0 + (3*s2 - 4*s + 1)*h*df0 +
+            (-6*s2 + 6*s)*f1 + (3*s2 - 2*s)*h*df1)
+
+def find_crossings(t, w, H, axis=1, direction=1, n_iter=8):
+    """Find the crossings of a plane by an orbit, interpolated to the
+    crossing time.
+
+    Parameters
+    ----------
+    t : numpy.ndarray
+        Times, shape ``(ntimes,)``.
+    w : numpy.ndarray
+        Phase-space positions, shape ``(6, ntimes)``, in the unit system of
+        the Hamiltonian.
+    H : `~gala.potential.Hamiltonian`
+    axis : int, optional
+        The section is the plane where this coordinate is zero.
+    direction : int, optional
+        Only find crossings where the coordinate is increasing (1),
+        decreasing (-1), or both (0).
+    n_iter : int, optional
+        Number of Newton iterations to find the root of the interpolant.
+
+    Returns
+    -------
+    t_cross : numpy.ndarray
+        Crossing times, shape ``(ncrossings,)``.
+    w_cross : numpy.ndarray
+        Phase-space positions at the crossings, shape ``(6, ncrossings)``.
+    """
+    q = w[axis]
+    up = (q[:-1] < 0) & (q[1:] >= 0)
+    down = (q[:-1] > 0) & (q[1:] <= 0)
+
+    if direction > 0:
+        cross = up
+    elif direction < 0:
+        cross = down
+    else:
+        cross = up | down
+    i, = np.where(cross)
+
+    if len(i) == 0:
+        return np.zeros(0), np.zeros((6, 0))
+
+    Om = H.frame.parameters['Omega'].decompose(H.units).value[2]
+    w0 = w[:, i]
+    w1 = w[:, i+1]
+    dw0 = _time_derivatives(w0, H, Om)
+    dw1 = _time_derivatives(w1, H, Om)
+    h = t[i+1] - t[i]
+
+    # solve for the root of the interpolated section coordinate, starting
+    # from linear interpolation
+    args = (w0[axis], w1[axis], dw0[axis], dw1[axis], h)
+    s = w0[axis] / (w0[axis] - w1[axis])
+    for _ in range(n_iter):
+        ds = _hermite(s, *args) / _dhermite(s, *args)
+        s = np.clip(s - ds, 0., 1.)
+
+    t_cross = t[i] + s*h
+    w_cross = _hermite(s[None], w0, w1, dw0, dw1, h[None])
+    w_cross[axis] = 0.
+
+    return t_cross, w_cross
+
+
+class SurfaceOfSection(Experiment):
+    """Record the crossings of orbits through a surface of section (see the
+    ``sos`` config namespace for the section and integration settings).
+
+    Orbits are integrated in segments, and only the crossings are kept (up
+    to ``max_crossings`` per orbit), so memory use is proportional to the
+    number of crossings rather than the number of steps. Use
+    `section_initial_conditions` to generate a batch of initial conditions
+    on the same surface of section (i.e. sharing a Jacobi energy).
+    """
+
+    config = Config()
+
+    @property
+    def cache_dtype(self):
+        # the size of the crossings buffer is set by the configuration
+        n = self.settings.max_crossings
+        return [
+            ('t_cross', 'f8', (n,)), # time of each crossing (NaN padded)
+            ('w_cross', 'f8', (n,6)), # phase-space position at each crossing
+            ('n_crossings', 'i8'), # number of recorded crossings
+            ('EJ', 'f8'), # Jacobi energy of the orbit
+            ('dE_max', 'f8'), # maximum energy difference (compared to initial) during orbit integration
+            ('success', 'b1'), # did we succeed in integrating the orbit
+            ('dt', 'f8'), # timestep used for integration
+            ('nsteps', 'i8') # number of steps integrated
+        ]
+
+    def run(self, w0, H):
+        c = self.settings
+        units = H.units
+
+        # return dict
+        result = self._empty_result
+
+        axis = _axes[c.section_axis]
+
+        # get timestep and nsteps for integration
+        try:
+            dt, nsteps = estimate_dt_n_steps(
+                w0, H, n_periods=c.n_periods,
+                n_steps_per_period=c.n_steps_per_period,
+                func=np.nanmin, Integrator=gi.DOPRI853Integrator)
+        except RuntimeError:
+            result['error_code'] = 2
+            return result
+        except:
+            result['error_code'] = 9
+            return result
+
+        logger.debug("Integrating orbit with dt={0}, nsteps={1}".format(dt, nsteps))
+
+        E0 = float(np.squeeze(H.energy(w0).value))
+        dE_max = 0.
+        t_cross = result['t_cross'][0]
+        w_cross = result['w_cross'][0]
+        n_cross = 0
+
+        t1 = 0.
+        w = w0
+        for i in range(0, nsteps, c.n_steps_per_segment):
+            try:
+                orbit = H.integrate_orbit(
+                    w, dt=dt, n_steps=min(c.n_steps_per_segment, nsteps-i),
+                    t1=t1, Integrator=gi.DOPRI853Integrator,
+                    Integrator_kwargs=dict(atol=c.atol))
+            except RuntimeError: # ODE integration failed
+                logger.warning("Orbit integration failed.")
+                result['error_code'] = 3
+                return result
+
+            E = orbit.energy().value
+            dE_max = max(dE_max, np.max(np.abs((E - E0) / E0)))
+
+            t = orbit.t.decompose(units).value
+            ws = orbit.w(units)
+            tc, wc = find_crossings(t, ws, H, axis=axis,
+                                    direction=c.direction)
+
+            n = min(len(tc), c.max_crossings - n_cross)
+            t_cross[n_cross:n_cross+n] = tc[:n]
+            w_cross[n_cross:n_cross+n] = wc[:, :n].T
+            n_cross += n
+
+            if n_cross >= c.max_crossings:
+                logger.debug("Crossings buffer full")
+                break
+
+            # start the next segment from the end of this one
+            t1 = t[-1]
+            w = gd.PhaseSpacePosition(pos=ws[:3, -1]*units['length'],
+                                      vel=ws[3:, -1]*units['length']/units['time'])
+
+        logger.debug("Found {0} crossings".format(n_cross))
+
+        result['t_cross'] = t_cross
+        result['w_cross'] = w_cross
+        result['n_crossings'] = n_cross
+        result['EJ'] = E0
+        result['dE_max'] = dE_max
+        result['dt'] = float(dt)
+        result['nsteps'] = nsteps
+
+        if dE_max > c.energy_tolerance:
+            result['error_code'] = 4
+            return result
+
+        result['success'] = True
+        result['error_code'] = 1
+        return result
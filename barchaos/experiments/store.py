@@ -0,0 +1,137 @@
+# coding: utf-8
+
+"""
+Persistent storage of integrated orbits, so that the frequency analysis can be
+re-run with different settings without re-integrating.
+
+Orbits are stored without units (in the unit system of the potential) in an
+HDF5 file, with one dataset per orbit (the number of timesteps differs between
+orbits) named by the orbit index. With compression, each orbit is stored as a
+single chunk, so reading an orbit decompresses only that orbit. The store also
+records a digest of the settings the orbits were integrated with, so they
+aren't analyzed as if they were integrated with other settings.
+"""
+
+# Standard library
+from os import path
+
+# Third-party
+import h5py
+import numpy as np
+
+__all__ = ['OrbitStore']
+
+class OrbitStore(object):
+    """An HDF5 file of integrated orbits.
+
+    Only one process should write to the store at a time (for experiments,
+    the master process, in the ``callback``).
+
+    Parameters
+    ----------
+    filename : str
+        Path to the store file. It is created if it doesn't exist.
+    compression : str, optional
+        HDF5 compression filter to use for new orbits (e.g., 'gzip' or
+        'lzf'), or None to store orbits uncompressed.
+    """
+
+    def __init__(self, filename, compression=None):
+        self.filename = path.abspath(filename)
+        self.compression = compression or None
+
+        if not path.exists(self.filename):
+            with h5py.File(self.filename, 'w') as f:
+                f.create_group('orbits')
+
+    @staticmethod
+    def default_filename(cache_file, key=None):
+        """The default store path for a given cache file (and configuration
+        digest, for keyed experiments).
+        """
+        base = path.splitext(cache_file)[0]
+        if key is not None:
+            base = "{0}_{1}".format(base, key)
+        return "{0}_orbits.hdf5".format(base)
+
+    @property
+    def config_digest(self):
+        """The digest of the settings the orbits were integrated with, or None
+        if it wasn't recorded.
+        """
+        with h5py.File(self.filename, 'r') as f:
+            return f.attrs.get('config_digest', None)
+
+    @config_digest.setter
+    def config_digest(self, value):
+        with h5py.File(self.filename, 'a') as f:
+            f.attrs['config_digest'] = value
+
+    def clear(self):
+        """Remove all orbits from the store."""
+        with h5py.File(self.filename, 'a') as f:
+            del f['orbits']
+            f.create_group('orbits')
+
+    def __contains__(self, index):
+        with h5py.File(self.filename, 'r') as f:
+            return str(index) in f['orbits']
+
+    def write(self, index, t, w, **attrs):
+        """Write (or overwrite) a single orbit.
+
+        Parameters
+        ----------
+        index : int
+            The orbit index.
+        t : array_like
+            Times of each step, shape ``(ntimes,)``. These must be evenly
+            spaced.
+        w : array_like
+            The phase-space positions, shape ``(6, ntimes)``.
+        **attrs
+            Any other metadata to store with the orbit, e.g., the timestep.
+        """
+        t = np.asarray(t)
+        w = np.asarray(w)
+        name = str(index)
+
+        kw = dict()
+        if self.compression is not None:
+            # a single chunk per orbit
+            kw['compression'] = self.compression
+            kw['chunks'] = w.shape
+
+        with h5py.File(self.filename, 'a') as f:
+            g = f['orbits']
+            if name in g:
+                del g[name]
+
+            d = g.create_dataset(name, data=w, **kw)
+            # only store the first time and time spacing: the times can be
+            # too large to store as an attribute
+            d.attrs['t0'] = t[0]
+            d.attrs['dt_sample'] = t[1] - t[0] if len(t) > 1 else 0.
+            for k, v in attrs.items():
+                d.attrs[k] = v
+
+    def read(self, index):
+        """Read a single orbit.
+
+        Returns
+        -------
+        t : numpy.ndarray
+            Times of each step, shape ``(ntimes,)``.
+        w : numpy.ndarray
+            The phase-space positions, shape ``(6, ntimes)``.
+        attrs : dict
+            Any other metadata stored with the orbit.
+        """
+        with h5py.File(self.filename, 'r') as f:
+            d = f['orbits'][str(index)]
+            attrs = dict(d.attrs)
+            t0 = attrs.pop('t0')
+            t = t0 + attrs.pop('dt_sample') * np.arange(d.shape[1])
+            w = d[:]
+
+        return t, w, attrs
@@ -0,0 +1,109 @@
+# coding: utf-8
+
+# Project
+from ..log import logger
+
+__all__ = ['Sweep']
+
+class Sweep(object):
+    """Run an experiment for several configurations on the same initial
+    conditions, over one pool of workers.
+
+    Each configuration's results are stored in a separate dataset in the cache
+    file, named by the experiment name and the digest of the configuration
+    (see the ``keyed`` argument of `Experiment`), and the digest and settings
+    are stored as attributes of the dataset. Tasks are ``(k, index)`` pairs of
+    a configuration and an orbit index, so instances can be passed to
+    ``pool.map()`` along with the ``callback`` method exactly like a single
+    experiment::
+
+        with Sweep(FreqMap, cache_file, config_files) as sweep:
+            pool.map(sweep, sweep.tasks(), callback=sweep.callback)
+            sweep.status()
+
+    Workers keep the Hamiltonian for each configuration they have seen, so
+    the potential is only set up once per configuration per worker.
+
+    Parameters
+    ----------
+    cls : class
+        The `Experiment` subclass to run.
+    cache_file : str
+        Path to the cache file.
+    config_files : iterable
+        Paths to the configuration files to sweep over.
+    overwrite : bool, optional
+    **kwargs
+        Any other keyword arguments are passed to the experiment.
+    """
+
+    def __init__(self, cls, cache_file, config_files, overwrite=False,
+                 **kwargs):
+        self.config_files = list(config_files)
+        self.experiments = [cls(cache_file, config_file=config_file,
+                                overwrite=overwrite, keyed=True, **kwargs)
+                            for config_file in self.config_files]
+
+        # configurations that are identical would write to the same dataset
+        names = [exp.name for exp in self.experiments]
+        if len(set(names)) != len(names):
+            raise ValueError("Some of the configuration files have identical "
+                             "settings.")
+
+        for config_file, exp in zip(self.config_files, self.experiments):
+            logger.info("Config '{0}': results in '{1}'"
+                        .format(config_file, exp.name))
+
+    def __enter__(self):
+        for exp in self.experiments:
+            exp.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for exp in self.experiments:
+            exp.__exit__(exc_type, exc_value, traceback)
+
+    def tasks(self):
+        """Return a list of ``(k, index)`` tasks to process, where ``k`` is
+        the index of the configuration file.
+        """
+        # ordered by configuration, so chunks of tasks sent to a worker
+        # mostly share the same Hamiltonian
+        return [(k, index) for k, exp in enumerate(self.experiments)
+                for index in exp.indices()]
+
+    def timed_out(self):
+        """Return a list of ``(k, index)`` tasks that exceeded their time
+        budget.
+        """
+        return [(k, index) for k, exp in enumerate(self.experiments)
+                for index in exp.timed_out()]
+
+    @property
+    def time_budget(self):
+        """ The wall-clock time budget per orbit [s] """
+        return self.experiments[0].time_budget
+
+    @time_budget.setter
+    def time_budget(self, value):
+        for exp in self.experiments:
+            exp.time_budget = value
+
+    def __call__(self, task):
+        k, index = task
+        return k, self.experiments[k](index)
+
+    def callback(self, res):
+        """Write the results for a task to the cache file. This should run on
+        the master process.
+        """
+        k, tmpfile = res
+        self.experiments[k].callback(tmpfile)
+
+    def status(self):
+        """
+        Prints out (to the logger) the status of each configuration.
+        """
+        for config_file, exp in zip(self.config_files, self.experiments):
+            logger.info("Config: {0}".format(config_file))
+            exp.status()
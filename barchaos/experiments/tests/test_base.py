@@ -0,0 +1,123 @@
+# Standard library
+from os import path
+import os
+import time
+
+# Third-party
+import astropy.units as u
+import pytest
+import gala.dynamics as gd
+import gala.potential as gp
+from gala.units import galactic
+import numpy as np
+import h5py
+
+# Package
+from ..base import Experiment, _hamiltonians
+from ...config import ConfigNamespace, ConfigItem
+from ...log import logger
+
+logger.setLevel(1)
+
+class Config(ConfigNamespace):
+    name = "sleepy"
+
+    sleep = ConfigItem(0.1, "Time to sleep for each stage [s]")
+
+class Sleepy(Experiment):
+    cache_dtype = [
+        ('success', 'b1')
+    ]
+
+    config = Config()
+
+    def run(self, w0, H):
+        result = self._empty_result
+        for i in range(3):
+            time.sleep(self.settings.sleep)
+
+        result['success'] = True
+        result['error_code'] = 1
+        return result
+
+@pytest.fixture
+def cache_file(tmpdir):
+    fn = tmpdir.join('cache.hdf5')
+
+    w0 = gd.PhaseSpacePosition(pos=np.random.random((3,4))*u.kpc,
+                               vel=np.random.random((3,4))*u.m/u.s)
+    with h5py.File(fn, 'w') as f:
+        g = f.create_group('w0')
+        w0.to_hdf5(g)
+
+    return str(fn)
+
+def test_time_budget(cache_file):
+    exp = Sleepy(cache_file, time_budget=0.15)
+
+    # no need for the bar potential here
+    key = exp.snapshot['potential'].digest()
+    _hamiltonians[key] = gp.Hamiltonian(
+        gp.KeplerPotential(m=1E10, units=galactic))
+
+    with exp:
+        exp.callback(exp(0))
+        assert exp.timed_out() == [0]
+
+        # timed out orbits are retried even if not overwriting
+        exp.time_budget = 10.
+        exp.callback(exp(0))
+        assert exp.timed_out() == []
+
+        # no budget
+        exp.time_budget = None
+        exp.callback(exp(1))
+
+    with h5py.File(cache_file, 'r') as f:
+        assert np.all(f['sleepy']['error_code'][:2] == 1)
+
+    del _hamiltonians[key]
+
+def test_profile(cache_file):
+    exp = Sleepy(cache_file, profile=2)
+
+    key = exp.snapshot['potential'].digest()
+    _hamiltonians[key] = gp.Hamiltonian(
+        gp.KeplerPotential(m=1E10, units=galactic))
+
+    with exp:
+        for index in exp.indices():
+            exp.callback(exp(index))
+
+        # a single worker profile
+        assert os.listdir(exp._profile_dir) == ['{0}.prof'.format(os.getpid())]
+
+        stats = exp.profile_report()
+
+    # only orbits 0 and 2 were profiled
+    calls = [v[1] for k,v in stats.stats.items() if k[2] == 'run']
+    assert calls == [2]
+    assert path.exists(path.join(exp._profile_dir, 'merged.prof'))
+
+    del _hamiltonians[key]
+
+def test_config_provenance(cache_file, tmpdir):
+    exp = Sleepy(cache_file)
+    with h5py.File(cache_file, 'r') as f:
+        assert f['sleepy'].attrs['config_digest'] == exp.snapshot.digest()
+
+    # results computed with other settings can't be mixed in
+    config_file = str(tmpdir.join('config.yml'))
+    with open(config_file, 'w') as f:
+        f.write("sleepy:\n  sleep: 0.2\n")
+
+    with pytest.raises(IOError):
+        Sleepy(cache_file, config_file=config_file)
+
+    with h5py.File(cache_file, 'r') as f:
+        assert f['sleepy'].attrs['config_digest'] == exp.snapshot.digest()
+
+    # ...unless overwriting
+    exp2 = Sleepy(cache_file, config_file=config_file, overwrite=True)
+    with h5py.File(cache_file, 'r') as f:
+        assert f['sleepy'].attrs['config_digest'] == exp2.snapshot.digest()
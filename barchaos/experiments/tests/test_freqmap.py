@@ -2,12 +2,15 @@
 import astropy.units as u
 import pytest
 import gala.dynamics as gd
+import gala.potential as gp
+from gala.units import galactic
 import numpy as np
 import h5py
 import schwimmbad
 
 # Package
-from ..freqmap import FreqMap
+from ..freqmap import FreqMap, OrbitIntegration, window_slices
+from ..store import OrbitStore
 from ...log import logger
 
 logger.setLevel(1)
@@ -41,3 +44,168 @@ def test_freqmap_multi(cache_file):
 
         exp.status()
 
+
+def test_freqmap_prescreen(cache_file, tmpdir):
+    with h5py.File(cache_file, 'a') as f:
+        if 'lyapunovscreen' in f:
+            del f['lyapunovscreen']
+        d = f.create_dataset('lyapunovscreen', shape=(16,),
+                             dtype=[('classification', 'i8')])
+        d['classification'] = np.arange(16) % 4
+
+    with h5py.File(cache_file, 'r') as f:
+        before = f['freqmap']['error_code'] if 'freqmap' in f else None
+
+    exp = FreqMap(cache_file, prescreen=True)
+    assert exp.indices() == [i for i in range(16) if i % 4 in (0, 2)]
+    assert exp._run_kwargs(1) == dict(n_periods=0)
+    assert exp._run_kwargs(2) == dict()
+
+    # skipped orbits that weren't processed get their own error code
+    if before is None:
+        before = np.zeros(16, dtype=int)
+    with h5py.File(cache_file, 'r') as f:
+        error_code = f['freqmap']['error_code']
+    skipped = (np.arange(16) % 2 == 1) & (before == 0)
+    assert np.all(error_code[skipped] == 7)
+    assert np.all(error_code[~skipped] == before[~skipped])
+
+    config_file = str(tmpdir.join('config.yml'))
+    with open(config_file, 'w') as f:
+        f.write("freqmap:\n  prescreen_n_periods: 16\n")
+
+    exp = FreqMap(cache_file, config_file=config_file, prescreen=True,
+                  keyed=True)
+    assert exp.indices() == list(range(16))
+    assert exp._run_kwargs(3) == dict(n_periods=16)
+    assert exp._needs_run(1)
+
+    # the pre-screen must cover all of the initial conditions
+    with h5py.File(cache_file, 'a') as f:
+        del f['lyapunovscreen']
+        f.create_dataset('lyapunovscreen', shape=(8,),
+                         dtype=[('classification', 'i8')])
+
+    with pytest.raises(IOError):
+        FreqMap(cache_file, prescreen=True)
+
+def test_orbitintegration(cache_file):
+    with OrbitIntegration(cache_file) as exp:
+        tmpfile = exp(0)
+        exp.callback(tmpfile)
+
+        exp.status()
+
+    assert 0 in exp.store
+
+    # now run the frequency analysis on the stored orbit
+    with FreqMap(cache_file, orbit_store=exp.store.filename,
+                 overwrite=True) as exp2:
+        tmpfile = exp2(0)
+        exp2.callback(tmpfile)
+
+def test_freqmap_from_store(cache_file, tmpdir):
+    pot = gp.LogarithmicPotential(v_c=200*u.km/u.s, r_h=1*u.kpc,
+                                  q1=1., q2=0.9, q3=0.8, units=galactic)
+    frame = gp.ConstantRotatingFrame(Omega=[0,0,40.]*u.km/u.s/u.kpc,
+                                     units=galactic)
+    H = gp.Hamiltonian(pot, frame)
+    w0 = gd.PhaseSpacePosition(pos=[8., 0, 0.5]*u.kpc,
+                               vel=[0, 200., 20]*u.km/u.s)
+    orbit = H.integrate_orbit(w0, dt=0.5, n_steps=20000)
+
+    store = OrbitStore(str(tmpdir.join('orbits.hdf5')))
+    store.write(3, orbit.t.value, orbit.w(galactic), dE_max=0., dt=0.5,
+                nsteps=20000)
+
+    exp = FreqMap(cache_file, orbit_store=store.filename)
+    result1 = exp.run(w0, H, index=3)
+    result2 = exp.analyze(orbit, exp._empty_result)
+    assert result1['error_code'] == 1
+    assert np.allclose(result1['freqs'], result2['freqs'])
+    assert result1['nsteps'] == 20000
+
+    # orbits missing from the store fail
+    assert exp.run(w0, H, index=4)['error_code'] == 9
+
+    # orbits integrated with other settings can't be analyzed, but the
+    # frequency analysis settings can change
+    store.config_digest = exp._store_digest
+    config_file = str(tmpdir.join('config.yml'))
+    with open(config_file, 'w') as f:
+        f.write("freqmap:\n  n_windows: 4\n")
+    FreqMap(cache_file, config_file=config_file, keyed=True,
+            orbit_store=store.filename)
+
+    with open(config_file, 'w') as f:
+        f.write("freqmap:\n  atol: 1.E-8\n")
+    with pytest.raises(IOError):
+        FreqMap(cache_file, config_file=config_file, keyed=True,
+                orbit_store=store.filename)
+
+def test_window_slices():
+    # contiguous halves
+    assert window_slices(100, 2) == [slice(0, 51), slice(50, 101)]
+
+    for n_windows, overlap in [(1, 0.), (3, 0.), (8, 0.5), (5, 0.75)]:
+        slices = window_slices(1000, n_windows, overlap)
+        assert len(slices) == n_windows
+        assert slices[0].start == 0
+        assert slices[-1].stop == 1001
+        assert len(set(sl.stop - sl.start for sl in slices)) == 1
+
+    with pytest.raises(ValueError):
+        window_slices(1000, 4, 1.)
+
+def test_freqmap_windows(cache_file, tmpdir):
+    config_file = str(tmpdir.join('config.yml'))
+    with open(config_file, 'w') as f:
+        f.write("freqmap:\n  n_windows: 8\n  window_overlap: 0.5\n")
+
+    pot = gp.LogarithmicPotential(v_c=200*u.km/u.s, r_h=1*u.kpc,
+                                  q1=1., q2=0.9, q3=0.8, units=galactic)
+    H = gp.Hamiltonian(pot)
+    w0 = gd.PhaseSpacePosition(pos=[8., 0, 0.5]*u.kpc,
+                               vel=[0, 200., 20]*u.km/u.s)
+    orbit = H.integrate_orbit(w0, dt=0.5, n_steps=20000)
+
+    exp = FreqMap(cache_file, config_file=config_file, keyed=True)
+    result = exp.analyze(orbit, exp._empty_result)
+    assert result['error_code'] == 1
+    assert result['freqs'].shape == (1, 8, 3)
+    assert np.all(np.isfinite(result['freqs']))
+
+    # a regular orbit has the same frequencies in all windows
+    assert np.allclose(result['freqs'][0], result['freqs'][0, 0], rtol=1E-2)
+
+    with h5py.File(cache_file, 'r') as f:
+        assert f[exp.name].dtype['freqs'].shape == (8, 3)
+
+def test_tolerance_ladder(cache_file, tmpdir):
+    config_file = str(tmpdir.join('config.yml'))
+    with open(config_file, 'w') as f:
+        f.write("freqmap:\n  atol_ladder: [1.E-4, 1.E-13]\n")
+
+    pot = gp.LogarithmicPotential(v_c=200*u.km/u.s, r_h=1*u.kpc,
+                                  q1=1., q2=0.9, q3=0.8, units=galactic)
+    H = gp.Hamiltonian(pot)
+    w0 = gd.PhaseSpacePosition(pos=[8., 0, 0.5]*u.kpc,
+                               vel=[0, 200., 20]*u.km/u.s)
+
+    exp = FreqMap(cache_file, config_file=config_file, keyed=True)
+    assert exp.settings.atol_ladder == (1E-4, 1E-13)
+
+    # the loose tolerance doesn't conserve energy, so the orbit is retried
+    orbit, dE_max, rung = exp._integrate_ladder(w0, H, dt=1., nsteps=10000)
+    assert rung == 1
+    assert dE_max < exp.settings.energy_tolerance
+    assert len(orbit.t) == 10001
+    with h5py.File(cache_file, 'r') as f:
+        assert 'rung' in f[exp.name].dtype.names
+
+    # the default is a single rung, with atol, and the rung isn't recorded
+    exp = FreqMap(cache_file)
+    _, dE_max, rung = exp._integrate_ladder(w0, H, dt=1., nsteps=10000)
+    assert rung == 0
+    with h5py.File(cache_file, 'r') as f:
+        assert 'rung' not in f[exp.name].dtype.names
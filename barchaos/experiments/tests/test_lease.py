@@ -0,0 +1,134 @@
+# Standard library
+import multiprocessing
+import os
+import time
+
+# Third-party
+import astropy.units as u
+import pytest
+import gala.dynamics as gd
+import gala.potential as gp
+from gala.units import galactic
+import numpy as np
+import h5py
+import schwimmbad
+
+# Package
+from ..base import Experiment, _hamiltonians
+from ..lease import LeaseLedger, process_leases
+from ...config import ConfigNamespace, ConfigItem
+from ...log import logger
+
+class Config(ConfigNamespace):
+    name = "worker"
+
+    sleep = ConfigItem(0.01, "Time to sleep for each orbit [s]")
+
+class Worker(Experiment):
+    cache_dtype = [
+        ('pid', 'i8'), # the process that ran the orbit
+        ('success', 'b1')
+    ]
+
+    config = Config()
+
+    def run(self, w0, H):
+        result = self._empty_result
+        time.sleep(self.settings.sleep)
+        result['pid'] = os.getpid()
+        result['success'] = True
+        result['error_code'] = 1
+        return result
+
+@pytest.fixture
+def cache_file(tmpdir):
+    fn = tmpdir.join('cache.hdf5')
+
+    w0 = gd.PhaseSpacePosition(pos=np.random.random((3,64))*u.kpc,
+                               vel=np.random.random((3,64))*u.m/u.s)
+    with h5py.File(fn, 'w') as f:
+        g = f.create_group('w0')
+        w0.to_hdf5(g)
+
+    return str(fn)
+
+def _job(cache_file):
+    # no need for the bar potential here
+    exp = Worker(cache_file, shared=True)
+    key = exp.snapshot['potential'].digest()
+    _hamiltonians[key] = gp.Hamiltonian(
+        gp.KeplerPotential(m=1E10, units=galactic))
+
+    with exp:
+        process_leases(exp, schwimmbad.SerialPool(), chunk_size=4)
+
+def test_ledger(cache_file):
+    exp = Worker(cache_file, shared=True)
+    ledger = LeaseLedger(exp, chunk_size=16, lease_time=0.1)
+    assert len(ledger) == 4
+    assert ledger.indices(1) == list(range(16, 32))
+
+    assert ledger.claim() == 0
+    assert ledger.claim() == 1
+    assert ledger.complete(1)
+    assert ledger.status() == (1, 1, 2)
+
+    # a lease that isn't renewed expires, and can be claimed by another job
+    time.sleep(0.2)
+    other = LeaseLedger(exp, chunk_size=16)
+    other.job_id = 'other'
+    assert other.claim() == 0
+    assert not ledger.renew(0)
+
+    # leases must be used with shared experiments
+    with pytest.raises(ValueError):
+        LeaseLedger(Worker(cache_file))
+
+def test_process_leases(cache_file):
+    # initialize the results dataset before starting the jobs
+    Worker(cache_file)
+
+    ctx = multiprocessing.get_context('fork')
+    jobs = [ctx.Process(target=_job, args=(cache_file,)) for _ in range(3)]
+    for job in jobs:
+        job.start()
+    for job in jobs:
+        job.join()
+        assert job.exitcode == 0
+
+    with h5py.File(cache_file, 'r') as f:
+        d = f['worker'][:]
+
+    # every orbit was processed, by one of the jobs
+    assert np.all(d['error_code'] == 1)
+    assert set(d['pid']) <= set(job.pid for job in jobs)
+
+    # each chunk was processed by a single job
+    assert np.all(d['pid'].reshape(-1, 4) == d['pid'].reshape(-1, 4)[:, :1])
+
+    # each job has its own temporary directory, which is cleaned up
+    assert not any(name.startswith('_tmp_')
+                   for name in os.listdir(os.path.dirname(cache_file)))
+
+def test_process_leases_lost(cache_file, monkeypatch):
+    exp = Worker(cache_file, shared=True)
+    key = exp.snapshot['potential'].digest()
+    _hamiltonians[key] = gp.Hamiltonian(
+        gp.KeplerPotential(m=1E10, units=galactic))
+
+    # every lease is taken over by another job as soon as it is renewed
+    monkeypatch.setattr(LeaseLedger, 'renew', lambda self, chunk: False)
+
+    with exp:
+        n_chunks = process_leases(exp, schwimmbad.SerialPool(), chunk_size=4,
+                                  batch_size=2)
+
+    # only the first batch of each chunk was processed, and no chunk was
+    # completed
+    assert n_chunks == 0
+    with h5py.File(cache_file, 'r') as f:
+        d = f['worker'][:]
+    assert np.all(d['error_code'].reshape(-1, 4)[:, :2] == 1)
+    assert np.all(d['error_code'].reshape(-1, 4)[:, 2:] == 0)
+
+    del _hamiltonians[key]
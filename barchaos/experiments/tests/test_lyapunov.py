@@ -0,0 +1,51 @@
+# Third-party
+import astropy.units as u
+import pytest
+import gala.dynamics as gd
+import gala.potential as gp
+from gala.units import galactic
+import numpy as np
+import h5py
+import schwimmbad
+
+# Package
+from ..lyapunov import LyapunovScreen
+from ...log import logger
+
+logger.setLevel(1)
+
+@pytest.fixture(scope='session')
+def cache_file(tmpdir_factory):
+    fn = tmpdir_factory.mktemp('cache').join('cache.hdf5')
+
+    w0 = gd.PhaseSpacePosition(pos=np.random.random((3,16))*u.kpc,
+                               vel=np.random.random((3,16))*u.m/u.s)
+    with h5py.File(fn, 'w') as f:
+        g = f.create_group('w0')
+        w0.to_hdf5(g)
+
+    return str(fn)
+
+def test_lyapunov(cache_file):
+    with LyapunovScreen(cache_file) as exp:
+        tmpfile = exp(0)
+        exp.callback(tmpfile)
+
+        exp.status()
+
+def test_lyapunov_multi(cache_file):
+
+    with LyapunovScreen(cache_file) as exp:
+        with schwimmbad.MultiPool() as pool:
+            pool.map(exp, list(range(16)), callback=exp.callback)
+
+        exp.status()
+
+def test_lyapunov_no_c(cache_file):
+    # fast_lyapunov_max needs a potential with a C implementation
+    pot = gp.HarmonicOscillatorPotential(omega=[1.,1.,1.]/u.Myr,
+                                         units=galactic)
+    exp = LyapunovScreen(cache_file)
+    res = exp.run(exp.w0[0], gp.Hamiltonian(pot))
+    assert res['error_code'] == 8
+    assert not res['success']
@@ -0,0 +1,128 @@
+# Third-party
+import astropy.units as u
+import pytest
+import gala.dynamics as gd
+import gala.potential as gp
+from gala.units import galactic
+import numpy as np
+import h5py
+
+# Package
+from ..base import _hamiltonians
+from ..freqmap import FreqMap, OrbitIntegration
+from ..orbitstats import OrbitStats
+from ..pipeline import Pipeline
+from ..store import OrbitStore
+from ...log import logger
+
+logger.setLevel(1)
+
+@pytest.fixture
+def H():
+    pot = gp.LogarithmicPotential(v_c=200*u.km/u.s, r_h=1*u.kpc,
+                                  q1=1., q2=0.9, q3=0.8, units=galactic)
+    frame = gp.ConstantRotatingFrame(Omega=[0,0,40.]*u.km/u.s/u.kpc,
+                                     units=galactic)
+    return gp.Hamiltonian(pot, frame)
+
+@pytest.fixture
+def cache_file(tmpdir, H):
+    fn = str(tmpdir.join('cache.hdf5'))
+
+    pos = np.array([[8., 0, 0.5], [4., 0, 0.1], [2., 0, 1.]]).T
+    vel = np.array([[0, 200., 20], [0, 150., 20], [0, 150., 0.]]).T
+    w0 = gd.PhaseSpacePosition(pos=pos*u.kpc, vel=vel*u.km/u.s)
+    with h5py.File(fn, 'w') as f:
+        g = f.create_group('w0')
+        w0.to_hdf5(g)
+
+    # store the orbits, so the test doesn't depend on the bar potential
+    store = OrbitStore(OrbitStore.default_filename(fn))
+    for i in range(w0.shape[0]):
+        orbit = H.integrate_orbit(w0[i], dt=0.5, n_steps=4000)
+        store.write(i, orbit.t.value, orbit.w(galactic), dE_max=0., dt=0.5,
+                    nsteps=4000)
+
+    return fn
+
+def test_orbitstats(cache_file, H):
+    exp = OrbitStats(cache_file)
+    orbit = H.integrate_orbit(exp.w0[0], dt=0.5, n_steps=4000)
+    result = exp.analyze(orbit, exp._empty_result)
+
+    assert result['error_code'] == 1
+    assert 0 < result['r_peri'] < 8.02 < result['r_apo']
+    assert np.allclose(result['EJ'], H.energy(exp.w0[0]).value)
+    assert result['dE_std'] < 1E-8
+
+def test_pipeline(cache_file, H):
+    store = OrbitStore.default_filename(cache_file)
+
+    with pytest.raises(ValueError):
+        Pipeline(cache_file, [FreqMap, OrbitIntegration], orbit_store=store)
+
+    pipeline = Pipeline(cache_file, [FreqMap, OrbitStats], orbit_store=store)
+
+    key = pipeline.stages[0].snapshot['potential'].digest()
+    _hamiltonians[key] = H
+
+    # count the number of times an orbit is read (or integrated)
+    first = pipeline.stages[0]
+    calls = []
+    get_orbit = first.get_orbit
+    def counting_get_orbit(*args, **kwargs):
+        calls.append(1)
+        return get_orbit(*args, **kwargs)
+    first.get_orbit = counting_get_orbit
+
+    with pipeline:
+        assert pipeline.indices() == [0, 1, 2]
+        for index in pipeline.indices():
+            pipeline.callback(pipeline(index))
+
+        # everything is done, so nothing is read again
+        assert pipeline(0) is None
+        pipeline.status()
+
+    assert len(calls) == 3
+
+    with h5py.File(cache_file, 'r') as f:
+        assert np.all(f['freqmap']['error_code'] == 1)
+        assert np.all(f['orbitstats']['error_code'] == 1)
+        assert np.all(f['orbitstats']['nsteps'] == 4000)
+
+    # the same results as running the stage on its own
+    exp = OrbitStats(cache_file, orbit_store=store, overwrite=True)
+    result = exp.run(exp.w0[1], H, index=1)
+    with h5py.File(cache_file, 'r') as f:
+        row = f['orbitstats'][1]
+    for name in ['EJ', 'r_peri', 'r_apo', 'xyz_max']:
+        assert np.allclose(row[name], result[name])
+
+    del _hamiltonians[key]
+
+def test_pipeline_profile(cache_file, H):
+    store = OrbitStore.default_filename(cache_file)
+    pipeline = Pipeline(cache_file, [FreqMap, OrbitStats], orbit_store=store,
+                        profile=2)
+
+    # the first stage profiles the whole pipeline
+    first = pipeline.stages[0]
+    assert pipeline.stages[1].profile is None
+
+    key = first.snapshot['potential'].digest()
+    _hamiltonians[key] = H
+
+    with pipeline:
+        for index in pipeline.indices():
+            pipeline.callback(pipeline(index))
+
+        stats = first.profile_report()
+
+    # only orbit 0 and 2 were profiled, and both stages ran on them
+    calls = [v[1] for k,v in stats.stats.items() if k[2] == '_run_stages']
+    assert calls == [2]
+    calls = [v[1] for k,v in stats.stats.items() if k[2] == 'analyze']
+    assert sorted(calls) == [2, 2]
+
+    del _hamiltonians[key]
@@ -0,0 +1,99 @@
+# Third-party
+import astropy.units as u
+import gala.dynamics as gd
+import gala.potential as gp
+from gala.units import galactic
+import numpy as np
+import h5py
+
+# Package
+from ..lyapunov import LyapunovScreen
+from ..refine import AdaptiveGrid, xz_initial_conditions
+from ...log import logger
+
+logger.setLevel(1)
+
+def ic_func(coords):
+    # dummy initial conditions: the positions are the grid coordinates
+    pos = np.zeros((3, len(coords)))
+    pos[0] = coords[:, 0]
+    pos[2] = coords[:, 1]
+    return gd.PhaseSpacePosition(pos=pos*u.kpc, vel=np.ones_like(pos)*u.kpc/u.Myr)
+
+def fake_freqmap(cache_file):
+    # a frequency map with a jump in frequency across x = 0.4
+    with h5py.File(cache_file, 'a') as f:
+        coords = f['grid']['coords'][:]
+        if 'freqmap' in f:
+            del f['freqmap']
+        data = np.zeros(len(coords), dtype=[('freqs', 'f8', (2,3)),
+                                            ('amps', 'f8', (2,3)),
+                                            ('is_tube', 'b1'),
+                                            ('error_code', 'i8')])
+
+        freqs = np.ones((len(coords), 2, 3))
+        freqs[coords[:, 0] > 0.4] *= 2.
+        freqs *= (1 + 1E-4*coords[:, 0])[:, None, None]
+        data['freqs'] = freqs
+        data['amps'] = 1.
+        data['is_tube'] = True
+        data['error_code'] = 1
+        f.create_dataset('freqmap', data=data)
+
+def test_refine(tmpdir):
+    cache_file = str(tmpdir.join('cache.hdf5'))
+
+    x, z = np.meshgrid(np.arange(0.05, 1, 0.1), np.arange(0.05, 1, 0.1))
+    coords = np.stack((x.ravel(), z.ravel()), axis=1)
+    AdaptiveGrid.create(cache_file, coords, spacing=[0.1, 0.1],
+                        w0=ic_func(coords), EJ=-0.1)
+    LyapunovScreen(cache_file)
+
+    config_file = str(tmpdir.join('config.yml'))
+    with open(config_file, 'w') as f:
+        f.write("refine:\n  max_orbits: {0}\n".format(100 + 4*20 + 4*4))
+    grid = AdaptiveGrid(cache_file, config_file=config_file)
+    assert grid.settings.max_orbits == 196
+
+    # only the two columns of cells on either side of the jump get refined
+    fake_freqmap(cache_file)
+    assert grid.refine(ic_func) == 4 * 20
+
+    with h5py.File(cache_file, 'r') as f:
+        assert f['w0']['pos'].shape == (3, 180)
+        assert f['grid'].attrs['EJ'] == -0.1
+
+        refined = f['grid']['refined'][:]
+        assert np.allclose(np.unique(coords[refined[:100], 0]), [0.35, 0.45])
+
+        parent = f['grid']['parent'][100:]
+        child_coords = f['grid']['coords'][100:]
+        assert np.all(f['grid']['level'][100:] == 1)
+        assert np.allclose(np.abs(child_coords - coords[parent]), 0.025)
+
+    # the budget limits how many cells get refined next
+    fake_freqmap(cache_file)
+    assert grid.refine(ic_func) == 4 * 4
+
+    # the budget is now used up
+    fake_freqmap(cache_file)
+    assert grid.refine(ic_func) == 0
+
+    # experiment datasets are resized to match the new initial conditions
+    exp = LyapunovScreen(cache_file)
+    assert exp.n_orbits == 196
+    with h5py.File(cache_file, 'r') as f:
+        assert f['lyapunovscreen'].shape == (196,)
+
+def test_xz_initial_conditions():
+    frame = gp.ConstantRotatingFrame(Omega=[0,0,40.]*u.km/u.s/u.kpc,
+                                     units=galactic)
+    H = gp.Hamiltonian(gp.MilkyWayPotential(), frame)
+
+    EJ = -0.2
+    xz = np.array([[1., 0.5], [5., 1.], [5., 20.]])
+    w0 = xz_initial_conditions(xz, EJ, H)
+
+    # the last point is outside of the zero-velocity surface
+    assert np.all(np.isnan(w0.v_y[-1]))
+    assert np.allclose(H.energy(w0[:2]).value, EJ)
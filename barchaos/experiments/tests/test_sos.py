@@ -0,0 +1,90 @@
+# Third-party
+import astropy.units as u
+import pytest
+import gala.dynamics as gd
+import gala.integrate as gi
+import gala.potential as gp
+from gala.units import galactic
+import numpy as np
+import h5py
+
+# Package
+from ..sos import SurfaceOfSection, section_initial_conditions, find_crossings
+from ...log import logger
+
+logger.setLevel(1)
+
+@pytest.fixture(scope='module')
+def H():
+    pot = gp.LogarithmicPotential(v_c=200*u.km/u.s, r_h=1*u.kpc,
+                                  q1=1., q2=0.8, q3=0.7, units=galactic)
+    frame = gp.ConstantRotatingFrame(Omega=[0,0,40.]*u.km/u.s/u.kpc,
+                                     units=galactic)
+    return gp.Hamiltonian(pot, frame)
+
+@pytest.fixture(scope='module')
+def cache_file(tmpdir_factory):
+    fn = tmpdir_factory.mktemp('cache').join('cache.hdf5')
+
+    w0 = gd.PhaseSpacePosition(pos=np.random.random((3,4))*u.kpc,
+                               vel=np.random.random((3,4))*u.m/u.s)
+    with h5py.File(fn, 'w') as f:
+        g = f.create_group('w0')
+        w0.to_hdf5(g)
+
+    return str(fn)
+
+def test_section_initial_conditions(H):
+    EJ = 0.05
+    w0 = section_initial_conditions(np.linspace(1, 4, 8), 0.05, EJ, H)
+    assert np.allclose(H.energy(w0).value, EJ)
+    assert np.all(w0.v_y > 0)
+
+    # outside of the zero-velocity curve
+    w0 = section_initial_conditions(2., 0., 0.01, H)
+    assert np.all(np.isnan(w0.v_y))
+
+def test_find_crossings(H):
+    w0 = section_initial_conditions(2., 0.05, 0.05, H)[0]
+
+    # coarse orbit to find the crossings, fine orbit to check them
+    kw = dict(Integrator=gi.DOPRI853Integrator,
+              Integrator_kwargs=dict(atol=1E-12))
+    orbit = H.integrate_orbit(w0, dt=1., n_steps=1000, **kw)
+    t, w = find_crossings(orbit.t.value, orbit.w(galactic), H, axis=1)
+
+    fine = H.integrate_orbit(w0, dt=0.001, n_steps=1000000, **kw)
+    t2, w2 = find_crossings(fine.t.value, fine.w(galactic), H, axis=1)
+
+    assert len(t) > 2
+    assert np.allclose(t, t2, atol=1E-3)
+    assert np.allclose(w, w2, atol=1E-5)
+    assert np.all(w[1] == 0)
+
+    # in both directions, there are about twice as many crossings
+    t3, _ = find_crossings(orbit.t.value, orbit.w(galactic), H, axis=1,
+                           direction=0)
+    assert abs(len(t3) - 2*len(t)) <= 2
+
+def test_sos(cache_file):
+    with SurfaceOfSection(cache_file) as exp:
+        tmpfile = exp(0)
+        exp.callback(tmpfile)
+
+        exp.status()
+
+    with h5py.File(cache_file, 'r') as f:
+        d = f['surfaceofsection']
+        assert d['w_cross'].shape == (4, exp.settings.max_crossings, 6)
+
+def test_sos_energy_tolerance(cache_file, H, tmpdir):
+    config_file = str(tmpdir.join('config.yml'))
+    with open(config_file, 'w') as f:
+        f.write("sos:\n  n_periods: 4\n  energy_tolerance: 1.E-18\n")
+
+    exp = SurfaceOfSection(cache_file, config_file=config_file, keyed=True)
+    w0 = section_initial_conditions(2., 0.05, 0.05, H)[0]
+    res = exp.run(w0=w0, H=H)
+    assert res['dE_max'] > 1E-18
+    assert res['error_code'] == 4
+    assert not res['success']
@@ -0,0 +1,40 @@
+# Third-party
+import numpy as np
+import pytest
+
+# Package
+from ..store import OrbitStore
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_orbitstore(tmpdir, compression):
+    store = OrbitStore(str(tmpdir.join('orbits.hdf5')),
+                       compression=compression)
+
+    t = np.linspace(0, 10, 128)
+    w = np.random.random((6, 128))
+    store.write(4, t, w, dt=0.1)
+
+    assert 4 in store
+    assert 3 not in store
+
+    t2, w2, attrs = store.read(4)
+    assert np.allclose(t2, t)
+    assert np.allclose(w2, w)
+    assert attrs['dt'] == 0.1
+
+    # overwrite with a different number of steps
+    store.write(4, t[:64], w[:, :64])
+    t2, w2, _ = store.read(4)
+    assert w2.shape == (6, 64)
+
+def test_orbitstore_digest(tmpdir):
+    store = OrbitStore(str(tmpdir.join('orbits.hdf5')))
+    assert store.config_digest is None
+
+    store.write(0, np.arange(4.), np.zeros((6, 4)))
+    store.config_digest = 'abc'
+    assert OrbitStore(store.filename).config_digest == 'abc'
+
+    store.clear()
+    assert 0 not in store
+    assert store.config_digest == 'abc'
@@ -0,0 +1,92 @@
+# Standard library
+from os import path
+
+# Third-party
+import astropy.units as u
+import pytest
+import gala.dynamics as gd
+import numpy as np
+import h5py
+import schwimmbad
+
+# Package
+from ..lyapunov import LyapunovScreen
+from ..sweep import Sweep
+from ...log import logger
+
+logger.setLevel(1)
+
+@pytest.fixture(scope='module')
+def cache_file(tmpdir_factory):
+    fn = tmpdir_factory.mktemp('cache').join('cache.hdf5')
+
+    w0 = gd.PhaseSpacePosition(pos=np.random.random((3,4))*u.kpc,
+                               vel=np.random.random((3,4))*u.m/u.s)
+    with h5py.File(fn, 'w') as f:
+        g = f.create_group('w0')
+        w0.to_hdf5(g)
+
+    return str(fn)
+
+@pytest.fixture(scope='module')
+def config_files(tmpdir_factory):
+    tmpdir = tmpdir_factory.mktemp('config')
+
+    filenames = []
+    for n_periods in [8, 16]:
+        fn = tmpdir.join('config{0}.yml'.format(n_periods))
+        fn.write("lyapunov:\n  n_periods: {0}\n".format(n_periods))
+        filenames.append(str(fn))
+
+    return filenames
+
+def test_sweep(cache_file, config_files):
+    sweep = Sweep(LyapunovScreen, cache_file, config_files)
+
+    names = [exp.name for exp in sweep.experiments]
+    assert names[0] != names[1]
+
+    with h5py.File(cache_file, 'r') as f:
+        for exp, n_periods in zip(sweep.experiments, [8, 16]):
+            assert exp.name == 'lyapunovscreen_{0}'.format(exp.key)
+            assert f[exp.name].attrs['config_digest'] == exp.key
+            assert exp.settings.n_periods == n_periods
+
+    assert sweep.tasks() == [(k, i) for k in range(2) for i in range(4)]
+
+    with sweep:
+        tmpdirs = [exp._tmpdir for exp in sweep.experiments]
+        assert tmpdirs[0] != tmpdirs[1]
+        assert all(path.exists(d) for d in tmpdirs)
+
+    # the same configuration twice isn't allowed
+    with pytest.raises(ValueError):
+        Sweep(LyapunovScreen, cache_file, [config_files[0]]*2)
+
+def test_sweep_disjoint(cache_file, tmpdir):
+    # each file only sets one setting: the others are the defaults, whatever
+    # the order the files are loaded in
+    fn1 = tmpdir.join('c1.yml')
+    fn1.write("potential:\n  Omega: 55.\n")
+    fn2 = tmpdir.join('c2.yml')
+    fn2.write("potential:\n  bar_mass: 2.E10\n")
+    config_files = [str(fn1), str(fn2)]
+
+    alone = LyapunovScreen(cache_file, config_file=config_files[1],
+                           keyed=True)
+
+    sweep = Sweep(LyapunovScreen, cache_file, config_files)
+    exp1, exp2 = sweep.experiments
+    assert exp1.snapshot['potential'].Omega == 55.
+    assert exp1.snapshot['potential'].bar_mass == 1E10
+    assert exp2.snapshot['potential'].Omega == 40.
+    assert exp2.snapshot['potential'].bar_mass == 2E10
+    assert exp2.key == alone.key
+
+def test_sweep_run(cache_file, config_files):
+    with Sweep(LyapunovScreen, cache_file, config_files) as sweep:
+        with schwimmbad.SerialPool() as pool:
+            for _ in pool.map(sweep, sweep.tasks(), callback=sweep.callback):
+                pass
+
+        sweep.status()
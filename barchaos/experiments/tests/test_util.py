@@ -0,0 +1,101 @@
+# Standard library
+import time
+
+# Third-party
+import astropy.units as u
+import gala.dynamics as gd
+import gala.potential as gp
+from gala.units import galactic
+import numpy as np
+import pytest
+
+# Package
+from ..error import OrbitTimeout
+from ..util import (circulation, align_circulation_with_z,
+                    frequency_coordinates, orbit_to_poincare_polar,
+                    call_with_time_limit)
+
+@pytest.fixture(scope='module')
+def orbits():
+    pot = gp.LogarithmicPotential(v_c=200*u.km/u.s, r_h=1*u.kpc,
+                                  q1=1., q2=0.9, q3=0.8, units=galactic)
+
+    # a z tube, an x tube, a y tube, and a box orbit
+    pos = np.array([[8., 0, 0.5], [0.3, 0., 6.], [0.2, 0., 6.],
+                    [1., 0.5, 0.2]]).T
+    vel = np.array([[0, 180., 10.], [10., -150., 0.], [-150., 0., 5.],
+                    [0., 0., 0.]]).T
+    w0 = gd.PhaseSpacePosition(pos=pos*u.kpc, vel=vel*u.km/u.s)
+    return gp.Hamiltonian(pot).integrate_orbit(w0, dt=0.5, n_steps=4000)
+
+def test_circulation(orbits):
+    w = orbits.w(galactic)
+
+    circ = circulation(w)
+    assert circ.dtype == bool
+    assert np.all(circ == orbits.circulation().astype(bool))
+    assert circ[:, 0].tolist() == [False, False, True]
+    assert circ[:, 1].tolist() == [True, False, False]
+    assert circ[:, 2].tolist() == [False, True, False]
+    assert not np.any(circ[:, 3])
+
+    # single orbits
+    for n in range(orbits.norbits):
+        assert np.all(circulation(w[..., n]) == circ[:, n])
+
+def test_align_circulation_with_z(orbits):
+    w = orbits.w(galactic)
+
+    aligned = align_circulation_with_z(w)
+    assert np.all(aligned == orbits.align_circulation_with_z().w(galactic))
+
+    # all aligned tube orbits circulate about z
+    circ = circulation(aligned)
+    assert np.all(circ[2, :3])
+
+    # single orbit, into a pre-allocated array
+    out = np.empty_like(w[..., 1])
+    assert align_circulation_with_z(w[..., 1], out=out) is out
+    assert np.all(out == aligned[..., 1])
+
+    with pytest.raises(ValueError):
+        align_circulation_with_z(w, out=np.empty_like(w[..., 1]))
+
+def test_frequency_coordinates(orbits):
+    w = orbits.w(galactic)
+    circ = circulation(w)
+
+    fs = frequency_coordinates(w, circ)
+    assert fs.shape == (3,) + w.shape[1:]
+    assert fs.dtype == complex
+
+    for n in range(orbits.norbits):
+        orbit = orbits[:, n]
+
+        # single orbit, into a pre-allocated array
+        out = np.empty((3, w.shape[1]), dtype=complex)
+        frequency_coordinates(w[..., n], out=out)
+        assert np.allclose(out, fs[..., n])
+
+        if np.any(circ[:, n]):
+            new_orbit = orbit.align_circulation_with_z(circ[:, n].astype(int))
+            expected = np.array(orbit_to_poincare_polar(new_orbit))
+        else:
+            expected = w[:3, :, n] + 1j*w[3:, :, n]
+        assert np.allclose(fs[..., n], expected)
+
+    fs = frequency_coordinates(w, circ, force_cartesian=True)
+    assert np.all(fs == w[:3] + 1j*w[3:])
+
+def test_call_with_time_limit():
+    assert call_with_time_limit(5., np.arange, 3).tolist() == [0, 1, 2]
+
+    # exceptions are raised in the parent
+    with pytest.raises(ZeroDivisionError):
+        call_with_time_limit(5., lambda: 1 // 0)
+
+    # the child is killed once it runs out of time
+    t0 = time.time()
+    with pytest.raises(OrbitTimeout):
+        call_with_time_limit(0.2, time.sleep, 5)
+    assert time.time() - t0 < 2.
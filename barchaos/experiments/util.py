@@ -1,4 +1,17 @@
+# Standard library
+import os
+import pickle
+import select
+import signal
+import time
+
+# Third-party
 import numpy as np
+import gala.integrate as gi
+
+# Project
+from ..log import logger
+from .error import OrbitTimeout
 
 def orbit_to_poincare_polar(orbit):
     r"""
@@ -29,3 +42,308 @@ def orbit_to_poincare_polar(orbit):
           orbit.z.value+1j*orbit.v_z.value]
 
     return fs
+
+# order of the axes that puts the axis of circulation along z, for orbits
+# circulating about z (or not at all), about x, and about y
+_alignments = ((0, 1, 2), (2, 1, 0), (0, 2, 1))
+
+def circulation(w):
+    """
+    Classify orbits by their circulation about each axis, from the sign of the
+    components of the angular momentum: an orbit circulates about an axis if
+    that component never changes sign (or gets close to zero). This is the
+    same as `gala.dynamics.Orbit.circulation`, but for unitless arrays.
+
+    Parameters
+    ----------
+    w : array_like
+        Phase-space positions, shape ``(6, ntimes)`` for a single orbit, or
+        ``(6, ntimes, norbits)`` for a block of orbits (as returned by
+        `gala.dynamics.Orbit.w`).
+
+    Returns
+    -------
+    circ : `numpy.ndarray`
+        Boolean array of circulation about the x, y, and z axes, shape
+        ``(3,)`` or ``(3, norbits)``.
+    """
+    w = np.asarray(w)
+    x = w[:3]
+    v = w[3:]
+
+    circ = np.empty((3,) + w.shape[2:], dtype=bool)
+    for i in range(3):
+        j, k = (i+1) % 3, (i+2) % 3
+        L = x[j]*v[k] - x[k]*v[j]
+        flipped = ((np.sign(L[1:]) != np.sign(L[0])) |
+                   (np.abs(L[1:]) < 1E-13))
+        circ[i] = ~np.any(flipped, axis=0)
+
+    return circ
+
+def _alignment(circ):
+    """ Index into ``_alignments`` for each orbit """
+    a = np.zeros(circ.shape[1:], dtype=int)
+    a[circ[0] & ~circ[2]] = 1
+    a[circ[1] & ~circ[0] & ~circ[2]] = 2
+
+    n_multi = np.sum(np.sum(circ, axis=0) > 1)
+    if n_multi > 0:
+        logger.warning("{0} orbit(s) circulate about multiple axes - are you "
+                       "sure the orbits have been integrated for long enough?"
+                       .format(n_multi))
+
+    return a
+
+def _as_block(w, circ, out, shape, dtype):
+    """
+    Add an orbit axis to a single orbit, and check (or allocate) the output
+    array. Returns views of the inputs with an orbit axis, and the output.
+    """
+    w = np.asarray(w)
+    if circ is None:
+        circ = circulation(w)
+    circ = np.asarray(circ, dtype=bool)
+
+    if out is None:
+        out = np.empty(shape + w.shape[1:], dtype=dtype)
+    elif out.shape != shape + w.shape[1:]:
+        raise ValueError("Output array has shape {0}, but should have shape "
+                         "{1}".format(out.shape, shape + w.shape[1:]))
+
+    if w.ndim == 2:
+        return w[..., None], circ[:, None], out[..., None], out
+
+    if circ.shape != (3, w.shape[2]):
+        raise ValueError("Shape of the circulation array {0} doesn't match "
+                         "the number of orbits ({1})"
+                         .format(circ.shape, w.shape[2]))
+
+    return w, circ, out, out
+
+def _fill_groups(w, group, out, func):
+    """
+    Call ``func(w, g, out)`` for each group of orbits, on views of the whole
+    block if all orbits are in the same group.
+    """
+    for g in np.unique(group):
+        sel = group == g
+        if np.all(sel):
+            func(w, g, out)
+
+        else:
+            idx, = np.where(sel)
+            tmp = np.empty(out.shape[:-1] + (len(idx),), dtype=out.dtype)
+            func(w[..., idx], g, tmp)
+            out[..., idx] = tmp
+
+def align_circulation_with_z(w, circ=None, out=None):
+    """
+    Swap the axes of orbits so that the circulation is about the z axis (for
+    tube orbits). This is the same as
+    `gala.dynamics.Orbit.align_circulation_with_z`, but for unitless arrays.
+
+    Parameters
+    ----------
+    w : array_like
+        Phase-space positions, shape ``(6, ntimes)`` or
+        ``(6, ntimes, norbits)``.
+    circ : array_like, optional
+        The circulation of the orbits, as returned by `circulation`. Computed
+        if not specified.
+    out : `numpy.ndarray`, optional
+        Array to write the aligned positions to, with the same shape as ``w``.
+
+    Returns
+    -------
+    out : `numpy.ndarray`
+    """
+    w, circ, o, out = _as_block(w, circ, out, (6,), float)
+
+    def align(w, a, out):
+        for i, j in enumerate(_alignments[a]):
+            out[i] = w[j]
+            out[i+3] = w[j+3]
+
+    _fill_groups(w, _alignment(circ), o, align)
+    return out
+
+def _fill_frequency_coordinates(w, a, out):
+    if a < 0: # Cartesian
+        for j in range(3):
+            out[j].real = w[j]
+            out[j].imag = w[j+3]
+        return
+
+    i, j, k = _alignments[a]
+    x, y, z = w[i], w[j], w[k]
+    vx, vy, vz = w[i+3], w[j+3], w[k+3]
+
+    # see orbit_to_poincare_polar - cos(phi) = y/R, sin(phi) = x/R
+    R = np.sqrt(x*x + y*y)
+    inv_R = 1 / R
+    sqrt_2THETA = np.sqrt(np.abs(2*(x*vy - y*vx)))
+
+    out[0].real = R
+    out[0].imag = (x*vx + y*vy) * inv_R
+    out[1].real = sqrt_2THETA * y * inv_R
+    out[1].imag = sqrt_2THETA * x * inv_R
+    out[2].real = z
+    out[2].imag = vz
+
+def frequency_coordinates(w, circ=None, force_cartesian=False, out=None):
+    """
+    The complex time series to run the frequency analysis on: Poincaré
+    symplectic polar coordinates (see `orbit_to_poincare_polar`) with the
+    circulation aligned with the z axis for tube orbits, and
+    :math:`q + i\\,p` in Cartesian coordinates for box orbits. The aligned
+    coordinates are written straight into the output array, so no aligned
+    copy of the orbits is made.
+
+    Parameters
+    ----------
+    w : array_like
+        Phase-space positions, shape ``(6, ntimes)`` or
+        ``(6, ntimes, norbits)``.
+    circ : array_like, optional
+        The circulation of the orbits, as returned by `circulation`. Computed
+        if not specified.
+    force_cartesian : bool, optional
+        Use Cartesian coordinates for all orbits.
+    out : `numpy.ndarray`, optional
+        Complex array to write to, shape ``(3, ntimes)`` or
+        ``(3, ntimes, norbits)``.
+
+    Returns
+    -------
+    fs : `numpy.ndarray`
+    """
+    w, circ, o, out = _as_block(w, circ, out, (3,), complex)
+
+    if force_cartesian:
+        group = np.full(circ.shape[1:], -1, dtype=int)
+    else:
+        group = np.where(np.any(circ, axis=0), _alignment(circ), -1)
+
+    _fill_groups(w, group, o, _fill_frequency_coordinates)
+    return out
+
+def call_with_time_limit(time_limit, func, *args, **kwargs):
+    """
+    Call a function in a forked child process, and kill the child if it
+    doesn't return within a wall-clock time limit. Unlike checking the time
+    between the stages of a calculation, this also bounds time spent in
+    compiled code (e.g., inside the C integrators), and the calculation itself
+    is unchanged. Forking an MPI process isn't safe, so this can't be used
+    with MPI pools.
+
+    Parameters
+    ----------
+    time_limit : float
+        The time limit [s].
+    func : callable
+        The function to call. Its return value (or any exception it raises)
+        must be picklable.
+    *args, **kwargs
+        Passed to the function.
+
+    Returns
+    -------
+    value
+        The return value of the function.
+
+    Raises
+    ------
+    `~barchaos.experiments.error.OrbitTimeout`
+        If the time limit is exceeded.
+    """
+    deadline = time.time() + time_limit
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0: # child: send the result back through the pipe, and exit
+        os.close(r)
+        try:
+            try:
+                out = (True, func(*args, **kwargs))
+            except BaseException as e:
+                out = (False, e)
+
+            try:
+                data = pickle.dumps(out)
+            except Exception:
+                data = pickle.dumps((False, RuntimeError(repr(out[1]))))
+
+            with os.fdopen(w, 'wb') as f:
+                f.write(data)
+        finally:
+            os._exit(0)
+
+    os.close(w)
+    chunks = []
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if (remaining <= 0 or
+                    len(select.select([r], [], [], remaining)[0]) == 0):
+                os.kill(pid, signal.SIGKILL)
+                raise OrbitTimeout()
+
+            chunk = os.read(r, 65536)
+            if not chunk: # the child is done
+                break
+            chunks.append(chunk)
+
+    finally:
+        os.close(r)
+        os.waitpid(pid, 0)
+
+    if len(chunks) == 0:
+        raise RuntimeError("Child process died without returning a result.")
+
+    success, value = pickle.loads(b''.join(chunks))
+    if not success:
+        raise value
+    return value
+
+def integrate_orbit(w0, H, dt, n_steps, atol=1E-11):
+    """
+    Integrate an orbit with the Dormand-Prince 8(5,3) integrator and compute
+    the maximum fractional (Jacobi) energy difference along the orbit.
+
+    Parameters
+    ----------
+    w0 : `~gala.dynamics.PhaseSpacePosition`
+    H : `~gala.potential.Hamiltonian`
+    dt : float
+    n_steps : int
+    atol : float, optional
+
+    Returns
+    -------
+    orbit : `~gala.dynamics.Orbit`
+        The orbit, or None if the integration failed.
+    dE_max : float
+        The maximum fractional energy difference (compared to initial), or
+        1E10 if the integration failed.
+    """
+    logger.debug("Integrating orbit with dt={0}, nsteps={1}"
+                 .format(dt, n_steps))
+
+    try:
+        orbit = H.integrate_orbit(w0, dt=dt, n_steps=n_steps,
+                                  Integrator=gi.DOPRI853Integrator,
+                                  Integrator_kwargs=dict(atol=atol))
+
+    except RuntimeError: # ODE integration failed
+        logger.warning("Orbit integration failed.")
+        return None, 1E10
+
+    logger.debug('Orbit integrated successfully, checking energy conservation...')
+
+    # check energy conservation for the orbit
+    E = orbit.energy()
+    dE_max = np.max(np.abs((E[1:] - E[0])/E[0]))
+    logger.debug('max(∆E) = {0:.2e}'.format(dE_max))
+
+    return orbit, dE_max
@@ -1,2 +1,4 @@
 from .core import *
 from .bfe import *
+from .grid import *
+from .fit import *
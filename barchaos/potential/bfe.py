@@ -17,7 +17,7 @@ x0 = 1.75
 y0 = 0.6
 z0 = 0.4
 
-__all__ = ['get_scf_coeffs']
+__all__ = ['get_scf_coeffs', 'prune_scf_coeffs']
 
 def f(x, y, Rmax):
     R_2 = x**2 + y**2
@@ -57,3 +57,33 @@ def get_scf_coeffs(Rmax, nmax, lmax):
     (S,Serr), (T,Terr) = coeff
 
     return S, np.zeros_like(S)
+
+def prune_scf_coeffs(Snlm, rel_tol):
+    """Prune an SCF expansion by dropping terms that are small compared to the
+    largest term.
+
+    Terms with ``|Snlm|`` below ``rel_tol`` times the largest ``|Snlm|`` are
+    set to zero (so they are skipped when the expansion is evaluated), and the
+    coefficient array is then truncated to the smallest ``nmax`` and ``lmax``
+    that contain all of the remaining terms.
+
+    Parameters
+    ----------
+    Snlm : numpy.ndarray
+        The expansion coefficients, shape ``(nmax+1, lmax+1, lmax+1)``.
+    rel_tol : float
+        The relative threshold for keeping a term.
+
+    Returns
+    -------
+    Snlm : numpy.ndarray
+        The pruned expansion coefficients.
+    """
+    S = np.array(Snlm, copy=True)
+    S[np.abs(S) < rel_tol * np.abs(S).max()] = 0.
+
+    nz = np.argwhere(S != 0)
+    nmax = nz[:, 0].max()
+    lmax = nz[:, 1:].max()
+
+    return S[:nmax+1, :lmax+1, :lmax+1]
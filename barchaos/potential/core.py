@@ -14,10 +14,16 @@ from scipy.optimize import minimize
 
 # Project
 from ..log import logger
-from ..config import ConfigNamespace, ConfigItem
-from .bfe import get_scf_coeffs
+from ..config import ConfigNamespace, ConfigItem, ConfigSnapshot
+from .bfe import get_scf_coeffs, prune_scf_coeffs
+from .grid import GridBarPotential, grid_errors
 
-__all__ = ['Config', 'get_hamiltonian', 'get_bar_potential']
+__all__ = ['Config', 'GridConfig', 'get_hamiltonian', 'get_potential_no_bar',
+           'get_bar_potential', 'get_bar_coeffs', 'get_grid_bar_potential',
+           'get_pruning_errors']
+
+# Path to the cached expansion coefficients and interpolation grids
+_data_path = path.join(path.dirname(path.abspath(__file__)), 'data')
 
 class Config(ConfigNamespace):
     name = "potential"
@@ -29,54 +35,135 @@ class Config(ConfigNamespace):
     Omega = ConfigItem(40., "Bar pattern speed [km/s/kpc]")
     bar_mass = ConfigItem(1E10, "Bar mass [Msun]")
 
-    # TODO: add other tunable parameters once I decide on the potential...
+    disk_mass = ConfigItem(5E10, "Mass of the (Miyamoto-Nagai) disk [Msun]")
+    disk_a = ConfigItem(3., "Disk scale length [kpc]")
+    disk_b = ConfigItem(0.28, "Disk scale height [kpc]")
+    spheroid_mass = ConfigItem(4E9, "Mass of the (Hernquist) spheroid [Msun]")
+    spheroid_c = ConfigItem(0.6, "Spheroid scale radius [kpc]")
+    halo_mass = ConfigItem(6E11, "Scale mass of the (NFW) halo [Msun]")
+    halo_r_s = ConfigItem(18., "Halo scale radius [kpc]")
+
+    prune_tol = ConfigItem(0., "Drop SCF terms with |Snlm| below this fraction "
+                               "of the largest term (0 keeps all terms)")
+
+class GridConfig(ConfigNamespace):
+    # Separate from the potential settings, because the grid isn't used for
+    # orbit integration, so these shouldn't change the digest of the potential
+    name = "bar_grid"
+
+    size = ConfigItem(96, "Number of grid points along each axis of the "
+                          "interpolated bar grid")
+    xmax = ConfigItem(10., "Extent of the bar grid in x and y [kpc]")
+    zmax = ConfigItem(5., "Extent of the bar grid in z [kpc]")
+    scale = ConfigItem(0.5, "Scale of the bar grid stretching - the grid "
+                            "spacing is finer inside of this [kpc]")
+    rmin = ConfigItem(0.1, "The SCF expansion is evaluated directly inside "
+                           "of this radius [kpc]")
+
+# The settings of the mass model that the bar expansion coefficients depend on
+# (along with nmax, lmax, and Omega): the expansion is truncated at the
+# corotation radius, which depends on the circular velocity of the full model,
+# including the bar itself
+_model_keys = ['disk_mass', 'disk_a', 'disk_b', 'spheroid_mass', 'spheroid_c',
+               'halo_mass', 'halo_r_s', 'bar_mass']
 
 # ==============================================================================
 
-# Define the potential model up to the bar component
-potential_no_bar = gp.CCompositePotential()
-potential_no_bar['disk'] = gp.MiyamotoNagaiPotential(m=5E10*u.Msun,
-                                                     a=3*u.kpc,
-                                                     b=280*u.pc,
-                                                     units=galactic)
-potential_no_bar['spheroid'] = gp.HernquistPotential(m=4E9*u.Msun,
-                                                     c=0.6*u.kpc,
-                                                     units=galactic)
-potential_no_bar['halo'] = gp.NFWPotential(m=6E11, r_s=18*u.kpc,
-                                           units=galactic)
-
-def get_hamiltonian(config_file=None):
-    c = Config()
-    c.load(config_file)
-
-    pot = potential_no_bar.copy()
-    pot['bar'] = get_bar_potential(config_file)
+def _disk(m, a, b):
+    return gp.MiyamotoNagaiPotential(m=m*u.Msun, a=a*u.kpc, b=b*u.kpc,
+                                     units=galactic)
+
+def _spheroid(m, c):
+    return gp.HernquistPotential(m=m*u.Msun, c=c*u.kpc, units=galactic)
+
+def _halo(m, r_s):
+    return gp.NFWPotential(m=m*u.Msun, r_s=r_s*u.kpc, units=galactic)
+
+def get_potential_no_bar(config=None):
+    """Get the potential model up to the bar component: a disk, spheroid, and
+    dark matter halo.
+    """
+    c = _get_config(config)
+
+    pot = gp.CCompositePotential()
+    pot['disk'] = _disk(c.disk_mass, c.disk_a, c.disk_b)
+    pot['spheroid'] = _spheroid(c.spheroid_mass, c.spheroid_c)
+    pot['halo'] = _halo(c.halo_mass, c.halo_r_s)
+    return pot
+
+def _get_config(config):
+    """Get the (frozen) potential settings from either a path to a
+    configuration file (or None, for the defaults) or a configuration snapshot.
+    """
+    if isinstance(config, ConfigSnapshot):
+        return config[Config.name]
+
+    return ConfigSnapshot.load(config, [Config()])[Config.name]
+
+def _get_grid_config(config):
+    """Like `_get_config`, for the (frozen) bar grid settings."""
+    if isinstance(config, ConfigSnapshot):
+        if GridConfig.name in config:
+            return config[GridConfig.name]
+        config = None # e.g., an experiment snapshot - use the defaults
+
+    return ConfigSnapshot.load(config, [GridConfig()])[GridConfig.name]
+
+def get_hamiltonian(config=None):
+    c = _get_config(config)
+
+    pot = get_potential_no_bar(config)
+    pot['bar'] = get_bar_potential(config)
 
     Om = [0., 0., c.Omega]*u.km/u.s/u.kpc
     frame = gp.ConstantRotatingFrame(Omega=Om, units=galactic)
 
     return gp.Hamiltonian(potential=pot, frame=frame)
 
-def get_bar_potential(config_file=None):
-    c = Config()
-    c.load(config_file)
+def _scf_bar(S, m):
+    # The bar model is symmetric, so all Tnlm are zero. The SCF expansion
+    # skips terms where both Snlm and Tnlm are zero, so these (and any pruned
+    # Snlm terms) cost nothing at run time.
+    return bscf.SCFPotential(m=m, r_s=1., Snlm=S, Tnlm=np.zeros_like(S),
+                             units=galactic)
+
+def get_bar_potential(config=None):
+    """Get the SCF bar potential. If ``prune_tol`` is set in the config, the
+    expansion is pruned with `~barchaos.potential.prune_scf_coeffs` - see
+    `get_pruning_errors` for the resulting errors.
+    """
+    c = _get_config(config)
+
+    S = get_bar_coeffs(config)
+
+    if c.prune_tol > 0:
+        S_full = S
+        S = prune_scf_coeffs(S_full, c.prune_tol)
+        logger.debug("Pruned SCF expansion from {0} to {1} terms"
+                     .format(np.count_nonzero(S_full), np.count_nonzero(S)))
+
+    return _scf_bar(S, c.bar_mass)
+
+def get_bar_coeffs(config=None):
+    """Get the (full) SCF expansion coefficients of the bar, Snlm. These are
+    cached, and computed (which could take some time) if no coefficients are
+    cached for the current bar model.
+    """
+    c = _get_config(config)
 
     # Generate a key to hash the expansion coefficients at in the coefficients
-    # HDF5 file
-    hash_key = str(hash((c.nmax, c.lmax, c.Omega)))
-    fiducial_hash_key = str(hash((c.nmax, c.lmax, 0)))
+    # HDF5 file: a digest of the settings the coefficients depend on
+    keys = ['nmax', 'lmax', 'Omega']
+    hash_key = c.digest(keys + _model_keys)
+    fiducial_hash_key = c.replace(Omega=0.).digest(keys)
 
-    this_path = path.dirname(path.abspath(__file__))
-    coeffs_filename = path.join(this_path, 'data', 'coeffs.hdf5')
+    coeffs_filename = path.join(_data_path, 'coeffs.hdf5')
 
     with h5py.File(coeffs_filename, 'a') as f:
         if hash_key in f:
             logger.debug("Loading cached expansion coefficients")
 
-            S = np.array(f[hash_key][:])
-            return bscf.SCFPotential(m=c.bar_mass, r_s=1.,
-                                     Snlm=S, Tnlm=np.zeros_like(S),
-                                     units=galactic)
+            return np.array(f[hash_key][:])
 
         elif fiducial_hash_key in f:
             fiducial_coeffs = np.array(f[fiducial_hash_key][:])
@@ -102,12 +189,8 @@ def get_bar_potential(config_file=None):
 
     # Now that we have the fiducial model, we construct a potential object with
     # the un-truncated bar:
-    pot = potential_no_bar.copy()
-    fid_bar = bscf.SCFPotential(m=c.bar_mass, r_s=1.,
-                                Snlm=fiducial_coeffs,
-                                Tnlm=np.zeros_like(fiducial_coeffs),
-                                units=galactic)
-    pot['bar'] = fid_bar
+    pot = get_potential_no_bar(config)
+    pot['bar'] = _scf_bar(fiducial_coeffs, c.bar_mass)
 
     def func(R):
         vc = pot.circular_velocity([R,0,0.]).to(u.km/u.s).value
@@ -118,7 +201,7 @@ def get_bar_potential(config_file=None):
     if not res.success:
         logger.warning('Failed to find corotation radius! Hopefully you '
                        'expected that...')
-        return fid_bar
+        return fiducial_coeffs
 
     Rmax = res.x[0]
 
@@ -130,7 +213,114 @@ def get_bar_potential(config_file=None):
                              data=coeffs)
         d.attrs['Rmax'] = Rmax
 
-    return bscf.SCFPotential(m=c.bar_mass, r_s=1.,
-                             Snlm=coeffs,
-                             Tnlm=np.zeros_like(fiducial_coeffs),
-                             units=galactic)
+    return coeffs
+
+def get_pruning_errors(config=None, R=None):
+    """Compute the errors introduced by pruning the SCF expansion of the bar
+    with the ``prune_tol`` set in the config.
+
+    Parameters
+    ----------
+    config : str, `~barchaos.config.ConfigSnapshot`, optional
+        Path to a configuration file, or a configuration snapshot.
+    R : array_like, optional
+        Radii to compare the potentials at [kpc].
+
+    Returns
+    -------
+    errors : dict
+        The number of terms in the full and pruned expansions, and the maximum
+        fractional error in the bar potential (``dPhi``) and in the circular
+        velocity of the full potential model (``dvc``).
+    """
+    c = _get_config(config)
+
+    if R is None:
+        R = np.logspace(-1, np.log10(20.), 64)
+    R = np.asarray(R)
+
+    S = get_bar_coeffs(config)
+    S_pruned = prune_scf_coeffs(S, c.prune_tol)
+
+    full = get_potential_no_bar(config)
+    full['bar'] = _scf_bar(S, c.bar_mass)
+    pruned = get_potential_no_bar(config)
+    pruned['bar'] = _scf_bar(S_pruned, c.bar_mass)
+
+    # compare at points on the x and y axes, and along a diagonal out of the
+    # plane (because the bar is triaxial)
+    dirs = np.array([[1., 0, 0], [0, 1, 0], [1., 1, 1]]) / np.sqrt([1, 1, 3])[:, None]
+    xyz = (R[None, :, None] * dirs[:, None, :]).reshape(-1, 3).T
+
+    Phi1 = full['bar'].energy(xyz).value
+    Phi2 = pruned['bar'].energy(xyz).value
+    vc1 = full.circular_velocity(xyz).value
+    vc2 = pruned.circular_velocity(xyz).value
+
+    errors = dict(n_terms=np.count_nonzero(S),
+                  n_terms_pruned=np.count_nonzero(S_pruned),
+                  dPhi=np.max(np.abs((Phi2 - Phi1) / Phi1)),
+                  dvc=np.max(np.abs((vc2 - vc1) / vc1)))
+
+    logger.info("Pruned SCF expansion ({n_terms_pruned} of {n_terms} terms): "
+                "max. fractional error in bar potential {dPhi:.1e}, in "
+                "circular velocity {dvc:.1e}".format(**errors))
+
+    return errors
+
+def get_grid_bar_potential(config=None):
+    """Get the bar potential evaluated by interpolating on a precomputed grid.
+    The grid is cached next to the expansion coefficients, and is computed
+    (which could take some time) if no grid is cached for the current bar
+    model and grid settings (in the ``bar_grid`` config namespace).
+
+    The grid potential is implemented in Python, so gala can't integrate
+    orbits in it with the C integrators (or compute Lyapunov exponents) - it
+    is only faster for vectorized evaluations at many points at once. The
+    Hamiltonian used for orbit integration (`get_hamiltonian`) always uses the
+    SCF bar.
+    """
+    c = _get_config(config)
+    g = _get_grid_config(config)
+
+    # The SCF bar potential: used to compute the grid, and evaluated directly
+    # outside of the grid
+    bar = get_bar_potential(config)
+
+    # The grid is stored for a unit-mass bar, but is computed from the
+    # expansion coefficients, which depend on bar_mass through the truncation
+    hash_key = "{0}_{1}".format(
+        c.digest(['nmax', 'lmax', 'Omega', 'prune_tol'] + _model_keys),
+        g.digest())
+    grids_filename = path.join(_data_path, 'grids.hdf5')
+
+    with h5py.File(grids_filename, 'a') as f:
+        if hash_key in f:
+            logger.debug("Loading cached bar potential grid")
+            return GridBarPotential.from_hdf5(f[hash_key], m=c.bar_mass,
+                                              fallback=bar)
+
+    logger.info("Couldn't find cached bar potential grid for nmax={0}, "
+                "lmax={1}, Omega={2}. Computing now, but this could take some "
+                "time...".format(c.nmax, c.lmax, c.Omega))
+
+    shape = (g.size, g.size, g.size)
+    xyz_max = (g.xmax, g.xmax, g.zmax)
+    grid_bar = GridBarPotential.from_potential(bar, m=c.bar_mass, shape=shape,
+                                               xyz_max=xyz_max, scale=g.scale,
+                                               r_min=g.rmin)
+
+    dE, dgrad = grid_errors(grid_bar, bar)
+    logger.info("Bar potential grid max. fractional errors: potential "
+                "{0:.1e}, gradient {1:.1e}".format(dE, dgrad))
+    if max(dE, dgrad) > 1E-4:
+        logger.warning("Bar potential grid doesn't meet the accuracy target - "
+                       "consider increasing the bar_grid size.")
+
+    with h5py.File(grids_filename, 'a') as f:
+        g = f.create_group(hash_key)
+        grid_bar.to_hdf5(g)
+        g.attrs['dE'] = dE
+        g.attrs['dgrad'] = dgrad
+
+    return grid_bar
@@ -0,0 +1,335 @@
+# coding: utf-8
+
+"""
+Fitting the parameters of the potential model to the Milky Way rotation curve
+(``Sofue.dat``) and enclosed mass measurements (``MW-Menc.txt``), which are
+shipped with the package in ``barchaos/potential/data``.
+
+The squared circular velocity is a sum over the components of the potential,
+and each component's contribution is proportional to its mass. The model
+therefore evaluates the circular velocity of each component per unit mass at
+the data radii, and caches these by the component's scale parameters: changing
+a mass only rescales a cached array, and changing a scale parameter only
+re-evaluates that component. The enclosed mass is computed from the circular
+velocity in the plane, :math:`M(<r) = r\\,v_c^2/G`, like
+`gala.potential.PotentialBase.mass_enclosed`.
+
+The bar is not axisymmetric, so its contribution is averaged over azimuth in
+the plane. The shape of the bar (the SCF expansion, truncated at corotation) is
+held fixed at that of the input configuration - only its mass is fit.
+"""
+
+# Standard library
+from importlib import resources
+from os import path
+
+# Third-party
+import astropy.units as u
+from astropy.constants import G
+import numpy as np
+from scipy.optimize import minimize
+
+# Project
+from ..log import logger
+from .core import (Config, _get_config, _disk, _spheroid, _halo,
+                   get_bar_potential)
+
+__all__ = ['load_rotation_curve', 'load_enclosed_mass', 'RotationCurveModel',
+           'fit_potential', 'update_config']
+
+def _load_data(filename, default, **kwargs):
+    """Load a data table from a file, or from the package data by default."""
+    if filename is not None:
+        return np.loadtxt(filename, unpack=True, **kwargs)
+
+    ref = resources.files(__package__) / 'data' / default
+    with resources.as_file(ref) as filename:
+        return np.loadtxt(filename, unpack=True, **kwargs)
+
+_G = G.to(u.kpc*u.km**2/u.s**2/u.Msun).value
+
+# name, potential factory, mass parameter, scale parameters
+_components = [
+    ('disk', _disk, 'disk_mass', ('disk_a', 'disk_b')),
+    ('spheroid', _spheroid, 'spheroid_mass', ('spheroid_c',)),
+    ('halo', _halo, 'halo_mass', ('halo_r_s',))
+]
+
+def load_rotation_curve(filename=None):
+    """Load rotation curve data.
+
+    Parameters
+    ----------
+    filename : str, optional
+        Path to a whitespace-delimited file with columns radius [kpc],
+        circular velocity [km/s], and its uncertainty [km/s]. Defaults to the
+        Sofue (2012) compilation shipped with the package.
+
+    Returns
+    -------
+    R : numpy.ndarray
+    v : numpy.ndarray
+    v_err : numpy.ndarray
+    """
+    R, v, v_err = _load_data(filename, 'Sofue.dat', skiprows=1)
+    return R, v, v_err
+
+def load_enclosed_mass(filename=None):
+    """Load enclosed mass measurements.
+
+    Parameters
+    ----------
+    filename : str, optional
+        Path to a comma-delimited file with columns radius [kpc], enclosed mass
+        [Msun], and its lower and upper uncertainties [Msun]. Defaults to the
+        compilation in ``MW-Menc.txt`` shipped with the package.
+
+    Returns
+    -------
+    r : numpy.ndarray
+    M : numpy.ndarray
+    M_err_neg : numpy.ndarray
+    M_err_pos : numpy.ndarray
+    """
+    r, M, M_err_neg, M_err_pos = _load_data(filename, 'MW-Menc.txt',
+                                            delimiter=',')
+    return r, M, M_err_neg, M_err_pos
+
+
+class RotationCurveModel(object):
+    """The circular velocity and enclosed mass of the potential model at the
+    radii of the data, and the likelihood of the data.
+
+    Parameters are passed as arrays with the values of the settings named by
+    ``param_names`` (see the ``potential`` config namespace) along the last
+    axis. All methods are vectorized over any leading axes, so many sets of
+    parameters can be evaluated at once.
+
+    Parameters
+    ----------
+    config : str, `~barchaos.config.ConfigSnapshot`, optional
+        Path to a configuration file, or a configuration snapshot. This sets
+        the shape of the bar, and the initial parameter values for fitting.
+    rotation_curve : tuple, optional
+        The rotation curve data, as returned by `load_rotation_curve` (the
+        default).
+    enclosed_mass : tuple, optional
+        The enclosed mass data, as returned by `load_enclosed_mass` (the
+        default).
+    bar : bool, optional
+        Include the bar component.
+    r_min : float, optional
+        Only use data outside of this radius [kpc]. The model has no central
+        black hole or nuclear star cluster.
+    n_phi : int, optional
+        Number of azimuthal angles to average the bar contribution over.
+    """
+
+    def __init__(self, config=None, rotation_curve=None, enclosed_mass=None,
+                 bar=True, r_min=0.25, n_phi=16):
+        self.config = _get_config(config)
+
+        if rotation_curve is None:
+            rotation_curve = load_rotation_curve()
+
+        if enclosed_mass is None:
+            enclosed_mass = load_enclosed_mass()
+
+        R, v, v_err = map(np.asarray, rotation_curve)
+        idx = R > r_min
+        self.R, self.v, self.v_err = R[idx], v[idx], v_err[idx]
+
+        r, M, M_err_neg, M_err_pos = map(np.asarray, enclosed_mass)
+        idx = r > r_min
+        self.r, self.M = r[idx], M[idx]
+        self.M_err_neg, self.M_err_pos = M_err_neg[idx], M_err_pos[idx]
+
+        # all radii to evaluate the components at
+        self._radii = np.concatenate((self.R, self.r))
+
+        self.param_names = [name for _, _, mass, scales in _components
+                            for name in (mass,) + scales]
+
+        self.bar = bar
+        if self.bar:
+            self.param_names.append('bar_mass')
+            self._bar_vc2 = self._bar_unit_vc2(config, n_phi)
+
+        # unit-mass squared circular velocities, keyed by component name and
+        # scale parameters
+        self._cache = dict()
+
+    def _bar_unit_vc2(self, config, n_phi):
+        bar = get_bar_potential(config)
+
+        phi = np.linspace(0, np.pi, n_phi, endpoint=False)
+        R = self._radii[:, None]
+        xyz = np.stack((R*np.cos(phi), R*np.sin(phi), np.zeros_like(R*phi)))
+        grad = bar.gradient(xyz.reshape(3, -1)).reshape(xyz.shape)
+
+        # R dPhi/dR, averaged over azimuth
+        vc2 = (xyz[0]*grad[0] + xyz[1]*grad[1]).mean(axis=-1) * u.kpc
+        return vc2.to(u.km**2/u.s**2).value / self.config.bar_mass
+
+    def _unit_vc2(self, name, func, scales):
+        key = (name,) + tuple(scales)
+        if key not in self._cache:
+            pot = func(1., *scales)
+            xyz = np.zeros((3, len(self._radii)))
+            xyz[0] = self._radii
+            vc = pot.circular_velocity(xyz).to(u.km/u.s).value
+            self._cache[key] = vc**2
+        return self._cache[key]
+
+    def params(self, config=None):
+        """Get the parameter values from a configuration (by default, the
+        model configuration).
+        """
+        c = self.config if config is None else _get_config(config)
+        return np.array([getattr(c, name) for name in self.param_names])
+
+    def circular_velocity_sq(self, p):
+        """The squared circular velocity [km^2/s^2] at the radii of the
+        rotation curve data followed by the enclosed mass data.
+        """
+        p = np.asarray(p, dtype=float)
+        shape = p.shape[:-1]
+        p = p.reshape(-1, len(self.param_names))
+
+        vc2 = np.zeros((p.shape[0], len(self._radii)))
+        for name, func, mass, scales in _components:
+            m = p[:, self.param_names.index(mass)]
+            s = p[:, [self.param_names.index(k) for k in scales]]
+
+            # only evaluate each distinct set of scale parameters once
+            s, inv = np.unique(s, axis=0, return_inverse=True)
+            unit = np.array([self._unit_vc2(name, func, si) for si in s])
+            vc2 += m[:, None] * unit[inv.ravel()]
+
+        if self.bar:
+            m = p[:, self.param_names.index('bar_mass')]
+            vc2 += m[:, None] * self._bar_vc2[None]
+
+        return vc2.reshape(shape + (len(self._radii),))
+
+    def model(self, p):
+        """The circular velocity [km/s] at the rotation curve radii, and the
+        enclosed mass [Msun] at the enclosed mass radii.
+        """
+        vc2 = self.circular_velocity_sq(p)
+        n = len(self.R)
+        return np.sqrt(vc2[..., :n]), self.r * vc2[..., n:] / _G
+
+    def ln_likelihood(self, p):
+        """The log-likelihood of the rotation curve and enclosed mass data. The
+        enclosed mass uncertainties are asymmetric, so the uncertainty on the
+        side of the model is used for each measurement.
+        """
+        vc, M = self.model(p)
+
+        chi2 = np.sum(((vc - self.v) / self.v_err)**2, axis=-1)
+
+        M_err = np.where(M > self.M, self.M_err_pos, self.M_err_neg)
+        chi2 += np.sum(((M - self.M) / M_err)**2, axis=-1)
+
+        return -0.5 * chi2
+
+
+class _Optimizer(object):
+    """ Maximize the likelihood from one starting point (for ``pool.map``) """
+
+    def __init__(self, model, p0, free):
+        self.model = model
+        self.p0 = p0
+        self.free = free
+
+    def params(self, x):
+        p = np.array(self.p0)
+        p[..., self.free] = 10**x
+        return p
+
+    def __call__(self, x0):
+        # all parameters are positive, so fit in log space
+        res = minimize(lambda x: -self.model.ln_likelihood(self.params(x)),
+                       x0=x0, method='Nelder-Mead',
+                       options=dict(xatol=1E-6, fatol=1E-6, maxiter=10000))
+        return res.fun, res.x
+
+def fit_potential(model, free=None, pool=None, n_starts=8, seed=42):
+    """Find the maximum-likelihood parameters of the potential model, starting
+    from the model configuration.
+
+    Parameters
+    ----------
+    model : `RotationCurveModel`
+    free : iterable, optional
+        Names of the parameters to fit. Defaults to the component masses, for
+        which the likelihood doesn't need any re-evaluation of the potential.
+    pool : optional
+        A schwimmbad pool to run the optimizations from each starting point
+        with.
+    n_starts : int, optional
+        Number of starting points, scattered around the initial values by
+        0.1 dex (the first is the initial values).
+    seed : int, optional
+        Seed for the starting points.
+
+    Returns
+    -------
+    params : dict
+        The best-fit values of all model parameters.
+    """
+    if free is None:
+        free = [name for name in model.param_names if name.endswith('_mass')]
+
+    for name in free:
+        if name not in model.param_names:
+            raise ValueError("Unknown parameter '{0}' - must be one of {1}"
+                             .format(name, model.param_names))
+
+    p0 = model.params()
+    free = [model.param_names.index(name) for name in free]
+
+    rnd = np.random.RandomState(seed)
+    x0 = np.log10(p0[free])
+    starts = x0[None] + rnd.normal(0, 0.1, size=(n_starts, len(free)))
+    starts[0] = x0
+
+    optimizer = _Optimizer(model, p0, free)
+    if pool is None:
+        results = list(map(optimizer, starts))
+    else:
+        results = list(pool.map(optimizer, starts))
+
+    funs = [fun for fun, _ in results]
+    best = int(np.argmin(funs))
+    p = optimizer.params(results[best][1])
+
+    logger.info("Best-fit log-likelihood {0:.2f} (initial {1:.2f}), from "
+                "start {2} of {3}".format(-funs[best],
+                                          model.ln_likelihood(p0),
+                                          best+1, n_starts))
+
+    return dict(zip(model.param_names, p.tolist()))
+
+def update_config(params, filename):
+    """Write potential parameters (e.g., the output of `fit_potential`) to the
+    ``potential`` namespace of a configuration file, keeping any other
+    settings in the file.
+    """
+    c = Config()
+
+    # config namespaces are singletons, so restore the current settings after
+    initial = c.to_dict()
+    try:
+        if path.exists(filename):
+            c.load(filename)
+
+        for k, v in params.items():
+            setattr(c, k, float(v))
+
+        c.save(filename)
+
+    finally:
+        for k, v in initial.items():
+            setattr(c, k, v)
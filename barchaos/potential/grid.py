@@ -0,0 +1,258 @@
+# coding: utf-8
+
+r"""
+Interpolated-grid representation of the bar potential.
+
+Evaluating the SCF expansion of the bar requires summing (nmax+1)(lmax+1)^2
+terms at every force evaluation. Because the bar is static in the rotating
+frame, we can instead tabulate the potential and its gradient once on a
+Cartesian grid and evaluate by cubic spline interpolation. The grid points are
+spaced uniformly in :math:`\sinh^{-1}(x/s)` along each axis, so the grid is
+finer near the center of the bar where the potential varies most rapidly.
+
+The bar density model (see `~barchaos.potential.bfe`) is symmetric under
+reflection through each of the three coordinate planes, so only the positive
+octant is tabulated: the potential is even in each coordinate, and each
+gradient component is odd in its own coordinate and even in the others.
+
+Accuracy target: inside the interpolation domain, the fractional error in the
+potential and in the magnitude of the gradient should be below 1E-4 relative to
+the SCF evaluation (see `grid_errors()`). The errors are computed and stored
+with the grid when it is built, so the grid settings in the ``potential``
+config namespace can be increased if this is not met. Outside of the
+interpolation domain, the potential falls back to evaluating the SCF expansion
+directly. The SCF basis functions are cuspy at the origin, so interpolation
+converges slowly there: points within a small radius of the origin also use
+the SCF expansion directly.
+
+`GridBarPotential` is a Python potential, so it can't be used with gala's C
+integrators: it speeds up vectorized evaluations of the bar at many points at
+once (e.g., for computing grids of forces), not orbit integration.
+"""
+
+# Third-party
+import gala.potential as gp
+from gala.units import galactic
+import numpy as np
+from scipy.ndimage import map_coordinates, spline_filter
+
+# Project
+from ..log import logger
+
+__all__ = ['GridBarPotential', 'grid_errors']
+
+# Number of ghost cells to pad the grid with (using the reflection symmetries)
+# below zero along each axis, and number of cells at the upper edge of the grid
+# to exclude from the interpolation domain. Both are set so that the boundary
+# conditions of the spline filter are damped to well below the accuracy target.
+_n_ghost = 8
+_n_margin = 6
+
+class GridBarPotential(gp.PotentialBase):
+    """A bar potential evaluated by interpolating on a precomputed grid.
+
+    Use `GridBarPotential.from_potential` to tabulate a potential. The grid is
+    stored for a unit-mass bar, so the same grid can be reused for any bar
+    mass.
+
+    Parameters
+    ----------
+    m : float
+        The bar mass [Msun].
+    Phi : numpy.ndarray
+        The unit-mass potential on the octant grid, shape ``(nx, ny, nz)``.
+    dPhi : numpy.ndarray
+        The unit-mass gradient on the octant grid, shape ``(3, nx, ny, nz)``.
+    xyz_max : array_like
+        The maximum coordinate value of the grid along each axis [kpc].
+    fallback : `~gala.potential.PotentialBase`
+        The potential to evaluate outside of the interpolation domain, e.g.,
+        the SCF bar potential with mass ``m``.
+    scale : float, optional
+        The scale of the grid stretching: the grid spacing is roughly uniform
+        inside of this and logarithmic outside [kpc].
+    r_min : float, optional
+        Points within this radius of the origin are evaluated with the
+        fallback potential [kpc].
+    units : `~gala.units.UnitSystem`, optional
+    """
+    ndim = 3
+
+    def __init__(self, m, Phi, dPhi, xyz_max, fallback, scale=1., r_min=0.,
+                 units=galactic):
+        super(GridBarPotential, self).__init__(units=units)
+
+        self.m = float(m)
+        self.scale = float(scale)
+        self.r_min = float(r_min)
+        self.Phi = np.asarray(Phi)
+        self.dPhi = np.asarray(dPhi)
+        self.xyz_max = np.asarray(xyz_max, dtype=float)
+        self.fallback = fallback
+
+        self.shape = np.array(self.Phi.shape)
+        umax = np.arcsinh(self.xyz_max / self.scale)
+        self._h = umax / (self.shape - 1)
+        self._domain_max = self.scale * np.sinh(umax - _n_margin * self._h)
+
+        # sign flip of each tabulated quantity when reflected through each of
+        # the coordinate planes (energy, then the three gradient components)
+        parities = [(1, 1, 1), (-1, 1, 1), (1, -1, 1), (1, 1, -1)]
+        arrs = [self.Phi] + list(self.dPhi)
+
+        # pad with ghost cells using the symmetries and precompute the cubic
+        # spline coefficients once
+        self._coeffs = [spline_filter(self._pad(arr, p), order=3, mode='mirror')
+                        for arr, p in zip(arrs, parities)]
+
+    @staticmethod
+    def _pad(arr, parity):
+        for axis in range(3):
+            ghost = np.flip(np.take(arr, range(1, _n_ghost+1), axis=axis),
+                            axis=axis)
+            arr = np.concatenate((parity[axis] * ghost, arr), axis=axis)
+        return arr
+
+    @classmethod
+    def from_potential(cls, potential, m, shape, xyz_max, scale=1., r_min=0.):
+        """Tabulate an octant-symmetric potential on a grid.
+
+        Parameters
+        ----------
+        potential : `~gala.potential.PotentialBase`
+            The potential to tabulate, e.g., the SCF bar potential. This is
+            also used as the fallback outside of the interpolation domain.
+        m : float
+            The mass of the input potential [Msun].
+        shape : tuple
+            Number of grid points along each axis.
+        xyz_max : array_like
+            The maximum coordinate value of the grid along each axis [kpc].
+        scale : float, optional
+            The scale of the grid stretching [kpc].
+        r_min : float, optional
+            Points within this radius of the origin are evaluated with the
+            input potential [kpc].
+        """
+        umax = np.arcsinh(np.asarray(xyz_max, dtype=float) / scale)
+        grids = [scale * np.sinh(np.linspace(0, u, n))
+                 for n, u in zip(shape, umax)]
+        xyz = np.stack(np.meshgrid(*grids, indexing='ij'))
+        xyz = xyz.reshape(3, -1)
+
+        logger.debug("Tabulating potential on a grid with {0} points"
+                     .format(xyz.shape[1]))
+
+        # the SCF expansion is singular on the z axis: evaluate points on the
+        # coordinate planes at a small offset, and set gradient components
+        # perpendicular to the planes to zero (by symmetry)
+        on_plane = xyz == 0
+        h = scale * umax / (np.asarray(shape) - 1)
+        xyz[on_plane] = np.broadcast_to(1E-4 * h[:, None], xyz.shape)[on_plane]
+
+        Phi = potential.energy(xyz).value / m
+        dPhi = potential.gradient(xyz).value / m
+        dPhi[on_plane] = 0.
+
+        Phi = Phi.reshape(shape)
+        dPhi = dPhi.reshape((3,) + tuple(shape))
+
+        return cls(m=m, Phi=Phi, dPhi=dPhi, xyz_max=xyz_max,
+                   fallback=potential, scale=scale, r_min=r_min,
+                   units=potential.units)
+
+    def to_hdf5(self, group):
+        """Save the grid (for a unit-mass bar) to an HDF5 group."""
+        group.create_dataset('Phi', data=self.Phi)
+        group.create_dataset('dPhi', data=self.dPhi)
+        group.attrs['xyz_max'] = self.xyz_max
+        group.attrs['scale'] = self.scale
+        group.attrs['r_min'] = self.r_min
+
+    @classmethod
+    def from_hdf5(cls, group, m, fallback):
+        """Load a grid saved with `GridBarPotential.to_hdf5`."""
+        return cls(m=m, Phi=group['Phi'][:], dPhi=group['dPhi'][:],
+                   xyz_max=group.attrs['xyz_max'], fallback=fallback,
+                   scale=group.attrs['scale'], r_min=group.attrs['r_min'],
+                   units=fallback.units)
+
+    def _split(self, q):
+        """Return a boolean mask of points inside the interpolation domain and
+        the (fractional) grid coordinates of those points.
+        """
+        aq = np.abs(q)
+        inside = (np.all(aq < self._domain_max[None], axis=1) &
+                  (np.sum(q**2, axis=1) > self.r_min**2))
+        u = np.arcsinh(aq[inside] / self.scale)
+        coords = (u / self._h[None] + _n_ghost).T
+        return inside, coords
+
+    def _interp(self, i, coords):
+        return map_coordinates(self._coeffs[i], coords, order=3,
+                               mode='mirror', prefilter=False)
+
+    def _energy(self, q, t=0.):
+        q = np.atleast_2d(q)
+        inside, coords = self._split(q)
+
+        E = np.empty(len(q))
+        E[inside] = self.m * self._interp(0, coords)
+        if not np.all(inside):
+            E[~inside] = self.fallback.energy(q[~inside].T).value
+
+        return E
+
+    def _gradient(self, q, t=0.):
+        # Note: unlike _energy(), gala passes positions to _gradient() with
+        # shape (ndim, N) and expects the same shape back
+        q = np.atleast_2d(q)
+        inside, coords = self._split(q.T)
+
+        grad = np.empty_like(q, dtype=float)
+        sign = np.sign(q[:, inside])
+        for j in range(3):
+            grad[j, inside] = self.m * sign[j] * self._interp(j+1, coords)
+
+        if not np.all(inside):
+            grad[:, ~inside] = self.fallback.gradient(q[:, ~inside]).value
+
+        return grad
+
+
+def grid_errors(grid_potential, potential, n_samples=4096, seed=42):
+    """Compute the maximum fractional errors of the interpolated potential and
+    gradient relative to the potential the grid was computed from, at random
+    points inside the interpolation domain.
+
+    Parameters
+    ----------
+    grid_potential : `GridBarPotential`
+    potential : `~gala.potential.PotentialBase`
+        The reference potential, e.g., the SCF potential the grid was computed
+        from.
+    n_samples : int, optional
+    seed : int, optional
+
+    Returns
+    -------
+    dE : float
+        Maximum fractional error in the potential.
+    dgrad : float
+        Maximum error in the gradient relative to the gradient magnitude.
+    """
+    rnd = np.random.RandomState(seed)
+    xyz = rnd.uniform(-1, 1, size=(3, n_samples))
+    xyz *= grid_potential._domain_max[:, None]
+    xyz = xyz[:, np.sum(xyz**2, axis=0) > grid_potential.r_min**2]
+
+    E1 = grid_potential.energy(xyz).value
+    E2 = potential.energy(xyz).value
+    g1 = grid_potential.gradient(xyz).value
+    g2 = potential.gradient(xyz).value
+
+    dE = np.max(np.abs((E1 - E2) / E2))
+    dgrad = np.max(np.linalg.norm(g1 - g2, axis=0) /
+                   np.linalg.norm(g2, axis=0))
+
+    return dE, dgrad
@@ -0,0 +1,24 @@
+# Third-party
+import numpy as np
+
+# Package
+from ..bfe import prune_scf_coeffs
+
+def test_prune_scf_coeffs():
+    S = np.zeros((7, 7, 7))
+    S[0,0,0] = 1.
+    S[2,2,0] = -0.1
+    S[1,2,2] = 0.01
+    S[6,6,6] = 1E-6
+    S[5,0,0] = 1E-5
+
+    # nothing pruned
+    assert np.all(prune_scf_coeffs(S, 1E-8) == S)
+
+    S2 = prune_scf_coeffs(S, 1E-4)
+    assert S2.shape == (3, 3, 3)
+    assert np.count_nonzero(S2) == 3
+    assert S2[2,2,0] == S[2,2,0]
+
+    # the input isn't modified
+    assert S[6,6,6] == 1E-6
@@ -0,0 +1,67 @@
+# Third-party
+import astropy.units as u
+import numpy as np
+import pytest
+
+# Package
+from ..core import Config, get_potential_no_bar
+from ..fit import (RotationCurveModel, fit_potential, update_config,
+                   load_rotation_curve, load_enclosed_mass)
+from ...config import ConfigSnapshot
+
+@pytest.fixture(scope='module')
+def model():
+    return RotationCurveModel(bar=False)
+
+def test_data():
+    R, v, v_err = load_rotation_curve()
+    assert len(R) == len(v) == len(v_err)
+    assert np.all(v_err > 0)
+
+    r, M, M_err_neg, M_err_pos = load_enclosed_mass()
+    assert np.all(M_err_neg > 0) and np.all(M_err_pos > 0)
+
+def test_model(model):
+    p = model.params()
+    vc, M = model.model(p)
+
+    pot = get_potential_no_bar()
+    xyz = np.zeros((3, len(model.R)))
+    xyz[0] = model.R
+    assert np.allclose(vc, pot.circular_velocity(xyz).to(u.km/u.s).value)
+
+    xyz = np.zeros((3, len(model.r)))
+    xyz[0] = model.r
+    assert np.allclose(M, pot.mass_enclosed(xyz).to(u.Msun).value, rtol=1E-4)
+
+    # vectorized over parameter sets
+    ps = p[None] * np.random.uniform(0.8, 1.2, size=(5, len(p)))
+    lnL = model.ln_likelihood(ps)
+    assert lnL.shape == (5,)
+    assert np.allclose(lnL, [model.ln_likelihood(pi) for pi in ps])
+
+def test_fit(model):
+    # fake data from a model with different masses
+    p_true = model.params()
+    p_true[model.param_names.index('disk_mass')] *= 1.3
+    p_true[model.param_names.index('halo_mass')] *= 0.8
+    vc, M = model.model(p_true)
+
+    fake = RotationCurveModel(bar=False,
+                              rotation_curve=(model.R, vc, 0.01*vc),
+                              enclosed_mass=(model.r, M, 0.01*M, 0.01*M))
+    params = fit_potential(fake, n_starts=2)
+    assert np.allclose([params[k] for k in fake.param_names], p_true,
+                       rtol=1E-3)
+
+def test_update_config(tmpdir):
+    filename = str(tmpdir.join('config.yml'))
+    with open(filename, 'w') as f:
+        f.write("potential:\n  Omega: 50.\n")
+
+    update_config(dict(disk_mass=6E10, halo_r_s=20.), filename)
+
+    c = ConfigSnapshot.load(filename, [Config()])['potential']
+    assert c.disk_mass == 6E10
+    assert c.halo_r_s == 20.
+    assert c.Omega == 50.
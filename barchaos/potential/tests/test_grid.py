@@ -0,0 +1,78 @@
+# Third-party
+import biff.scf as bscf
+from gala.units import galactic
+import h5py
+import numpy as np
+import pytest
+
+# Package
+from ..core import Config, GridConfig, _get_grid_config
+from ..grid import GridBarPotential, grid_errors
+from ...config import ConfigSnapshot
+
+@pytest.fixture(scope='module')
+def scf_bar():
+    # A cheap, triaxial SCF potential with only even terms, like the bar
+    S = np.zeros((4, 4, 4))
+    S[0,0,0] = 1.
+    S[1,0,0] = 0.2
+    S[0,2,0] = -0.1
+    S[0,2,2] = 0.05
+    S[2,2,2] = 0.02
+    return bscf.SCFPotential(m=1E10, r_s=1., Snlm=S, Tnlm=np.zeros_like(S),
+                             units=galactic)
+
+@pytest.fixture(scope='module')
+def grid_bar(scf_bar):
+    return GridBarPotential.from_potential(scf_bar, m=1E10, shape=(64,64,64),
+                                           xyz_max=(10., 10., 5.),
+                                           scale=0.5, r_min=0.1)
+
+def test_accuracy(grid_bar, scf_bar):
+    dE, dgrad = grid_errors(grid_bar, scf_bar)
+    assert dE < 1E-4
+    assert dgrad < 1E-4
+
+def test_symmetry(grid_bar):
+    xyz = np.array([0.7, 0.3, 0.2])
+    signs = np.array([[1,1,1], [-1,1,1], [1,-1,1], [1,1,-1], [-1,-1,-1]]).T
+
+    E = grid_bar.energy(xyz[:, None] * signs).value
+    assert np.allclose(E, E[0])
+
+    grad = grid_bar.gradient(xyz[:, None] * signs).value
+    assert np.allclose(grad, grad[:, :1] * signs)
+
+def test_fallback(grid_bar, scf_bar):
+    # outside of the grid, and close to the origin
+    xyz = np.array([[20., 1., 1.], [0.01, 0.02, 0.03]]).T
+    assert np.allclose(grid_bar.energy(xyz), scf_bar.energy(xyz))
+    assert np.allclose(grid_bar.gradient(xyz), scf_bar.gradient(xyz))
+
+def test_hdf5(grid_bar, scf_bar, tmpdir):
+    fn = str(tmpdir / 'grid.hdf5')
+    with h5py.File(fn, 'w') as f:
+        grid_bar.to_hdf5(f.create_group('grid'))
+
+    with h5py.File(fn, 'r') as f:
+        grid_bar2 = GridBarPotential.from_hdf5(f['grid'], m=2E10,
+                                               fallback=scf_bar)
+
+    xyz = np.array([0.7, 0.3, 0.2])
+    assert np.allclose(grid_bar2.energy(xyz), 2*grid_bar.energy(xyz))
+
+def test_grid_config(tmpdir):
+    config_file = str(tmpdir / 'config.yml')
+    with open(config_file, 'w') as f:
+        f.write("bar_grid:\n  size: 32\n")
+
+    # the grid settings don't change the potential settings (which key the
+    # results of the experiments)
+    snapshot = ConfigSnapshot.load(config_file, [Config(), GridConfig()])
+    default = ConfigSnapshot.load(None, [Config()])
+    assert snapshot['potential'].digest() == default['potential'].digest()
+    assert _get_grid_config(snapshot).size == 32
+    assert _get_grid_config(config_file).size == 32
+
+    # defaults for snapshots without grid settings
+    assert _get_grid_config(default).size == 96
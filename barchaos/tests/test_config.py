@@ -2,7 +2,7 @@
 import pytest
 
 # Package
-from ..config import ConfigItem, ConfigNamespace
+from ..config import ConfigItem, ConfigNamespace, ConfigSnapshot
 
 def test_configitem():
     test = ConfigItem(15)
@@ -58,3 +58,81 @@ def test_confignamespace(tmpdir):
 
     c1.load(fn)
     assert c1.derp == 20 # the value saved
+
+def test_configsnapshot(tmpdir):
+    import pickle
+
+    class Config(ConfigNamespace):
+        name = "snapshot_test"
+        derp = ConfigItem(15)
+        herp = ConfigItem(1.5)
+
+    fn = str(tmpdir / 'config.yml')
+    c = Config()
+    c.derp = 20
+    c.save(fn)
+    c.derp = 15
+
+    snapshot = ConfigSnapshot.load(fn, [c])
+    assert snapshot['snapshot_test'].derp == 20
+    assert snapshot['snapshot_test'].herp == 1.5
+
+    # snapshots are immutable
+    with pytest.raises(AttributeError):
+        snapshot['snapshot_test'].derp = 10
+
+    # changing the namespace doesn't change the snapshot
+    c.derp = 30
+    assert snapshot['snapshot_test'].derp == 20
+
+    # stable digest, and survives pickling and serializing
+    snapshot2 = pickle.loads(pickle.dumps(snapshot))
+    assert snapshot2 == snapshot
+    assert snapshot2.digest() == snapshot.digest()
+    assert ConfigSnapshot.from_json(snapshot.to_json()) == snapshot
+    assert hash(snapshot2) == hash(snapshot)
+
+    snapshot3 = snapshot.replace('snapshot_test', derp=21)
+    assert snapshot3['snapshot_test'].derp == 21
+    assert snapshot3.digest() != snapshot.digest()
+
+    # digest of a subset of settings
+    ns = snapshot['snapshot_test']
+    assert ns.digest(['herp']) == snapshot3['snapshot_test'].digest(['herp'])
+    assert ns.digest() != snapshot3['snapshot_test'].digest()
+
+def test_configsnapshot_independent(tmpdir):
+
+    class Config(ConfigNamespace):
+        name = "independent_test"
+        derp = ConfigItem(15)
+        herp = ConfigItem(1.5)
+
+    fn1 = str(tmpdir / 'config1.yml')
+    with open(fn1, 'w') as f:
+        f.write("independent_test:\n  derp: 20\n")
+
+    fn2 = str(tmpdir / 'config2.yml')
+    with open(fn2, 'w') as f:
+        f.write("independent_test:\n  herp: 2.5\n")
+
+    c = Config()
+    alone = ConfigSnapshot.load(fn2, [c])
+
+    # settings from a file loaded before don't carry over
+    ConfigSnapshot.load(fn1, [c])
+    snapshot = ConfigSnapshot.load(fn2, [c])
+    assert snapshot['independent_test'].derp == 15
+    assert snapshot['independent_test'].herp == 2.5
+    assert snapshot.digest() == alone.digest()
+
+    # and the namespace isn't changed, nor are its settings used
+    assert c.derp == 15
+    c.herp = 3.5
+    assert ConfigSnapshot.load(None, [c])['independent_test'].herp == 1.5
+
+    # values are still validated
+    with open(fn1, 'w') as f:
+        f.write("independent_test:\n  derp: wassup\n")
+    with pytest.raises(TypeError):
+        ConfigSnapshot.load(fn1, [c])
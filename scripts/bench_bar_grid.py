@@ -0,0 +1,50 @@
+"""
+Benchmark the interpolated-grid bar potential against evaluating the SCF
+expansion directly: accuracy, and throughput of vectorized force evaluations.
+The grid potential is implemented in Python, so it is not used for orbit
+integration (which uses gala's C integrators with the SCF bar).
+"""
+
+# Standard library
+import time
+
+# Third-party
+import numpy as np
+
+# Project
+from barchaos.log import logger
+from barchaos.potential import (get_bar_potential, get_grid_bar_potential,
+                                grid_errors)
+
+def main(config_file, n_points):
+    bar_scf = get_bar_potential(config_file)
+    bar_grid = get_grid_bar_potential(config_file)
+
+    dE, dgrad = grid_errors(bar_grid, bar_scf)
+    logger.info("Max. fractional error: potential {0:.1e}, gradient {1:.1e}"
+                .format(dE, dgrad))
+
+    # Force evaluations
+    rnd = np.random.RandomState(42)
+    xyz = rnd.uniform(-5, 5, size=(3, n_points))
+    xyz[2] /= 5.
+
+    for name, bar in [('scf', bar_scf), ('grid', bar_grid)]:
+        t0 = time.time()
+        bar.gradient(xyz)
+        t = time.time() - t0
+        logger.info("{0:>4s} bar gradient: {1:.2f} µs per point"
+                    .format(name, t / n_points * 1E6))
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--config', dest='config_file', default=None,
+                        type=str, help='Path to a configuration file.')
+    parser.add_argument('--npoints', dest='n_points', default=100000,
+                        type=int, help='Number of force evaluations.')
+
+    args = parser.parse_args()
+
+    main(args.config_file, n_points=args.n_points)
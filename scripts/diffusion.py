@@ -0,0 +1,69 @@
+# Third-party
+import schwimmbad
+
+# Project
+from barchaos.analysis import FrequencyDiffusion
+from barchaos.log import logger
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    import logging
+
+    # Define parser object
+    parser = ArgumentParser(description="Compute frequency diffusion rates "
+                                        "from the results of an experiment.")
+
+    vq_group = parser.add_mutually_exclusive_group()
+    vq_group.add_argument('-v', '--verbose', action='count', default=0,
+                          dest='verbosity')
+    vq_group.add_argument('-q', '--quiet', action='count', default=0,
+                          dest='quietness')
+
+    # For schwimmbad / pool selection
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--ncores', dest='n_cores', default=1,
+                       type=int, help='Number of processes (uses '
+                                      'multiprocessing).')
+    group.add_argument('--mpi', dest='mpi', default=False,
+                       action='store_true', help='Run with MPI.')
+
+    # For this script
+    parser.add_argument('--cache', dest='cache_file', required=True,
+                        type=str, help='Path to the cache file.')
+    parser.add_argument('--source', dest='source', default='freqmap',
+                        type=str, help='Name of the experiment dataset to '
+                                       'analyze.')
+    parser.add_argument('--chunk-size', dest='chunk_size', default=2**20,
+                        type=int, help='Number of rows to process at once '
+                                       'per worker.')
+
+    args = parser.parse_args()
+
+    # Set logger level based on verbose flags
+    if args.verbosity != 0:
+        if args.verbosity == 1:
+            logger.setLevel(logging.DEBUG)
+        else: # anything >= 2
+            logger.setLevel(1)
+
+    elif args.quietness != 0:
+        if args.quietness == 1:
+            logger.setLevel(logging.WARNING)
+        else: # anything >= 2
+            logger.setLevel(logging.ERROR)
+
+    else: # default
+        logger.setLevel(logging.INFO)
+
+    pool = schwimmbad.choose_pool(mpi=args.mpi, processes=args.n_cores)
+
+    with FrequencyDiffusion(cache_file=args.cache_file, source=args.source,
+                            chunk_size=args.chunk_size) as analysis:
+
+        for _ in pool.map(analysis, analysis.chunks(),
+                          callback=analysis.callback):
+            pass
+
+    analysis.status()
+
+    pool.close()
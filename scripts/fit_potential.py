@@ -0,0 +1,87 @@
+"""
+Fit the disk, spheroid, and halo (and bar mass) of the potential model to the
+Milky Way rotation curve and enclosed mass data shipped with the package (in
+``barchaos/potential/data``), starting from the settings in a configuration
+file, and optionally write the best-fit parameters back to the ``potential``
+namespace of the configuration file.
+"""
+
+# Third-party
+import schwimmbad
+
+# Project
+from barchaos.log import logger
+from barchaos.potential import RotationCurveModel, fit_potential, update_config
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    import logging
+
+    # Define parser object
+    parser = ArgumentParser(description=__doc__)
+
+    vq_group = parser.add_mutually_exclusive_group()
+    vq_group.add_argument('-v', '--verbose', action='count', default=0,
+                          dest='verbosity')
+    vq_group.add_argument('-q', '--quiet', action='count', default=0,
+                          dest='quietness')
+
+    # For schwimmbad / pool selection
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--ncores', dest='n_cores', default=1,
+                       type=int, help='Number of processes (uses '
+                                      'multiprocessing).')
+    group.add_argument('--mpi', dest='mpi', default=False,
+                       action='store_true', help='Run with MPI.')
+
+    # For this script
+    parser.add_argument('--config', dest='config_file', default=None,
+                        type=str, help='Path to a configuration file.')
+    parser.add_argument('--free', dest='free', default=None, nargs='+',
+                        type=str, help='Names of the potential settings to '
+                                       'fit (default: the component masses).')
+    parser.add_argument('--nstarts', dest='n_starts', default=8, type=int,
+                        help='Number of starting points for the optimizer.')
+    parser.add_argument('--no-bar', dest='bar', default=True,
+                        action='store_false',
+                        help='Leave the bar out of the model.')
+    parser.add_argument('--save', dest='save', default=False,
+                        action='store_true',
+                        help='Write the best-fit parameters to the '
+                             'configuration file.')
+
+    args = parser.parse_args()
+
+    # Set logger level based on verbose flags
+    if args.verbosity != 0:
+        if args.verbosity == 1:
+            logger.setLevel(logging.DEBUG)
+        else: # anything >= 2
+            logger.setLevel(1)
+
+    elif args.quietness != 0:
+        if args.quietness == 1:
+            logger.setLevel(logging.WARNING)
+        else: # anything >= 2
+            logger.setLevel(logging.ERROR)
+
+    else: # default
+        logger.setLevel(logging.INFO)
+
+    if args.save and args.config_file is None:
+        parser.error("--save requires --config")
+
+    pool = schwimmbad.choose_pool(mpi=args.mpi, processes=args.n_cores)
+
+    model = RotationCurveModel(args.config_file, bar=args.bar)
+    params = fit_potential(model, free=args.free, pool=pool,
+                           n_starts=args.n_starts)
+    pool.close()
+
+    for k, v in params.items():
+        logger.info("{0}: {1:.4g}".format(k, v))
+
+    if args.save:
+        update_config(params, args.config_file)
+        logger.info("Wrote best-fit parameters to {0}"
+                    .format(args.config_file))
@@ -0,0 +1,110 @@
+"""
+Build a frequency map on an adaptively refined grid of initial conditions in
+(x, z) at fixed Jacobi energy: run FreqMap on a coarse grid, then repeatedly
+refine the grid where the frequency map has structure and run FreqMap on the
+new initial conditions, until the orbit budget (see the ``refine`` config
+namespace) is used up or there is nothing left to refine.
+"""
+
+# Standard library
+from functools import partial
+from os import path
+
+# Third-party
+import numpy as np
+import schwimmbad
+
+# Project
+from barchaos.experiments import FreqMap, AdaptiveGrid, xz_initial_conditions
+from barchaos.log import logger
+from barchaos.potential import get_hamiltonian
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    import logging
+
+    # Define parser object
+    parser = ArgumentParser(description=__doc__)
+
+    vq_group = parser.add_mutually_exclusive_group()
+    vq_group.add_argument('-v', '--verbose', action='count', default=0,
+                          dest='verbosity')
+    vq_group.add_argument('-q', '--quiet', action='count', default=0,
+                          dest='quietness')
+
+    # For schwimmbad / pool selection
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--ncores', dest='n_cores', default=1,
+                       type=int, help='Number of processes (uses '
+                                      'multiprocessing).')
+    group.add_argument('--mpi', dest='mpi', default=False,
+                       action='store_true', help='Run with MPI.')
+
+    # For this script
+    parser.add_argument('--cache', dest='cache_file', required=True,
+                        type=str, help='Path to the cache file. If it '
+                                       'doesn\'t exist, it is created with '
+                                       'the initial grid.')
+    parser.add_argument('--config', dest='config_file', default=None,
+                        type=str, help='Path to a configuration file.')
+    parser.add_argument('--EJ', dest='EJ', default=None, type=float,
+                        help='Jacobi energy of the grid [kpc^2/Myr^2].')
+    parser.add_argument('--xlim', dest='xlim', default=[0., 10.], nargs=2,
+                        type=float, help='Range of x of the initial grid.')
+    parser.add_argument('--zlim', dest='zlim', default=[0., 5.], nargs=2,
+                        type=float, help='Range of z of the initial grid.')
+    parser.add_argument('--spacing', dest='spacing', default=0.5, type=float,
+                        help='Spacing of the initial grid [kpc].')
+
+    args = parser.parse_args()
+
+    # Set logger level based on verbose flags
+    if args.verbosity != 0:
+        if args.verbosity == 1:
+            logger.setLevel(logging.DEBUG)
+        else: # anything >= 2
+            logger.setLevel(1)
+
+    elif args.quietness != 0:
+        if args.quietness == 1:
+            logger.setLevel(logging.WARNING)
+        else: # anything >= 2
+            logger.setLevel(logging.ERROR)
+
+    else: # default
+        logger.setLevel(logging.INFO)
+
+    H = get_hamiltonian(args.config_file)
+
+    if not path.exists(args.cache_file):
+        if args.EJ is None:
+            raise ValueError("You must specify the Jacobi energy (--EJ) to "
+                             "create a new grid.")
+
+        h = args.spacing
+        x = np.arange(args.xlim[0] + h/2, args.xlim[1], h)
+        z = np.arange(args.zlim[0] + h/2, args.zlim[1], h)
+        xz = np.stack([a.ravel() for a in np.meshgrid(x, z)], axis=1)
+
+        AdaptiveGrid.create(args.cache_file, xz, spacing=[h, h],
+                            w0=xz_initial_conditions(xz, args.EJ, H),
+                            EJ=args.EJ)
+
+    grid = AdaptiveGrid(args.cache_file, config_file=args.config_file)
+    ic_func = partial(xz_initial_conditions, EJ=grid.attrs['EJ'], H=H)
+
+    pool = schwimmbad.choose_pool(mpi=args.mpi, processes=args.n_cores)
+
+    while True:
+        # orbits that are already done are skipped
+        with FreqMap(cache_file=args.cache_file,
+                     config_file=args.config_file) as exp:
+            for _ in pool.map(exp, exp.indices(), callback=exp.callback):
+                pass
+
+        if grid.refine(ic_func) == 0:
+            break
+
+    exp.status()
+
+    pool.close()
@@ -5,6 +5,26 @@ import schwimmbad
 from barchaos import experiments
 from barchaos.log import logger
 
+def run(pool, runner, tasks, requeue_factor=None):
+    """Process the tasks with the experiment (or sweep), then re-run any
+    orbits that ran out of time with a larger time budget.
+    """
+    for _ in pool.map(runner, tasks, callback=runner.callback):
+        pass
+
+    if requeue_factor is None or not runner.time_budget:
+        return
+
+    tasks = runner.timed_out()
+    if len(tasks) > 0:
+        runner.time_budget = runner.time_budget * requeue_factor
+        logger.info("Re-running {0} orbits that ran out of time with a time "
+                    "budget of {1:.0f} s".format(len(tasks),
+                                                 runner.time_budget))
+
+        for _ in pool.map(runner, tasks, callback=runner.callback):
+            pass
+
 if __name__ == "__main__":
     from argparse import ArgumentParser
     import logging
@@ -36,11 +56,86 @@ if __name__ == "__main__":
                                        'execute.')
     parser.add_argument('--cache', dest='cache_file', required=True,
                         type=str, help='Path to the cache file.')
-    parser.add_argument('--config', dest='config_file', default=None,
-                        type=str, help='Path to a configuration file.')
+
+    config_group = parser.add_mutually_exclusive_group()
+    config_group.add_argument('--config', dest='config_file', default=None,
+                              type=str, help='Path to a configuration file.')
+    config_group.add_argument('--sweep', dest='sweep_files', default=None,
+                              type=str, nargs='+',
+                              help='Paths to several configuration files to '
+                                   'run the experiment for, storing the '
+                                   'results for each in a separate dataset '
+                                   'in the cache file named by the digest of '
+                                   'the configuration.')
+
+    parser.add_argument('--prescreen', dest='prescreen', default=False,
+                        action='store_true',
+                        help='Use the results of the LyapunovScreen '
+                             'experiment to skip (or integrate for fewer '
+                             'periods) orbits that are clearly regular or '
+                             'chaotic. Only supported by FreqMap.')
+
+    parser.add_argument('--orbit-store', dest='orbit_store', default=None,
+                        type=str, help='Path to an orbit store. For '
+                                       'OrbitIntegration, the store to write '
+                                       'orbits to; for FreqMap, the store to '
+                                       'read orbits from instead of '
+                                       'integrating.')
+
+    parser.add_argument('--time-budget', dest='time_budget', default=None,
+                        type=float, help='Wall-clock time budget for each '
+                                         'orbit, in seconds. Orbits that run '
+                                         'out of time get error code 6. Each '
+                                         'orbit is processed in a forked '
+                                         'process, so not supported with '
+                                         '--mpi.')
+    parser.add_argument('--requeue-timeouts', dest='requeue_factor',
+                        default=None, type=float,
+                        help='At the end of the run, re-run orbits that ran '
+                             'out of time with the time budget multiplied by '
+                             'this factor.')
+
+    parser.add_argument('--pipeline', dest='stages', default=None,
+                        type=str, nargs='+',
+                        help='Names of other experiment classes to run as '
+                             'stages on the same integrated orbits as the '
+                             'main experiment (e.g., OrbitStats with '
+                             'FreqMap), writing to their own datasets.')
+
+    parser.add_argument('--lease', dest='lease_size', default=None,
+                        type=int, metavar='CHUNK',
+                        help='Cooperate with other independent jobs on the '
+                             'same cache file: claim chunks of this many '
+                             'orbits at a time through a ledger next to the '
+                             'cache file. Not supported with --sweep or '
+                             '--requeue-timeouts.')
+    parser.add_argument('--lease-time', dest='lease_time', default=600.,
+                        type=float, help='Time until a lease on a chunk of '
+                                         'orbits expires unless renewed (as '
+                                         'each orbit completes), in seconds.')
+
+    parser.add_argument('--profile', dest='profile', default=None,
+                        type=int, metavar='N',
+                        help='Profile every Nth orbit with cProfile. Each '
+                             'worker writes its profile to a directory next '
+                             'to the cache file, and the merged profile is '
+                             'reported after the status.')
 
     args = parser.parse_args()
 
+    if args.lease_size is not None and args.sweep_files is not None:
+        parser.error("--lease is not supported with --sweep")
+
+    if args.time_budget is not None and args.mpi:
+        parser.error("--time-budget is not supported with --mpi")
+
+    if args.lease_size is not None and args.requeue_factor is not None:
+        parser.error("--requeue-timeouts is not supported with --lease")
+
+    if args.stages is not None and (args.sweep_files is not None or
+                                    args.lease_size is not None):
+        parser.error("--pipeline is not supported with --sweep or --lease")
+
     # Set logger level based on verbose flags
     if args.verbosity != 0:
         if args.verbosity == 1:
@@ -61,13 +156,53 @@ if __name__ == "__main__":
 
     cls = getattr(experiments, args.experiment)
 
-    with cls(cache_file=args.cache_file, config_file=args.config_file,
-             overwrite=args.overwrite) as exp:
+    kwargs = dict()
+    if args.prescreen:
+        kwargs['prescreen'] = True
 
-        for _ in pool.map(exp, list(range(exp.n_orbits)),
-                          callback=exp.callback):
-            pass
+    if args.orbit_store is not None:
+        kwargs['orbit_store'] = args.orbit_store
+
+    if args.time_budget is not None:
+        kwargs['time_budget'] = args.time_budget
+
+    if args.profile is not None:
+        kwargs['profile'] = args.profile
+
+    if args.lease_size is not None:
+        kwargs['shared'] = True
+
+    if args.sweep_files is not None:
+        with experiments.Sweep(cls, cache_file=args.cache_file,
+                               config_files=args.sweep_files,
+                               overwrite=args.overwrite, **kwargs) as sweep:
+
+            run(pool, sweep, sweep.tasks(), args.requeue_factor)
+
+            sweep.status()
+
+    elif args.stages is not None:
+        stages = [cls] + [getattr(experiments, name) for name in args.stages]
+        with experiments.Pipeline(args.cache_file, stages,
+                                  config_file=args.config_file,
+                                  overwrite=args.overwrite,
+                                  **kwargs) as pipeline:
+
+            run(pool, pipeline, pipeline.indices(), args.requeue_factor)
+
+            pipeline.status()
+
+    else:
+        with cls(cache_file=args.cache_file, config_file=args.config_file,
+                 overwrite=args.overwrite, **kwargs) as exp:
+
+            if args.lease_size is not None:
+                experiments.process_leases(exp, pool,
+                                           chunk_size=args.lease_size,
+                                           lease_time=args.lease_time)
+            else:
+                run(pool, exp, exp.indices(), args.requeue_factor)
 
-        exp.status()
+            exp.status()
 
     pool.close()
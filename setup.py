@@ -16,7 +16,10 @@ import barchaos
 pkg_data = dict()
 pkg_data["barchaos"] = ["README.md", "LICENSE"]
 pkg_data["barchaos.potential"] = ["data/README.md",
-                                  "data/coeffs.hdf5"]
+                                  "data/coeffs.hdf5",
+                                  "data/grids.hdf5",
+                                  "data/Sofue.dat",
+                                  "data/MW-Menc.txt"]
 
 setup(
     name="barchaos",
@@ -24,7 +27,8 @@ setup(
     author="Adrian Price-Whelan",
     author_email="adrianmpw@gmail.com",
     url="https://github.com/adrn/BarChaos",
-    packages=["barchaos", "barchaos.experiments", "barchaos.potential"],
+    packages=["barchaos", "barchaos.analysis", "barchaos.experiments",
+              "barchaos.potential"],
     description="",
     long_description=open("README.md").read(),
     package_data=pkg_data,